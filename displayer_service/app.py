@@ -2,6 +2,8 @@ import common.screen_manager
 import logging
 import threading
 
+from common.metrics import MetricsExporter
+
 
 if __name__ == "__main__":
     # Initialise the ScreenManager.
@@ -13,6 +15,30 @@ if __name__ == "__main__":
         target=display.refresh_in_background, daemon=True)
     image_refresh_thread.start()
 
+    # Images are only retrieved locally when not fetching frames from a
+    # render server.
+    if display.image_retriever is not None:
+        # Create a thread for keeping the image index in sync with the image source.
+        index_refresh_thread = threading.Thread(
+            target=display.image_retriever.image_index.refresh_in_background, daemon=True)
+        index_refresh_thread.start()
+
+        # Create a thread for crawling the metadata of newly indexed images.
+        metadata_crawler_thread = threading.Thread(
+            target=display.image_retriever.metadata_store.crawl_in_background, daemon=True)
+        metadata_crawler_thread.start()
+
+    # Create a thread for applying changes to the display config file.
+    if display.display_config.config['config_reload']['enabled']:
+        threading.Thread(
+            target=display.display_config.watch_in_background, daemon=True).start()
+
+    # Create a thread for exporting the pipeline's timings and gauges.
+    if display.display_config.config['metrics']['export_enabled']:
+        metrics_exporter = MetricsExporter(display.logger, display.display_config)
+        threading.Thread(
+            target=metrics_exporter.export_in_background, daemon=True).start()
+
     # Block the main thread until the user interrupts the program
     try:
         image_refresh_thread.join()
@@ -0,0 +1,291 @@
+#!/usr/bin/python3
+
+"""Benchmarks the image pipeline on simulated hardware.
+
+Generates a corpus of synthetic photos of varying size and format, then
+measures the latency of each stage of displaying them (list, copy, decode,
+crop, resize, date burn, quantize, show) and the peak memory used, as well as
+weighted image selection over a large album. Results are written as JSON for
+regression tracking.
+
+Usage: python benchmark.py [--output benchmark-results.json]
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import statistics
+import tempfile
+import time
+
+import numpy as np
+import PIL
+from PIL import Image
+
+from common import image_processor
+from common.display_config import DisplayConfig
+from common.image_index import ImageIndex
+from common.image_retriever import ImageRetriever
+from common.simulated_hardware import SimulatedInky
+from common.weighted_scheduler import WeightedScheduler
+
+
+RESOLUTION = (600, 448)
+# (name, width, height, format) of each synthetic photo in the corpus.
+CORPUS = [
+    ("2mp-landscape", 1632, 1224, 'JPEG'),
+    ("12mp-landscape", 4000, 3000, 'JPEG'),
+    ("12mp-portrait", 3000, 4000, 'JPEG'),
+    ("12mp-landscape-png", 4000, 3000, 'PNG'),
+    ("24mp-landscape", 6000, 4000, 'JPEG'),
+    ("50mp-landscape", 8160, 6120, 'JPEG'),
+    ("panorama", 12000, 2000, 'JPEG'),
+]
+FILE_EXTENSIONS = {'JPEG': '.jpg', 'PNG': '.png'}
+STAGES = ['copy', 'decode', 'crop', 'resize', 'date_burn', 'quantize', 'show']
+# Number of weighted draws and weight updates to time.
+NUM_SAMPLING_OPERATIONS = 10000
+
+
+def generate_photo(width, height, seed):
+    """Returns a synthetic photo: smooth colour gradients with sensor noise."""
+    rng = np.random.RandomState(seed)
+    x = np.linspace(0, 1, width, dtype=np.float32)
+    y = np.linspace(0, 1, height, dtype=np.float32)[:, np.newaxis]
+    channels = []
+    for _ in range(3):
+        phase_x, phase_y = rng.uniform(0, 2 * np.pi, 2)
+        channel = 128 + 60 * np.sin(4 * x + phase_x) + 60 * np.cos(3 * y + phase_y)
+        channels.append(channel)
+    pixels = np.stack(np.broadcast_arrays(*channels), axis=-1)
+    pixels += rng.normal(0, 8, (height, width, 1)).astype(np.float32)
+    return Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8), 'RGB')
+
+
+def generate_corpus(corpus_dir, max_megapixels):
+    """Writes the synthetic corpus into the given directory."""
+    for seed, (name, width, height, image_format) in enumerate(CORPUS):
+        if width * height > max_megapixels * 1_000_000:
+            continue
+        img = generate_photo(width, height, seed)
+        exif = img.getexif()
+        exif[306] = "2023:03:06 15:03:42"
+        img.save(os.path.join(corpus_dir, name + FILE_EXTENSIONS[image_format]),
+                 format=image_format, exif=exif.tobytes())
+
+
+def time_stages(image_retriever, image_path, output_dir, dither, crop_mode):
+    """Runs one image through the pipeline, returning each stage's latency."""
+    stage_secs = {}
+    display = SimulatedInky(logging.getLogger(), RESOLUTION, output_dir, 0)
+
+    def timed(stage, function, *args):
+        start_time = time.perf_counter()
+        result = function(*args)
+        stage_secs[stage] = time.perf_counter() - start_time
+        return result
+
+    image_file = timed('copy', image_retriever.fetch_image_file, image_path)
+    img = timed('decode', lambda: image_processor.decode_for_display(
+        Image.open(image_file), RESOLUTION))
+    width, height = RESOLUTION
+    img = timed('crop', lambda: image_processor.crop_to_box(
+        img, image_processor.determine_crop_box(img, width / height, crop_mode)))
+    img = timed('resize', img.resize, RESOLUTION)
+    img = timed('date_burn', image_processor.burn_date_into_image, img)
+    frame = timed('quantize', image_processor.palettize, img,
+                  image_processor.DEFAULT_SATURATION, dither)
+    timed('show', lambda: (display.set_image(frame), display.show()))
+    image_retriever.clean_up_image_file(image_file)
+    return stage_secs
+
+
+def make_display_config(temp_dir):
+    """Returns the default display config, with everything it writes to disk
+    redirected into the given directory, so that benchmarking never touches
+    the service's own index, metadata, frame cache, state or local copies."""
+    display_config = DisplayConfig(logging.getLogger())
+    config = display_config.config
+    config['image_index']['index_file_path'] = os.path.join(temp_dir, 'index.json')
+    config['metadata']['db_path'] = os.path.join(temp_dir, 'metadata.sqlite3')
+    config['frame_cache']['cache_dir'] = os.path.join(temp_dir, 'frame-cache')
+    config['state']['state_dir'] = os.path.join(temp_dir, 'state')
+    config['retrieval']['local_copy_dir'] = os.path.join(temp_dir, 'local-copies')
+    return display_config
+
+
+def benchmark_case(image_path, num_repeats, dither, crop_mode, result_queue):
+    """Benchmarks one image. Runs in its own process to isolate peak memory."""
+    start_rss_bytes = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    with tempfile.TemporaryDirectory() as temp_dir:
+        display_config = make_display_config(temp_dir)
+        image_retriever = ImageRetriever(logging.getLogger(), display_config)
+        runs = [time_stages(image_retriever, image_path, temp_dir, dither, crop_mode)
+                for _ in range(num_repeats)]
+    peak_rss_bytes = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    stage_secs = {stage: statistics.median(run[stage] for run in runs)
+                  for stage in STAGES}
+    result_queue.put({
+        'stage_secs': stage_secs,
+        'total_secs': sum(stage_secs.values()),
+        'peak_rss_bytes': peak_rss_bytes,
+        'peak_rss_increase_bytes': peak_rss_bytes - start_rss_bytes,
+    })
+
+
+def time_listing(corpus_dir, num_repeats):
+    """Returns the median latency of listing the corpus into the image index."""
+    with tempfile.TemporaryDirectory() as temp_dir:
+        display_config = make_display_config(temp_dir)
+        display_config.config['display']['image_source_dir'] = corpus_dir
+        image_index = ImageIndex(logging.getLogger(), display_config)
+        listing_secs = []
+        for _ in range(num_repeats):
+            start_time = time.perf_counter()
+            image_index.scan_image_source()
+            listing_secs.append(time.perf_counter() - start_time)
+    return statistics.median(listing_secs)
+
+
+class SyntheticImageIndex:
+    """Stands in for the image index of an album of the given size."""
+
+    def __init__(self, num_images):
+        now = time.time()
+        rng = random.Random(0)
+        self.generation = 1
+        self.entries = {
+            f"/album/{image_num:06d}.jpg": {
+                'size': 4 * 1024 * 1024,
+                # Spread over the last 10 years.
+                'mtime': now - rng.random() * 10 * 365 * 86400,
+                'extension': '.jpg',
+            } for image_num in range(num_images)}
+
+    def get_entries(self):
+        return dict(self.entries)
+
+
+def time_weighted_sampling(num_images):
+    """Returns the latency of building, drawing from and updating the weights
+    of a weighted schedule over an album of the given size."""
+    display_config = DisplayConfig(logging.getLogger())
+    display_config.config['schedule']['weighting_rules'] = [
+        {"rule": "recent", "weight": 3.0, "days": 30},
+        {"rule": "on_this_day", "weight": 5.0, "window_days": 0},
+        {"rule": "favourites", "weight": 2.0,
+         "file_names": [f"{image_num:06d}.jpg" for image_num in range(0, num_images, 100)]},
+    ]
+    scheduler = WeightedScheduler(logging.getLogger(), display_config,
+                                  SyntheticImageIndex(num_images))
+
+    start_time = time.perf_counter()
+    with scheduler.lock:
+        scheduler.sync()
+    build_secs = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    for _ in range(NUM_SAMPLING_OPERATIONS):
+        scheduler.next()
+    draw_secs = (time.perf_counter() - start_time) / NUM_SAMPLING_OPERATIONS
+
+    rng = random.Random(0)
+    start_time = time.perf_counter()
+    for _ in range(NUM_SAMPLING_OPERATIONS):
+        scheduler.tree.update(rng.randrange(num_images), rng.uniform(0.5, 5))
+    update_secs = (time.perf_counter() - start_time) / NUM_SAMPLING_OPERATIONS
+
+    print(f"{'weighted sampling':>20}: {num_images} images, built in {build_secs:.3f}s, "
+          f"{draw_secs * 1e6:.1f}us per draw, {update_secs * 1e6:.1f}us per update")
+    return {
+        'num_images': num_images,
+        'build_secs': build_secs,
+        'draw_secs': draw_secs,
+        'update_secs': update_secs,
+    }
+
+
+def run_benchmark(corpus_dir, num_repeats, dither, crop_mode, num_sampling_images):
+    """Benchmarks every image in the corpus directory, and weighted sampling."""
+    cases = []
+    for file_name in sorted(os.listdir(corpus_dir)):
+        image_path = os.path.join(corpus_dir, file_name)
+        with Image.open(image_path) as img:
+            width, height = img.size
+            image_format = img.format
+
+        result_queue = multiprocessing.Queue()
+        case_process = multiprocessing.Process(
+            target=benchmark_case,
+            args=(image_path, num_repeats, dither, crop_mode, result_queue))
+        case_process.start()
+        case_result = result_queue.get()
+        case_process.join()
+
+        case_result.update({
+            'name': os.path.splitext(file_name)[0],
+            'format': image_format,
+            'width': width,
+            'height': height,
+            'file_size_bytes': os.path.getsize(image_path),
+        })
+        print(f"{case_result['name']:>20}: {case_result['total_secs']:.3f}s, "
+              f"peak RSS {case_result['peak_rss_bytes'] / 2 ** 20:.1f} MiB")
+        cases.append(case_result)
+
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'machine': platform.machine(),
+        'python_version': platform.python_version(),
+        'pillow_version': PIL.__version__,
+        'numpy_version': np.__version__,
+        'resolution': list(RESOLUTION),
+        'dither': dither,
+        'crop_mode': crop_mode,
+        'num_repeats': num_repeats,
+        'list_secs': time_listing(corpus_dir, num_repeats),
+        'cases': cases,
+        'weighted_sampling': time_weighted_sampling(num_sampling_images),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--output', default='benchmark-results.json',
+                        help="Path to write the JSON results to.")
+    parser.add_argument('--corpus-dir',
+                        help="Benchmark these images instead of a synthetic corpus.")
+    parser.add_argument('--max-megapixels', type=float, default=50,
+                        help="Skip synthetic photos larger than this.")
+    parser.add_argument('--repeats', type=int, default=3,
+                        help="Number of times to run each image through the pipeline.")
+    parser.add_argument('--dither', default=image_processor.DEFAULT_DITHER,
+                        choices=[image_processor.FLOYD_STEINBERG_DITHER,
+                                 image_processor.BAYER_DITHER,
+                                 image_processor.ROW_DIFFUSION_DITHER])
+    parser.add_argument('--crop-mode', default=image_processor.CONTENT_AWARE_CROP,
+                        choices=[image_processor.CENTER_CROP,
+                                 image_processor.CONTENT_AWARE_CROP])
+    parser.add_argument('--sampling-images', type=int, default=100000,
+                        help="Album size to benchmark weighted sampling at.")
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    with tempfile.TemporaryDirectory() as synthetic_corpus_dir:
+        corpus_dir = args.corpus_dir
+        if corpus_dir is None:
+            print("Generating synthetic corpus...")
+            generate_corpus(synthetic_corpus_dir, args.max_megapixels)
+            corpus_dir = synthetic_corpus_dir
+        results = run_benchmark(corpus_dir, args.repeats, args.dither, args.crop_mode,
+                                args.sampling_images)
+
+    with open(args.output, 'w', encoding='utf-8') as results_file:
+        json.dump(results, results_file, indent=4)
+    print(f"Wrote results to {args.output}.")
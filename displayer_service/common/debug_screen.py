@@ -2,8 +2,15 @@
 
 """Module for creating the debug screen."""
 
-from PIL import Image, ImageDraw, ImageFont
+import os
+import threading
+
+from PIL import Image, ImageDraw
 from PIL.Image import Image as ImageType
+from typing import List
+
+from common.fonts import load_font
+from common.log_handlers import RingBufferHandler
 
 # At font size 20 and a screen size of 600x448, we can fit:
 #  - 59 characters horizontally.
@@ -15,22 +22,51 @@ MAX_LINES = 22
 FONT_PATH = "fonts/Mono.ttf"
 FONT_SIZE = 20
 
+# Size of the blocks the log file is read in, backwards from its end.
+READ_BLOCK_SIZE = 4096
 
-def transform_logs_to_image(logs_path: str) -> ImageType:
-    """Returns a PIL Image of the debug screen.
+# The last rendered debug screen, as (state of the logs, image). Reused while
+# no new lines have been logged.
+_last_render = None
+_last_render_lock = threading.Lock()
 
-    Writes the most recent few logs to an in-memory PIL image with readable font
-    style and size.
+
+def read_last_lines(logs_path: str, num_lines: int,
+                    block_size=READ_BLOCK_SIZE) -> List[str]:
+    """Returns the last `num_lines` lines of the given file.
+
+    Reads backwards from the end of the file, one block at a time, so the cost
+    doesn't grow with the size of the file.
+    """
+    with open(logs_path, 'rb') as logs_file:
+        position = logs_file.seek(0, os.SEEK_END)
+        blocks = []
+        num_newlines = 0
+        # One more line break than lines is needed to know that the earliest
+        # line is complete.
+        while position > 0 and num_newlines <= num_lines:
+            read_size = min(block_size, position)
+            position -= read_size
+            logs_file.seek(position)
+            block = logs_file.read(read_size)
+            blocks.append(block)
+            num_newlines += block.count(b'\n')
+
+    text = b''.join(reversed(blocks)).decode('utf-8', errors='replace')
+    return text.splitlines()[-num_lines:]
+
+
+def render_log_lines(lines: List[str]) -> ImageType:
+    """Returns a PIL Image of the debug screen showing the given log lines.
+
+    The most recent (last) lines are shown first, in a readable font style and
+    size.
     """
     # Create a blank white image
     debug_screen_img = Image.new('RGB', (600, 448), 'white')
     draw = ImageDraw.Draw(debug_screen_img)
-    font = ImageFont.truetype(FONT_PATH, FONT_SIZE)
+    font = load_font(FONT_PATH, FONT_SIZE)
 
-    # Extract last MAX_LINES lines from the log file and reverse.
-    lines = []
-    with open(logs_path, "r", encoding='utf-8') as logs_file:
-        lines = logs_file.read().splitlines()
     # Get only the last MAX_LINES items and reverse the list so most recent logs
     # are first.
     lines = lines[-MAX_LINES:]
@@ -55,3 +91,39 @@ def transform_logs_to_image(logs_path: str) -> ImageType:
         line_index += 1
 
     return debug_screen_img
+
+
+def render_if_changed(source_state, get_lines) -> ImageType:
+    """Returns the debug screen for the log lines given by `get_lines`.
+
+    `source_state` identifies the state of the logs. If it's unchanged since
+    the last call, no new lines have been logged and the previous image is
+    reused rather than re-rendered.
+    """
+    global _last_render
+    with _last_render_lock:
+        if _last_render is not None and _last_render[0] == source_state:
+            return _last_render[1].copy()
+
+    debug_screen_img = render_log_lines(get_lines())
+    with _last_render_lock:
+        _last_render = (source_state, debug_screen_img)
+    return debug_screen_img.copy()
+
+
+def transform_logs_to_image(logs_path: str) -> ImageType:
+    """Returns a PIL Image of the debug screen for the given log file.
+
+    Writes the most recent few logs to an in-memory PIL image with readable font
+    style and size.
+    """
+    logs_stat = os.stat(logs_path)
+    return render_if_changed(
+        (logs_path, logs_stat.st_size, logs_stat.st_mtime_ns),
+        lambda: read_last_lines(logs_path, MAX_LINES))
+
+
+def transform_ring_buffer_to_image(ring_buffer_handler: RingBufferHandler) -> ImageType:
+    """Returns a PIL Image of the debug screen for the given in-memory logs."""
+    num_records, lines = ring_buffer_handler.get_lines()
+    return render_if_changed((id(ring_buffer_handler), num_records), lambda: lines)
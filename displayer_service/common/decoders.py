@@ -0,0 +1,179 @@
+"""Provides the registry of image decoders, and decode cost budgets.
+
+Opening an image only reads its header, which is enough to tell how costly
+decoding it will be. Images whose cheapest decode would exceed the `decode`
+budgets in the display config are rejected up front, rather than stalling
+(or getting the service OOM-killed on) a Pi Zero.
+"""
+import math
+
+from typing import Dict
+from PIL import Image, UnidentifiedImageError
+
+try:
+    import pillow_heif
+except ImportError:
+    # HEIC/HEIF images need the optional pillow-heif package.
+    pillow_heif = None
+
+
+# The coarsest scale that draft decoding (`Image.draft`) can decode at.
+MAX_DRAFT_SCALE = 8
+# Brands in the 'ftyp' box of HEIF files, to explain why they can't be opened
+# without pillow-heif.
+HEIF_BRANDS = (b'heic', b'heix', b'hevc', b'hevx', b'heim', b'heis', b'mif1', b'msf1')
+# Bytes per pixel of decoded images, by mode. Other modes take 4 bytes.
+MODE_BYTES_PER_PIXEL = {
+    '1': 1, 'L': 1, 'P': 1, 'LA': 2, 'PA': 2, 'I;16': 2, 'RGB': 3, 'YCbCr': 3,
+}
+
+
+class ImageRejected(Exception):
+    """Raised when an image can't be decoded, or would cost too much to."""
+
+
+class Decoder:
+    """How images of one format are decoded, and roughly what it costs.
+
+    `secs_per_megapixel` is the decode time on a Pi Zero. Decoders that
+    `can_draft` decode straight to a 1/2, 1/4 or 1/8 scale (for JPEGs, by DCT
+    scaling), which skips most of the work for large images. Others always
+    decode every pixel.
+    """
+
+    def __init__(self, image_format, secs_per_megapixel, can_draft=False):
+        self.image_format = image_format
+        self.secs_per_megapixel = secs_per_megapixel
+        self.can_draft = can_draft
+
+
+# Image format (as in `Image.format`) -> its decoder.
+DECODERS: Dict[str, Decoder] = {}
+
+
+def register_decoder(decoder: Decoder) -> None:
+    DECODERS[decoder.image_format] = decoder
+
+
+# Load every PIL plugin up front. `Image.open` only loads the common ones when
+# it's limited to particular formats.
+Image.init()
+register_decoder(Decoder('JPEG', 0.15, can_draft=True))
+# Multi-picture JPEGs, as written by many phone cameras.
+register_decoder(Decoder('MPO', 0.15, can_draft=True))
+register_decoder(Decoder('PNG', 0.4))
+register_decoder(Decoder('WEBP', 0.5))
+register_decoder(Decoder('GIF', 0.3))
+register_decoder(Decoder('BMP', 0.1))
+register_decoder(Decoder('TIFF', 0.4))
+if pillow_heif is not None:
+    pillow_heif.register_heif_opener()
+    register_decoder(Decoder('HEIF', 1.5))
+
+
+def can_draft(image_format) -> bool:
+    """Returns whether images of the given format can be draft decoded."""
+    decoder = DECODERS.get(image_format)
+    return decoder is not None and decoder.can_draft
+
+
+def is_heif_file(image_file) -> bool:
+    """Returns whether the given image file or path looks like a HEIF file."""
+    if isinstance(image_file, (str, bytes)) or hasattr(image_file, '__fspath__'):
+        with open(image_file, 'rb') as file:
+            header = file.read(12)
+    else:
+        position = image_file.tell()
+        image_file.seek(0)
+        header = image_file.read(12)
+        image_file.seek(position)
+    return header[4:8] == b'ftyp' and header[8:12] in HEIF_BRANDS
+
+
+def open_image(image_file) -> Image.Image:
+    """Lazily opens the given image file or path with a registered decoder.
+
+    Raises `ImageRejected` if the image isn't of a format with a decoder, or
+    is too large for PIL to open at all.
+    """
+    try:
+        # Some formats, like MPO, are opened by another format's plugin.
+        return Image.open(image_file, formats=[
+            image_format for image_format in DECODERS if image_format in Image.OPEN])
+    except Image.DecompressionBombError as e:
+        raise ImageRejected(str(e)) from e
+    except UnidentifiedImageError as e:
+        if 'HEIF' not in DECODERS and is_heif_file(image_file):
+            raise ImageRejected(
+                "HEIC/HEIF images need the pillow-heif package to be installed.") from None
+        raise ImageRejected(f"The file isn't an image of a supported format: {e}") from e
+
+
+class ImageProbe:
+    """An image's format, size and mode, read from its header, and what
+    decoding it would cost."""
+
+    def __init__(self, image_format, size, mode):
+        self.image_format = image_format
+        self.size = tuple(size)
+        self.mode = mode
+
+    @classmethod
+    def from_image(cls, img: Image.Image):
+        """Probes a lazily opened image, without decoding it."""
+        return cls(img.format, img.size, img.mode)
+
+    @property
+    def decoder(self) -> Decoder:
+        decoder = DECODERS.get(self.image_format)
+        if decoder is None:
+            raise ImageRejected(f"There's no decoder for {self.image_format} images.")
+        return decoder
+
+    @property
+    def bytes_per_pixel(self) -> int:
+        """Bytes per pixel while decoding, including the copy made when
+        converting to RGB for display."""
+        if self.decoder.can_draft:
+            # Drafts are decoded straight to RGB (or greyscale).
+            return MODE_BYTES_PER_PIXEL.get(self.mode, 4)
+        conversion_bytes = 0 if self.mode == 'RGB' else MODE_BYTES_PER_PIXEL['RGB']
+        return MODE_BYTES_PER_PIXEL.get(self.mode, 4) + conversion_bytes
+
+    @property
+    def min_decode_pixels(self) -> int:
+        """The number of pixels decoded by the cheapest decode of the image."""
+        width, height = self.size
+        if not self.decoder.can_draft:
+            return width * height
+        return math.ceil(width / MAX_DRAFT_SCALE) * math.ceil(height / MAX_DRAFT_SCALE)
+
+    def get_max_decode_pixels(self, decode_config) -> int:
+        """Returns the most pixels the image can be decoded at within the
+        pixel, memory and time budgets of the given `decode` config."""
+        return int(min(
+            decode_config['max_pixels'],
+            decode_config['max_memory_bytes'] / self.bytes_per_pixel,
+            decode_config['max_secs'] / self.decoder.secs_per_megapixel * 1e6))
+
+
+def check_decode_budget(probe: ImageProbe, decode_config) -> int:
+    """Returns the most pixels the probed image can be decoded at.
+
+    Raises `ImageRejected` if even its cheapest decode is over budget.
+    """
+    max_decode_pixels = probe.get_max_decode_pixels(decode_config)
+    if probe.min_decode_pixels > max_decode_pixels:
+        width, height = probe.size
+        raise ImageRejected(
+            f"Decoding the {width}x{height} {probe.image_format} image would exceed "
+            f"the decode budget.")
+    return max_decode_pixels
+
+
+def plan_decode(image_file, decode_config) -> int:
+    """Probes the given image file or path from its header alone, and checks
+    it against the decode budget, as in `check_decode_budget`."""
+    with open_image(image_file) as img:
+        probe = ImageProbe.from_image(img)
+    return check_decode_budget(probe, decode_config)
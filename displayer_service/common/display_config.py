@@ -1,27 +1,338 @@
+import os
 import sys
 import json
 from logging import Logger
+from typing import Callable, List, Optional, Set, Tuple
+
+from common.file_watcher import FileWatcher
 
 DEFAULT_DISPLAY_CONFIG = {
     "display": {
-        # TODO: Validate: this should always be >0
         "refresh_period_secs": 86400,
-        "allowed_image_extensions": [".jpg", ".jpeg", ".png"],
-        # TODO: Required fields like this should be validated to be set to an existent directory on program startup and log on failure.
-        "image_source_dir": "~/Pictures"
+        # HEIC/HEIF images need the optional pillow-heif package. Without it,
+        # they're rejected (see the "decode" section).
+        "allowed_image_extensions": [".jpg", ".jpeg", ".png", ".heic", ".heif"],
+        # Must be set, or the service exits on startup. It's only warned
+        # about if it doesn't exist, since the rclone mount may come up after
+        # the service does.
+        "image_source_dir": "~/Pictures",
+        # Whether to skip refreshing the panel when the new frame is identical
+        # to the one already on it.
+        "skip_identical_refreshes": True
+    },
+    "hardware": {
+        # "inky" for the real display and buttons, or "simulated" to run
+        # without a Pi. The simulated display writes each frame to a PNG.
+        "backend": "inky",
+        "simulated_resolution": [600, 448],
+        "simulated_output_dir": "./simulated-display",
+        # Models how long the real panel takes to refresh.
+        "simulated_refresh_secs": 30
+    },
+    "image_index": {
+        # On-disk index of the images in `image_source_dir`, so that picking an
+        # image doesn't require listing the (slow, rclone-mounted) directory.
+        "index_file_path": "./.ink-memories-index.json",
+        # How often the index is incrementally re-synced with the image source.
+        "refresh_period_secs": 900,
+        # Gives up on listing the image source if it takes longer than this,
+        # e.g. because the mount is hung.
+        "scan_timeout_secs": 300
+    },
+    "metadata": {
+        # SQLite store of each image's EXIF date, orientation, dimensions,
+        # format and perceptual hash, filled in from image headers by a
+        # background crawler, and from decoded frames as they're rendered.
+        "db_path": "./.ink-memories-metadata.sqlite3",
+        # Niceness of the crawler thread, from 0 to 19 (lowest priority).
+        "crawler_niceness": 19,
+        # How often the crawler checks the image index for new images.
+        "crawl_poll_secs": 60
+    },
+    "schedule": {
+        # How the next image is chosen: "shuffle" shows every image once, in
+        # a random order, before repeating any. "weighted" draws images at
+        # random, favouring them according to `weighting_rules`.
+        "mode": "shuffle",
+        # Each rule multiplies the weight of the images it matches by
+        # `weight`. Rules are "recent" (added in the last `days` days),
+        # "on_this_day" (from this day in earlier years, give or take
+        # `window_days`) and "favourites" (by `file_names`).
+        "weighting_rules": [
+            {"rule": "recent", "weight": 3.0, "days": 30},
+            {"rule": "on_this_day", "weight": 5.0, "window_days": 0}
+        ]
+    },
+    "near_duplicates": {
+        # Whether the schedule skips images that look nearly identical to an
+        # image shown recently, e.g. burst shots.
+        "enabled": True,
+        # How many bits (out of 64) the perceptual hashes of two images can
+        # differ by for them to count as near-duplicates.
+        "max_distance": 6,
+        # An image is skipped if a near-duplicate of it was picked within this
+        # many picks.
+        "suppression_window": 50
+    },
+    "retrieval": {
+        # Images up to this size are read straight into memory. Larger images
+        # are copied to local disk instead.
+        "in_memory_max_bytes": 32 * 1024 * 1024,
+        "read_chunk_size_bytes": 1024 * 1024,
+        # Where the local copies of larger images go. Removed on shutdown.
+        "local_copy_dir": "./tmp-images",
+        # Gives up on fetching an image if it takes longer than this. While
+        # the image source is unavailable, frames are drawn from the frame
+        # cache instead.
+        "source_timeout_secs": 60
+    },
+    "render": {
+        # Whether to burn the date the photo was taken into the frame.
+        "burn_date": True,
+        # How much to favour the panel's measured colours over pure colours
+        # when palettizing, from 0.0 to 1.0.
+        "saturation": 0.5,
+        # How frames are dithered to the display's 7 colours: "floyd_steinberg"
+        # (Pillow, as the Inky library does), or NumPy's "bayer" (ordered) or
+        # "row_diffusion" (error diffusion, vectorized over rows).
+        "dither": "floyd_steinberg",
+        # How frames are cropped to the display's aspect ratio: "center", or
+        # "content_aware" to keep the most detailed part of the photo, e.g.
+        # people's faces in portrait shots on a landscape panel. Content-aware
+        # crop boxes are kept in the metadata store, so each photo's is only
+        # worked out once.
+        "crop_mode": "content_aware",
+        # Where image processing runs: "in_process", or "process_pool" to
+        # spread it across the cores of multi-core Pi models.
+        "backend": "in_process",
+        "num_processes": 3
+    },
+    "decode": {
+        # Budgets for decoding a single image. Opening an image only reads
+        # its header, which tells how costly decoding it will be. JPEGs over
+        # budget are decoded at a coarser scale, at the cost of detail. Other
+        # images, or JPEGs over budget even at 1/8 scale, are rejected and
+        # left out of the image index until they change, rather than stalling
+        # the Pi or getting the service OOM-killed.
+        "max_pixels": 50 * 1000 * 1000,
+        "max_memory_bytes": 192 * 1024 * 1024,
+        # Decode time is estimated from the image's size and format.
+        "max_secs": 30
+    },
+    "frame_cache": {
+        # Disk cache of display-ready frames, keyed by source image content.
+        "cache_dir": "./.frame-cache",
+        "max_size_bytes": 100 * 1024 * 1024
+    },
+    "state": {
+        # Where the last rendered frame and the frame buffer's manifest are
+        # persisted, so that startup doesn't wait on the image source.
+        "state_dir": "./.ink-memories-state",
+        # Whether to re-show the last rendered frame on startup. If so, the
+        # first automatic refresh waits for a full refresh period.
+        "show_last_frame_on_startup": True
+    },
+    "prefetch": {
+        # Number of worker threads retrieving and rendering frames.
+        "num_workers": 2,
+        # Memory budget for the buffer of rendered frames. A 600x448 frame
+        # takes roughly 270 KB. The buffer is refilled up to the budget
+        # whenever it drains to the low watermark.
+        "max_buffer_bytes": 3 * 1024 * 1024,
+        "low_watermark_bytes": 1536 * 1024,
+        # Failed retrievals are retried with exponential backoff.
+        "initial_backoff_secs": 5,
+        "max_backoff_secs": 300
     },
+    "logging": {
+        "log_file_path": "./.ink-memories-log",
+        # The log file is rotated once it reaches `max_bytes`, keeping
+        # `backup_count` old logs.
+        "max_bytes": 1024 * 1024,
+        "backup_count": 3,
+        # Number of recent log lines kept in memory for the debug screen.
+        "ring_buffer_size": 200
+    },
+    "render_server": {
+        # Where `serve_frames.py` listens for displays asking for frames.
+        "bind_address": "0.0.0.0",
+        "port": 8765,
+        # Frames are rendered for up to this many different panel resolutions.
+        "max_resolutions": 4,
+        # How long a request waits for a frame to be rendered before giving up.
+        "frame_timeout_secs": 60
+    },
+    "render_client": {
+        # Whether to fetch rendered frames from a render server, rather than
+        # retrieving and rendering images on this device.
+        "enabled": False,
+        "server_url": "http://localhost:8765",
+        # How often to check the server for a new frame. The server moves on
+        # to a new frame once per its own refresh period.
+        "poll_secs": 300,
+        "timeout_secs": 30
+    },
+    "config_reload": {
+        # Whether to watch the config file and apply changes to it without a
+        # restart. Changes to the settings in `RESTART_REQUIRED_KEYS` still
+        # need a restart.
+        "enabled": True,
+        # How often to check the config file, if inotify isn't available.
+        "poll_secs": 5
+    },
+    "metrics": {
+        # Whether to periodically export the timings of each pipeline stage
+        # and gauges like the frame buffer's size.
+        "export_enabled": True,
+        "export_period_secs": 60,
+        # Prometheus-format textfile, e.g. for node_exporter's textfile
+        # collector.
+        "prometheus_textfile_path": "./.ink-memories-metrics.prom",
+        # JSONL trace of every timing span. Rolled over to `<path>.1` once it
+        # reaches `trace_max_bytes`.
+        "trace_file_path": "./.ink-memories-trace.jsonl",
+        "trace_max_bytes": 1024 * 1024
+    },
+}
+
+
+# (Section, key) pairs that are only read on startup. A key of None stands
+# for the whole section.
+RESTART_REQUIRED_KEYS = {
+    ('hardware', None),
+    ('logging', None),
+    ('config_reload', None),
+    ('state', 'state_dir'),
+    ('image_index', 'index_file_path'),
+    ('metadata', 'db_path'),
+    ('retrieval', 'local_copy_dir'),
+    ('metadata', 'crawler_niceness'),
+    ('frame_cache', 'cache_dir'),
+    ('prefetch', 'num_workers'),
+    ('render', 'backend'),
+    ('render', 'num_processes'),
+    ('metrics', 'export_enabled'),
+    ('render_server', 'bind_address'),
+    ('render_server', 'port'),
+    ('render_client', 'enabled'),
 }
 
+# A change to a config, as a set of changed (section, key) pairs.
+ConfigChanges = Set[Tuple[str, Optional[str]]]
+
+
+def merge_config(base_config: dict, overrides: dict) -> dict:
+    """Returns a new config with `overrides` merged on top of `base_config`.
+
+    Sections (top-level dicts) are merged key-by-key so that a config file only
+    needs to specify the fields it wants to change.
+    """
+    merged_config = {}
+    for section, values in base_config.items():
+        merged_config[section] = dict(values) if isinstance(
+            values, dict) else values
+    for section, values in overrides.items():
+        if isinstance(values, dict) and isinstance(merged_config.get(section), dict):
+            merged_config[section].update(values)
+        else:
+            merged_config[section] = values
+    return merged_config
+
+
+def _is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def validate_config(config: dict) -> List[str]:
+    """Returns a description of each problem with the given config.
+
+    Every setting must have the same type as its default, except that
+    integers and floats are interchangeable.
+    """
+    errors = []
+    for section, default_values in DEFAULT_DISPLAY_CONFIG.items():
+        values = config.get(section)
+        if not isinstance(values, dict):
+            errors.append(f"'{section}' must be an object.")
+            continue
+        for key, default_value in default_values.items():
+            value = values.get(key)
+            if _is_number(default_value):
+                is_valid = _is_number(value)
+            else:
+                is_valid = isinstance(value, type(default_value))
+            if not is_valid:
+                errors.append(f"'{section}.{key}' must be of type "
+                              f"{type(default_value).__name__}, not {type(value).__name__}.")
+    if errors:
+        return errors
+
+    if config['display']['refresh_period_secs'] <= 0:
+        errors.append("'display.refresh_period_secs' must be positive.")
+    if not all(isinstance(extension, str) and extension.startswith('.')
+               for extension in config['display']['allowed_image_extensions']):
+        errors.append("'display.allowed_image_extensions' must be a list of "
+                      "extensions, like \".jpg\".")
+    if not config['display']['image_source_dir'].strip():
+        errors.append("'display.image_source_dir' must be set.")
+    if config['config_reload']['poll_secs'] <= 0:
+        errors.append("'config_reload.poll_secs' must be positive.")
+    for key in ('max_pixels', 'max_memory_bytes', 'max_secs'):
+        if config['decode'][key] <= 0:
+            errors.append(f"'decode.{key}' must be positive.")
+    return errors
+
+
+def get_config_changes(old_config: dict, new_config: dict) -> ConfigChanges:
+    """Returns the (section, key) pairs whose values differ between the two
+    configs. Changed top-level values that aren't sections have a key of None."""
+    changes = set()
+    for section in set(old_config) | set(new_config):
+        old_values = old_config.get(section)
+        new_values = new_config.get(section)
+        if isinstance(old_values, dict) and isinstance(new_values, dict):
+            changes.update((section, key) for key in set(old_values) | set(new_values)
+                           if old_values.get(key) != new_values.get(key))
+        elif old_values != new_values:
+            changes.add((section, None))
+    return changes
+
+
+def format_config_key(section, key) -> str:
+    return section if key is None else f"{section}.{key}"
+
+
+def read_config_file(config_file_path) -> dict:
+    """Returns the contents of the given config file.
+
+    Raises `OSError` if it can't be read, or `ValueError` if it isn't a JSON
+    object.
+    """
+    with open(config_file_path, 'r') as file:
+        display_config_dict = json.load(file)
+    if not isinstance(display_config_dict, dict):
+        raise ValueError("The config must be a JSON object.")
+    return display_config_dict
+
 
 class DisplayConfig():
-    """TODO"""
-    # TODO: It would be good to enforce typing against this config to trust it's always well-formed.
-    # TODO: It would be good to add some validation to ensure that required fields are provided.
-    # TODO: Make the config take on default values. Could do a dict merge with the dict read from the JSON.
+    """The display's config, read from a JSON config file on top of defaults.
+
+    The config file can be watched (see `watch_in_background`), in which case
+    valid changes to it are swapped in as a whole, and listeners are told
+    which settings changed so they can apply them. Components should read
+    settings through `config` each time they're needed, rather than keeping
+    their own copies, so that they pick up changes.
+    """
     config = DEFAULT_DISPLAY_CONFIG
 
     def __init__(self, logger: Logger, config_file_path=None):
         self.logger = logger
+        self.config = merge_config(DEFAULT_DISPLAY_CONFIG, {})
+        self.config_file_path = config_file_path
+        # Called with the `ConfigChanges` whenever the config is reloaded.
+        self.listeners: List[Callable[[ConfigChanges], None]] = []
+        self.file_watcher: Optional[FileWatcher] = None
 
         # If a config file is specified, override defaults.
         if config_file_path:
@@ -31,13 +342,10 @@ class DisplayConfig():
 
     def extract_config_from_file(self, config_file_path):
         try:
-            with open(config_file_path, 'r') as file:
-                display_config_dict = json.load(file)
+            display_config_dict = read_config_file(config_file_path)
             self.logger.info("Successfully loaded display_config.json.")
             self.logger.info(json.dumps(display_config_dict, indent=4))
-            merged_config = self.config.copy()
-            merged_config.update(display_config_dict)
-            self.config = merged_config
+            self.config = merge_config(self.config, display_config_dict)
         except FileNotFoundError:
             self.logger.critical(
                 f"Error: File '{config_file_path}' not found.")
@@ -49,3 +357,65 @@ class DisplayConfig():
         except Exception as e:
             self.logger.critical(f"An unexpected error occurred: {e}")
             sys.exit(1)
+        for error in validate_config(self.config):
+            self.logger.error(f"Invalid display config: {error}")
+        image_source_dir = self.config['display']['image_source_dir']
+        if not isinstance(image_source_dir, str) or not image_source_dir.strip():
+            self.logger.critical("Error: 'display.image_source_dir' must be set.")
+            sys.exit(1)
+        image_source_dir = os.path.expanduser(image_source_dir)
+        if not os.path.isdir(image_source_dir):
+            self.logger.warning(
+                f"The image source directory '{image_source_dir}' doesn't exist (yet).")
+
+    def add_listener(self, listener: Callable[[ConfigChanges], None]) -> None:
+        """Registers a callback for whenever the config is reloaded."""
+        self.listeners.append(listener)
+
+    def reload(self) -> bool:
+        """Re-reads the config file, and swaps in the new config if it's
+        valid. Returns whether it was swapped in.
+
+        An invalid config is logged and ignored, leaving the current config in
+        place.
+        """
+        try:
+            new_config = merge_config(DEFAULT_DISPLAY_CONFIG,
+                                      read_config_file(self.config_file_path))
+        except (OSError, ValueError) as e:
+            self.logger.error(f"Failed to reload '{self.config_file_path}': {e}")
+            return False
+        errors = validate_config(new_config)
+        if errors:
+            for error in errors:
+                self.logger.error(f"Ignoring invalid display config: {error}")
+            return False
+
+        # Swapped in as a whole, so readers never see a half-applied config.
+        old_config, self.config = self.config, new_config
+        changes = get_config_changes(old_config, new_config)
+        if not changes:
+            return True
+        self.logger.info("Reloaded the display config. Changed: %s.", ", ".join(
+            sorted(format_config_key(section, key) for section, key in changes)))
+        for section, key in changes:
+            if (section, None) in RESTART_REQUIRED_KEYS or (section, key) in RESTART_REQUIRED_KEYS:
+                self.logger.warning(
+                    f"'{format_config_key(section, key)}' only takes effect after a restart.")
+        for listener in list(self.listeners):
+            try:
+                listener(changes)
+            except Exception as e:
+                self.logger.error(f"Failed to apply the display config changes: {e}")
+        return True
+
+    def watch_in_background(self) -> None:
+        """Reloads the config whenever the config file changes."""
+        self.file_watcher = FileWatcher(self.logger, self.config_file_path,
+                                        self.config['config_reload']['poll_secs'])
+        self.file_watcher.watch(self.reload)
+
+    def stop_watching(self) -> None:
+        """Stops `watch_in_background`, within the poll period."""
+        if self.file_watcher is not None:
+            self.file_watcher.stop()
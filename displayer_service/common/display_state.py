@@ -0,0 +1,130 @@
+"""Provides persistence of the display's state across restarts."""
+import hashlib
+import json
+import os
+
+from logging import Logger
+from typing import List, Optional
+from pathlib import Path
+from PIL import Image
+from PIL.Image import Image as ImageType
+
+from common.display_config import DisplayConfig
+
+
+LAST_FRAME_FILE_NAME = "last-frame.png"
+BUFFER_MANIFEST_FILE_NAME = "buffer-manifest.json"
+SHOWN_FINGERPRINT_FILE_NAME = "shown-fingerprint"
+
+
+def get_frame_fingerprint(frame: ImageType) -> str:
+    """Returns a fingerprint of a palettized frame's pixels.
+
+    The display shows a "P" mode frame's colour indices as they are, so two
+    frames with the same size and pixels look identical on the panel.
+    """
+    fingerprint = hashlib.blake2b(digest_size=16)
+    fingerprint.update(f"{frame.mode}:{frame.width}x{frame.height}:".encode())
+    fingerprint.update(frame.tobytes())
+    return fingerprint.hexdigest()
+
+
+class DisplayState:
+    """Persists the last rendered frame, the fingerprint of the frame on the
+    panel and the frame buffer's manifest.
+
+    This lets the displayer service pick up where it left off after a reboot
+    without waiting on the image source.
+    """
+    logger: Logger
+    display_config: DisplayConfig
+
+    def __init__(self, logger, display_config):
+        self.logger = logger
+        self.display_config = display_config
+
+        Path(self.state_dir).mkdir(parents=True, exist_ok=True)
+
+    @property
+    def state_dir(self) -> str:
+        return self.display_config.config['state']['state_dir']
+
+    @property
+    def last_frame_path(self) -> str:
+        return os.path.join(self.state_dir, LAST_FRAME_FILE_NAME)
+
+    @property
+    def buffer_manifest_path(self) -> str:
+        return os.path.join(self.state_dir, BUFFER_MANIFEST_FILE_NAME)
+
+    @property
+    def shown_fingerprint_path(self) -> str:
+        return os.path.join(self.state_dir, SHOWN_FINGERPRINT_FILE_NAME)
+
+    def save_last_frame(self, frame: ImageType) -> None:
+        """Persists the frame that was last rendered to the display."""
+        tmp_frame_path = f"{self.last_frame_path}.tmp"
+        try:
+            frame.save(tmp_frame_path, format='PNG', compress_level=1)
+            os.replace(tmp_frame_path, self.last_frame_path)
+        except OSError as e:
+            self.logger.error(f"Failed to save the last frame: {e}")
+
+    def load_last_frame(self) -> Optional[ImageType]:
+        """Returns the frame that was last rendered, or None if there isn't one."""
+        try:
+            frame = Image.open(self.last_frame_path)
+            frame.load()
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            self.logger.error(f"Failed to load the last frame: {e}")
+            return None
+        return frame
+
+    def save_shown_fingerprint(self, fingerprint: str) -> None:
+        """Persists the fingerprint of the frame that's on the panel.
+
+        The e-ink panel keeps showing its last frame while powered off, so
+        this stays accurate across restarts.
+        """
+        tmp_fingerprint_path = f"{self.shown_fingerprint_path}.tmp"
+        try:
+            with open(tmp_fingerprint_path, 'w', encoding='utf-8') as fingerprint_file:
+                fingerprint_file.write(fingerprint)
+            os.replace(tmp_fingerprint_path, self.shown_fingerprint_path)
+        except OSError as e:
+            self.logger.error(f"Failed to save the shown frame's fingerprint: {e}")
+
+    def load_shown_fingerprint(self) -> Optional[str]:
+        """Returns the fingerprint of the frame on the panel, or None if it's
+        unknown."""
+        try:
+            with open(self.shown_fingerprint_path, 'r', encoding='utf-8') as fingerprint_file:
+                return fingerprint_file.read().strip() or None
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            self.logger.error(f"Failed to load the shown frame's fingerprint: {e}")
+            return None
+
+    def save_buffer_manifest(self, manifest: List[dict]) -> None:
+        """Persists the list of frames in the frame buffer."""
+        tmp_manifest_path = f"{self.buffer_manifest_path}.tmp"
+        try:
+            with open(tmp_manifest_path, 'w', encoding='utf-8') as manifest_file:
+                json.dump(manifest, manifest_file)
+            os.replace(tmp_manifest_path, self.buffer_manifest_path)
+        except OSError as e:
+            self.logger.error(f"Failed to save the buffer manifest: {e}")
+
+    def load_buffer_manifest(self) -> List[dict]:
+        """Returns the persisted list of frames in the frame buffer."""
+        try:
+            with open(self.buffer_manifest_path, 'r', encoding='utf-8') as manifest_file:
+                return json.load(manifest_file)
+        except FileNotFoundError:
+            return []
+        except (OSError, json.JSONDecodeError) as e:
+            self.logger.error(f"Failed to load the buffer manifest: {e}")
+            return []
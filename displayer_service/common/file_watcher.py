@@ -0,0 +1,134 @@
+"""Provides watching of a file for changes, with inotify where available."""
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import threading
+
+from logging import Logger
+from typing import Callable, Optional
+
+
+# inotify(7) constants, from <sys/inotify.h>.
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+# Editors and `os.replace` swap in a new file rather than writing in place,
+# so the file's directory is watched rather than the file itself.
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+# struct inotify_event: wd, mask, cookie and len, followed by the name.
+INOTIFY_EVENT_HEADER = struct.Struct('iIII')
+INOTIFY_READ_BYTES = 4096
+# How long to wait for further events after the first, so that a file that's
+# written in several steps is only reported once.
+SETTLE_SECS = 0.1
+
+
+def _load_libc():
+    """Returns libc if it has inotify, or None."""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    except OSError:
+        return None
+    if not hasattr(libc, 'inotify_init1') or not hasattr(libc, 'inotify_add_watch'):
+        return None
+    return libc
+
+
+class FileWatcher:
+    """Calls back whenever a file's contents change.
+
+    Uses inotify on Linux, falling back to polling the file's size, mtime and
+    inode every `poll_secs` elsewhere, or if inotify can't be set up. Even
+    with inotify, the file is re-checked every `poll_secs`, in case an event
+    is missed.
+    """
+    logger: Logger
+
+    def __init__(self, logger, file_path, poll_secs):
+        self.logger = logger
+        self.file_path = os.path.abspath(file_path)
+        self.poll_secs = poll_secs
+        self.stop_event = threading.Event()
+
+    def get_signature(self) -> Optional[tuple]:
+        """Returns what identifies the current version of the file, or None if
+        it doesn't exist."""
+        try:
+            stat_result = os.stat(self.file_path)
+        except OSError:
+            return None
+        return (stat_result.st_ino, stat_result.st_size, stat_result.st_mtime_ns)
+
+    def open_inotify(self) -> Optional[int]:
+        """Returns an inotify file descriptor watching the file's directory,
+        or None if inotify isn't available."""
+        libc = _load_libc()
+        if libc is None:
+            self.logger.info("inotify isn't available. Polling %s instead.", self.file_path)
+            return None
+        inotify_fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if inotify_fd < 0:
+            self.logger.error(
+                f"Failed to set up inotify: {os.strerror(ctypes.get_errno())}. Polling instead.")
+            return None
+        watch_descriptor = libc.inotify_add_watch(
+            inotify_fd, os.fsencode(os.path.dirname(self.file_path)), WATCH_MASK)
+        if watch_descriptor < 0:
+            self.logger.error(
+                f"Failed to watch {self.file_path}: {os.strerror(ctypes.get_errno())}. Polling instead.")
+            os.close(inotify_fd)
+            return None
+        return inotify_fd
+
+    def wait_for_event(self, inotify_fd, timeout_secs) -> bool:
+        """Waits up to `timeout_secs` for an event about the file. Returns
+        whether there was one."""
+        file_name = os.fsencode(os.path.basename(self.file_path))
+        is_file_event = False
+        while True:
+            readable_fds, _, _ = select.select([inotify_fd], [], [], timeout_secs)
+            if not readable_fds:
+                return is_file_event
+            try:
+                event_bytes = os.read(inotify_fd, INOTIFY_READ_BYTES)
+            except BlockingIOError:
+                continue
+            offset = 0
+            while offset + INOTIFY_EVENT_HEADER.size <= len(event_bytes):
+                _, _, _, name_length = INOTIFY_EVENT_HEADER.unpack_from(event_bytes, offset)
+                name_start = offset + INOTIFY_EVENT_HEADER.size
+                name = event_bytes[name_start:name_start + name_length].rstrip(b'\0')
+                is_file_event = is_file_event or name == file_name
+                offset = name_start + name_length
+            if is_file_event:
+                # Swallow the rest of a burst of events.
+                timeout_secs = SETTLE_SECS
+
+    def watch(self, on_change: Callable[[], None]) -> None:
+        """Calls `on_change` whenever the file changes, until `stop` is
+        called."""
+        inotify_fd = self.open_inotify()
+        signature = self.get_signature()
+        try:
+            while not self.stop_event.is_set():
+                if inotify_fd is None:
+                    self.stop_event.wait(self.poll_secs)
+                else:
+                    self.wait_for_event(inotify_fd, self.poll_secs)
+                new_signature = self.get_signature()
+                if new_signature is None or new_signature == signature:
+                    continue
+                signature = new_signature
+                if not self.stop_event.is_set():
+                    on_change()
+        finally:
+            if inotify_fd is not None:
+                os.close(inotify_fd)
+
+    def stop(self) -> None:
+        """Stops watching the file, within `poll_secs`."""
+        self.stop_event.set()
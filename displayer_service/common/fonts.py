@@ -0,0 +1,14 @@
+"""Provides a process-wide cache of loaded fonts."""
+import functools
+
+from PIL import ImageFont
+from PIL.ImageFont import FreeTypeFont
+
+
+@functools.lru_cache(maxsize=None)
+def load_font(font_path, font_size) -> FreeTypeFont:
+    """Returns the given TrueType font, loading it only on first use.
+
+    Fonts are shared, so callers must not modify the returned font.
+    """
+    return ImageFont.truetype(font_path, font_size)
@@ -0,0 +1,197 @@
+"""Provides a disk cache of display-ready rendered frames."""
+import hashlib
+import json
+import os
+import random
+import threading
+
+from collections import OrderedDict
+from logging import Logger
+from typing import List, Optional
+from pathlib import Path
+from PIL import Image
+from PIL.Image import Image as ImageType
+from PIL.PngImagePlugin import PngInfo
+
+from common.display_config import DisplayConfig
+
+
+FRAME_FILE_EXTENSION = ".png"
+# Frame metadata (from `Image.info`) that is stored alongside cached frames.
+FRAME_METADATA_KEYS = ('exif_date', 'source_path')
+DIGEST_CHUNK_SIZE = 1024 * 1024
+
+
+def digest_image_file(image_file) -> str:
+    """Returns the SHA-256 hex digest of the given image's file contents.
+
+    `image_file` may be a path or a binary file object.
+    """
+    digest = hashlib.sha256()
+    if isinstance(image_file, (str, os.PathLike)):
+        with open(image_file, 'rb') as file:
+            for chunk in iter(lambda: file.read(DIGEST_CHUNK_SIZE), b''):
+                digest.update(chunk)
+    else:
+        position = image_file.tell()
+        image_file.seek(0)
+        for chunk in iter(lambda: image_file.read(DIGEST_CHUNK_SIZE), b''):
+            digest.update(chunk)
+        image_file.seek(position)
+    return digest.hexdigest()
+
+
+def make_frame_key(source_digest, resolution, render_options) -> str:
+    """Returns the cache key of a frame rendered from the given source."""
+    width, height = resolution
+    options = json.dumps(render_options, sort_keys=True)
+    options_digest = hashlib.sha256(options.encode('utf-8')).hexdigest()[:16]
+    return f"{source_digest}-{width}x{height}-{options_digest}"
+
+
+class FrameCache:
+    """Size-budgeted, least-recently-used disk cache of rendered frames.
+
+    Frames are keyed by the source image's content digest, the display
+    resolution and the render options (see `make_frame_key`), so a frame is
+    reused whenever the same photo comes around again, regardless of where
+    it was fetched from.
+
+    Recency survives restarts because it is tracked through the mtime of each
+    frame file, which is bumped on every cache hit.
+    """
+    logger: Logger
+    display_config: DisplayConfig
+
+    def __init__(self, logger, display_config):
+        self.logger = logger
+        self.display_config = display_config
+
+        # Protects `frame_sizes` and `total_size_bytes`.
+        self.lock = threading.Lock()
+
+        # Frame key -> size of the frame file, from least to most recently
+        # used.
+        self.frame_sizes: OrderedDict = OrderedDict()
+        self.total_size_bytes = 0
+
+        # Cache hit statistics since startup.
+        self.num_hits = 0
+        self.num_misses = 0
+
+        Path(self.cache_dir).mkdir(parents=True, exist_ok=True)
+        self.load()
+
+    @property
+    def cache_dir(self) -> str:
+        return self.display_config.config['frame_cache']['cache_dir']
+
+    @property
+    def max_size_bytes(self) -> int:
+        return self.display_config.config['frame_cache']['max_size_bytes']
+
+    def frame_path(self, key) -> str:
+        return os.path.join(self.cache_dir, key + FRAME_FILE_EXTENSION)
+
+    def load(self) -> None:
+        """Populates the cache bookkeeping from the frames already on disk."""
+        frame_files = []
+        for dir_entry in os.scandir(self.cache_dir):
+            if not dir_entry.name.endswith(FRAME_FILE_EXTENSION):
+                continue
+            stat_result = dir_entry.stat()
+            frame_files.append((stat_result.st_mtime, dir_entry.name,
+                                stat_result.st_size))
+
+        with self.lock:
+            for _, file_name, size in sorted(frame_files):
+                key = file_name[:-len(FRAME_FILE_EXTENSION)]
+                self.frame_sizes[key] = size
+                self.total_size_bytes += size
+        self.logger.info("Frame cache holds %s frames (%s bytes).",
+                         len(self.frame_sizes), self.total_size_bytes)
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.frame_sizes
+
+    def sample_keys(self, num_frames, exclude=()) -> List[str]:
+        """Returns up to `num_frames` distinct random keys of cached frames,
+        other than those in `exclude`."""
+        with self.lock:
+            keys = [key for key in self.frame_sizes if key not in exclude]
+        return random.sample(keys, min(num_frames, len(keys)))
+
+    def get(self, key) -> Optional[ImageType]:
+        """Returns the cached frame for the given key, or None on a miss."""
+        with self.lock:
+            if key not in self.frame_sizes:
+                self.num_misses += 1
+                return None
+            self.frame_sizes.move_to_end(key)
+            self.num_hits += 1
+
+        frame_path = self.frame_path(key)
+        try:
+            frame = Image.open(frame_path)
+            frame.load()
+            os.utime(frame_path)
+        except OSError as e:
+            self.logger.error(f"Failed to read cached frame {key}: {e}")
+            self.discard(key)
+            return None
+        return frame
+
+    def put(self, key, frame: ImageType) -> None:
+        """Adds a frame to the cache, evicting old frames if over budget."""
+        frame_path = self.frame_path(key)
+        tmp_frame_path = f"{frame_path}.tmp"
+        try:
+            frame_metadata = PngInfo()
+            for metadata_key in FRAME_METADATA_KEYS:
+                if frame.info.get(metadata_key):
+                    frame_metadata.add_text(
+                        metadata_key, frame.info[metadata_key])
+            # Frames are small and rendered often, so favour speed over
+            # compression.
+            frame.save(tmp_frame_path, format='PNG', compress_level=1,
+                       pnginfo=frame_metadata)
+            os.replace(tmp_frame_path, frame_path)
+            size = os.path.getsize(frame_path)
+        except OSError as e:
+            self.logger.error(f"Failed to cache frame {key}: {e}")
+            return
+
+        with self.lock:
+            self.total_size_bytes += size - self.frame_sizes.get(key, 0)
+            self.frame_sizes[key] = size
+            self.frame_sizes.move_to_end(key)
+        self.evict()
+
+    def discard(self, key) -> None:
+        """Removes a frame from the cache."""
+        with self.lock:
+            size = self.frame_sizes.pop(key, None)
+            if size is None:
+                return
+            self.total_size_bytes -= size
+        try:
+            os.remove(self.frame_path(key))
+        except FileNotFoundError:
+            pass
+
+    def evict(self) -> None:
+        """Removes least recently used frames until the cache is in budget."""
+        while True:
+            with self.lock:
+                if self.total_size_bytes <= self.max_size_bytes or \
+                        len(self.frame_sizes) <= 1:
+                    return
+                key = next(iter(self.frame_sizes))
+            self.logger.info("Evicting frame %s from the frame cache.", key)
+            self.discard(key)
+
+    @property
+    def hit_rate(self) -> float:
+        num_lookups = self.num_hits + self.num_misses
+        return self.num_hits / num_lookups if num_lookups else 0.0
@@ -0,0 +1,145 @@
+"""Provides rendering of source images into display-ready frames."""
+from logging import Logger
+from typing import Optional
+from PIL.Image import Image as ImageType
+
+from common.decoders import plan_decode
+from common.display_config import DisplayConfig
+from common.frame_cache import FrameCache, digest_image_file, make_frame_key
+from common.image_processor import CONTENT_AWARE_CROP
+from common.metadata_store import MetadataStore
+from common.metrics import metrics
+from common.render_backends import create_render_backend
+
+
+def get_render_options(display_config: DisplayConfig) -> dict:
+    """Returns the options that affect what a rendered frame looks like."""
+    render_config = display_config.config['render']
+    return {
+        'burn_date': render_config['burn_date'],
+        'saturation': render_config['saturation'],
+        'dither': render_config['dither'],
+        'crop_mode': render_config['crop_mode'],
+    }
+
+
+class FrameRenderer:
+    """Renders source images into palettized frames for the display.
+
+    Rendered frames are cached by the source image's content, so displaying a
+    photo again skips the whole processing pipeline.
+    """
+    logger: Logger
+    display_config: DisplayConfig
+    frame_cache: FrameCache
+    metadata_store: Optional[MetadataStore]
+
+    def __init__(self, logger, display_config, resolution, metadata_store=None,
+                 frame_cache=None):
+        self.logger = logger
+        self.display_config = display_config
+        self.resolution = tuple(resolution)
+        # If given, source image metadata is read from here rather than from
+        # the image itself.
+        self.metadata_store = metadata_store
+        # Renderers for different resolutions can share a frame cache.
+        self.frame_cache = frame_cache or FrameCache(logger, display_config)
+        # Runs the image processing pipeline on cache misses.
+        self.render_backend = create_render_backend(logger, display_config)
+
+    def get_render_options(self) -> dict:
+        """Returns the options that affect what a rendered frame looks like."""
+        return get_render_options(self.display_config)
+
+    def shutdown(self) -> None:
+        """Stops the render backend, e.g. its worker processes."""
+        self.render_backend.shutdown()
+
+    def get_frame_key(self, image_file) -> str:
+        """Returns the frame cache key for the given image file or path."""
+        return make_frame_key(digest_image_file(image_file), self.resolution,
+                              self.get_render_options())
+
+    def get_exif_date(self, source_path) -> Optional[str]:
+        """Returns the source image's EXIF date from the metadata store.
+
+        Returns '' if the image is known to have no date, or None if the image
+        hasn't been crawled yet.
+        """
+        if self.metadata_store is None or source_path is None:
+            return None
+        metadata = self.metadata_store.get(source_path)
+        if metadata is None:
+            return None
+        return metadata['exif_date'] or ''
+
+    def get_crop_box(self, source_path) -> Optional[tuple]:
+        """Returns the source image's content-aware crop box from the metadata
+        store, or None if it hasn't been worked out yet."""
+        if self.metadata_store is None or source_path is None or \
+                self.get_render_options()['crop_mode'] != CONTENT_AWARE_CROP:
+            return None
+        width, height = self.resolution
+        return self.metadata_store.get_crop_box(source_path, width / height)
+
+    def save_crop_box(self, source_path, crop_box) -> None:
+        """Keeps the content-aware crop box worked out while rendering the
+        source image in the metadata store, so it's only worked out once."""
+        if self.metadata_store is None or source_path is None or crop_box is None or \
+                self.get_render_options()['crop_mode'] != CONTENT_AWARE_CROP:
+            return
+        width, height = self.resolution
+        self.metadata_store.put_crop_box(source_path, width / height, crop_box)
+
+    def save_dhash(self, source_path, dhash) -> None:
+        """Keeps the source image's dHash, worked out while rendering it, in
+        the metadata store, for images the crawler couldn't hash from their
+        headers alone."""
+        if self.metadata_store is None or source_path is None or dhash is None:
+            return
+        self.metadata_store.put_dhash(source_path, format(dhash, '016x'))
+
+    def render(self, image_file, source_path=None) -> ImageType:
+        """Returns the display-ready frame for the given image file or path.
+
+        `source_path` is the image's path in the image source, used to look up
+        its metadata.
+
+        The frame's `info` carries its frame cache key under 'frame_key', the
+        source image's EXIF date, if any, under 'exif_date' and its
+        `source_path`, if given, under 'source_path'.
+
+        Raises `ImageRejected` if the image can't be decoded within the
+        decode budget.
+        """
+        with metrics.span('digest'):
+            frame_key = self.get_frame_key(image_file)
+        frame = self.frame_cache.get(frame_key)
+        metrics.set_gauge('frame_cache_hit_ratio', round(self.frame_cache.hit_rate, 4))
+        if frame is not None:
+            self.logger.info("Using cached frame %s.", frame_key)
+        else:
+            with metrics.span('probe'):
+                max_decode_pixels = plan_decode(
+                    image_file, self.display_config.config['decode'])
+            crop_box = self.get_crop_box(source_path)
+            # The decode budget only limits how much detail is decoded, and
+            # the crop box follows from the crop mode, so neither is part of
+            # the frame key.
+            render_options = dict(self.get_render_options(),
+                                  max_decode_pixels=max_decode_pixels, crop_box=crop_box)
+            with metrics.span('render'):
+                frame = self.render_backend.render(
+                    image_file, self.resolution, render_options,
+                    self.get_exif_date(source_path))
+            if crop_box is None:
+                self.save_crop_box(source_path, frame.info.get('crop_box'))
+            self.save_dhash(source_path, frame.info.get('dhash'))
+            if source_path is not None:
+                frame.info['source_path'] = source_path
+            with metrics.span('cache_write'):
+                self.frame_cache.put(frame_key, frame)
+            self.logger.info("Rendered and cached frame %s.", frame_key)
+
+        frame.info['frame_key'] = frame_key
+        return frame
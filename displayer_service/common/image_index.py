@@ -0,0 +1,315 @@
+"""Provides a persistent index of the images available in the image source."""
+import json
+import os
+import random
+import threading
+import time
+
+from logging import Logger
+from typing import Dict, List, Tuple
+
+from common.display_config import ConfigChanges, DisplayConfig
+from common.image_source import run_with_timeout, scan_executor
+from common.metrics import metrics
+
+
+INDEX_FORMAT_VERSION = 1
+
+
+class ImageIndex:
+    """On-disk index of the images in the image source directory.
+
+    Listing the rclone-mounted image source directory is slow for large albums,
+    so the index is built once, persisted to disk and then incrementally
+    re-synced in the background. Picking images only ever touches the
+    in-memory copy of the index.
+
+    Each entry maps an image path to its size, mtime and file extension.
+    Images that can't or shouldn't be decoded (see `decoders`) are set aside
+    as rejected, along with the reason, and are left out of the index until
+    they change.
+    """
+    logger: Logger
+    display_config: DisplayConfig
+
+    def __init__(self, logger, display_config, read_only=False):
+        self.logger = logger
+        self.display_config = display_config
+        # If set, the index is never written back to the index file, e.g. for
+        # tools that run alongside the service, which owns the file.
+        self.read_only = read_only
+
+        # Protects `entries`, `paths`, `path_positions` and
+        # `rejected_entries`.
+        self.lock = threading.Lock()
+
+        # Image path -> {"size": ..., "mtime": ..., "extension": ...}.
+        self.entries: Dict[str, dict] = {}
+        # Dense list of every indexed path, for O(1) random sampling. Paths
+        # are removed by swapping with the last element, so `path_positions`
+        # tracks where each path currently lives in the list.
+        self.paths: List[str] = []
+        self.path_positions: Dict[str, int] = {}
+        # Image path -> its entry, plus the "reason" it was rejected.
+        self.rejected_entries: Dict[str, dict] = {}
+
+        # Whether the index has been populated, either from disk or from a
+        # sync with the image source.
+        self.is_built = False
+        # Incremented whenever images are added to, updated in or removed from
+        # the index, so that users of the index can cheaply tell when to
+        # re-sync.
+        self.generation = 0
+
+        self.load()
+
+    @property
+    def index_file_path(self) -> str:
+        return self.display_config.config['image_index']['index_file_path']
+
+    @property
+    def image_source_dir(self) -> str:
+        return os.path.expanduser(self.display_config.config['display']['image_source_dir'])
+
+    def __len__(self):
+        return len(self.paths)
+
+    def load(self) -> None:
+        """Populates the index from the index file, if one exists."""
+        try:
+            with open(self.index_file_path, 'r', encoding='utf-8') as index_file:
+                index_dict = json.load(index_file)
+        except FileNotFoundError:
+            self.logger.info("No image index found at %s.",
+                             self.index_file_path)
+            return
+        except (OSError, json.JSONDecodeError) as e:
+            self.logger.error(f"Failed to load image index: {e}")
+            return
+
+        if index_dict.get('version') != INDEX_FORMAT_VERSION or \
+                index_dict.get('image_source_dir') != self.image_source_dir:
+            self.logger.info("Image index is stale. It will be rebuilt.")
+            return
+
+        with self.lock:
+            self.entries = {}
+            self.paths = []
+            self.path_positions = {}
+            for image_path, entry in index_dict['entries'].items():
+                self._add_path(image_path, entry)
+            self.rejected_entries = index_dict.get('rejected', {})
+            self.is_built = True
+            self.generation += 1
+        self.logger.info("Loaded %s images from the image index.",
+                         len(self.paths))
+
+    def save(self) -> None:
+        """Atomically writes the index to the index file, unless the index is
+        read-only."""
+        if self.read_only:
+            return
+        with self.lock:
+            index_dict = {
+                'version': INDEX_FORMAT_VERSION,
+                'image_source_dir': self.image_source_dir,
+                'entries': dict(self.entries),
+                'rejected': dict(self.rejected_entries),
+            }
+
+        # Write to a temporary file first so that a crash mid-write never
+        # leaves behind a truncated index.
+        tmp_index_file_path = f"{self.index_file_path}.tmp"
+        try:
+            with open(tmp_index_file_path, 'w', encoding='utf-8') as index_file:
+                json.dump(index_dict, index_file)
+            os.replace(tmp_index_file_path, self.index_file_path)
+        except OSError as e:
+            self.logger.error(f"Failed to save image index: {e}")
+
+    def scan_image_source(self) -> Dict[str, dict]:
+        """Returns an entry for every allowed image in the image source.
+
+        Raises `OSError` if the image source directory can't be listed.
+        """
+        allowed_extensions = self.display_config.config['display']['allowed_image_extensions']
+        scanned_entries = {}
+        with os.scandir(self.image_source_dir) as dir_entries:
+            for dir_entry in dir_entries:
+                _, file_extension = os.path.splitext(dir_entry.name)
+                file_extension = file_extension.lower()
+                if file_extension not in allowed_extensions:
+                    continue
+                try:
+                    if not dir_entry.is_file():
+                        continue
+                    stat_result = dir_entry.stat()
+                except OSError:
+                    # The file may have been removed since it was listed.
+                    continue
+                image_path = os.path.join(
+                    self.display_config.config['display']['image_source_dir'], dir_entry.name)
+                scanned_entries[image_path] = {
+                    'size': stat_result.st_size,
+                    'mtime': stat_result.st_mtime,
+                    'extension': file_extension,
+                }
+        return scanned_entries
+
+    def refresh(self) -> Tuple[int, int, int]:
+        """Re-syncs the index with the image source directory.
+
+        Only the difference between the index and the directory listing is
+        applied. Returns the number of (added, updated, removed) images.
+        """
+        start_time = time.monotonic()
+        try:
+            with metrics.span('index_scan'):
+                scanned_entries = run_with_timeout(
+                    self.scan_image_source,
+                    timeout_secs=self.display_config.config['image_index']['scan_timeout_secs'],
+                    executor=scan_executor)
+        except OSError as e:
+            self.logger.error(
+                f"Failed to scan image source '{self.image_source_dir}': {e}")
+            return (0, 0, 0)
+
+        num_added = num_updated = num_removed = 0
+        with self.lock:
+            for image_path in [p for p in self.entries if p not in scanned_entries]:
+                self._remove_path(image_path)
+                num_removed += 1
+            for image_path in [p for p in self.rejected_entries if p not in scanned_entries]:
+                del self.rejected_entries[image_path]
+                num_removed += 1
+            for image_path, entry in scanned_entries.items():
+                rejected_entry = self.rejected_entries.get(image_path)
+                if rejected_entry is not None:
+                    if rejected_entry['size'] == entry['size'] and \
+                            rejected_entry['mtime'] == entry['mtime']:
+                        continue
+                    # The image has changed since it was rejected, so give it
+                    # another go.
+                    del self.rejected_entries[image_path]
+                    self._add_path(image_path, entry)
+                    num_updated += 1
+                    continue
+                existing_entry = self.entries.get(image_path)
+                if existing_entry is None:
+                    self._add_path(image_path, entry)
+                    num_added += 1
+                elif existing_entry['size'] != entry['size'] or \
+                        existing_entry['mtime'] != entry['mtime']:
+                    self.entries[image_path] = entry
+                    num_updated += 1
+            self.is_built = True
+            if num_added or num_updated or num_removed:
+                self.generation += 1
+            num_images = len(self.paths)
+        metrics.set_gauge('indexed_images', num_images)
+
+        self.logger.info(
+            "Synced image index in %.2fs: %s images, %s added, %s updated, %s removed.",
+            time.monotonic() - start_time, num_images, num_added, num_updated, num_removed)
+        if num_added or num_updated or num_removed:
+            self.save()
+        return (num_added, num_updated, num_removed)
+
+    def apply_config_changes(self, changes: ConfigChanges) -> None:
+        """Re-syncs the index if the image source directory or the allowed
+        extensions have changed.
+
+        Only the difference is applied, as with any other re-sync: images
+        that no longer match are removed and new ones are added.
+        """
+        if ('display', 'image_source_dir') in changes or \
+                ('display', 'allowed_image_extensions') in changes:
+            self.logger.info("The images to index have changed. Re-syncing the image index.")
+            self.refresh()
+        if any(section == 'decode' for section, _ in changes):
+            self.clear_rejections()
+
+    def mark_rejected(self, image_path, reason) -> None:
+        """Sets the given image aside, so that it's not picked or decoded
+        again until it changes."""
+        with self.lock:
+            entry = self.entries.get(image_path)
+            if entry is None:
+                return
+            self._remove_path(image_path)
+            self.rejected_entries[image_path] = dict(entry, reason=reason)
+            self.generation += 1
+        metrics.increment('images_rejected')
+        self.logger.warning("Rejected %s: %s", image_path, reason)
+        self.save()
+
+    def clear_rejections(self) -> None:
+        """Returns every rejected image to the index, e.g. since the decode
+        budget has changed."""
+        with self.lock:
+            if not self.rejected_entries:
+                return
+            for image_path, rejected_entry in self.rejected_entries.items():
+                entry = dict(rejected_entry)
+                del entry['reason']
+                self._add_path(image_path, entry)
+            self.logger.info("Returned %s rejected images to the image index.",
+                             len(self.rejected_entries))
+            self.rejected_entries = {}
+            self.generation += 1
+        self.save()
+
+    def ensure_built(self) -> None:
+        """Builds the index if it hasn't been loaded or synced yet."""
+        if not self.is_built:
+            self.refresh()
+
+    def refresh_in_background(self) -> None:
+        """Periodically re-syncs the index with the image source."""
+        while True:
+            time.sleep(self.display_config.config['image_index']['refresh_period_secs'])
+            self.refresh()
+
+    def get_paths(self) -> List[str]:
+        """Returns the paths of all indexed images."""
+        with self.lock:
+            return list(self.paths)
+
+    def get_entry(self, image_path) -> dict:
+        """Returns the index entry for the given path, or None."""
+        with self.lock:
+            return self.entries.get(image_path)
+
+    def get_rejected(self) -> Dict[str, str]:
+        """Returns the reason each rejected image was rejected, by path."""
+        with self.lock:
+            return {image_path: rejected_entry['reason']
+                    for image_path, rejected_entry in self.rejected_entries.items()}
+
+    def get_entries(self) -> Dict[str, dict]:
+        """Returns a snapshot of every index entry, keyed by path."""
+        with self.lock:
+            return dict(self.entries)
+
+    def sample(self, num_images) -> List[str]:
+        """Returns up to `num_images` distinct, randomly chosen image paths."""
+        with self.lock:
+            num_images = min(num_images, len(self.paths))
+            if num_images == 1:
+                return [self.paths[random.randrange(len(self.paths))]]
+            return random.sample(self.paths, num_images)
+
+    def _add_path(self, image_path, entry) -> None:
+        """Adds an entry. Expects `self.lock` to be held."""
+        self.entries[image_path] = entry
+        self.path_positions[image_path] = len(self.paths)
+        self.paths.append(image_path)
+
+    def _remove_path(self, image_path) -> None:
+        """Removes an entry in O(1). Expects `self.lock` to be held."""
+        del self.entries[image_path]
+        position = self.path_positions.pop(image_path)
+        last_path = self.paths.pop()
+        if last_path != image_path:
+            self.paths[position] = last_path
+            self.path_positions[last_path] = position
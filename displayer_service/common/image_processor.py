@@ -1,15 +1,81 @@
 #!/usr/bin/python3
 
+import math
 import os
-from PIL import Image, ImageDraw, ExifTags, ImageFont
+import numpy as np
+from PIL import Image, ImageDraw, ExifTags, ImageOps
 from pathlib import Path
 from datetime import datetime
 
+from common.decoders import MAX_DRAFT_SCALE, can_draft
+from common.fonts import load_font
+from common.metrics import metrics
+
 
 # Font path relative to the root folder, `displayer_service`.
 FONT_PATH = "fonts/Mono.ttf"
 FONT_SIZE = 20
 
+# EXIF identifier for the 'Orientation' field. Orientations 5-8 store the image
+# rotated by 90 degrees, i.e. with its width and height swapped.
+EXIF_ORIENTATION_TAG = 274
+TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+
+# How frames are cropped to the display's aspect ratio.
+# - Keep the centre of the image.
+CENTER_CROP = 'center'
+# - Keep the window with the most detail (edge energy), e.g. people's faces
+#   rather than the sky above them.
+CONTENT_AWARE_CROP = 'content_aware'
+DEFAULT_CROP_MODE = CONTENT_AWARE_CROP
+# Longest side of the thumbnail that edge energy is computed over. Crop boxes
+# are only this precise, which is plenty for picking a window.
+CROP_THUMBNAIL_SIZE = 128
+
+# Width and height of the grid that perceptual hashes are computed over, giving
+# hashes of DHASH_SIZE * DHASH_SIZE bits.
+DHASH_SIZE = 8
+
+# The Inky Impression's 7 colours, in the order of the display's colour indices:
+# black, white, green, blue, red, yellow, orange. These match the Inky library's
+# palettes, which blend the panel's measured (saturated) colours with pure
+# (desaturated) colours.
+DESATURATED_PALETTE = [
+    (0, 0, 0), (255, 255, 255), (0, 255, 0), (0, 0, 255),
+    (255, 0, 0), (255, 255, 0), (255, 140, 0)]
+SATURATED_PALETTE = [
+    (57, 48, 57), (255, 255, 255), (58, 91, 70), (61, 59, 94),
+    (156, 72, 75), (208, 190, 71), (177, 106, 73)]
+DEFAULT_SATURATION = 0.5
+
+# Dithering methods for palettizing.
+# - Pillow's Floyd-Steinberg error diffusion, as used by the Inky library.
+FLOYD_STEINBERG_DITHER = 'floyd_steinberg'
+# - NumPy ordered dithering with a 4x4 Bayer matrix.
+BAYER_DITHER = 'bayer'
+# - NumPy error diffusion that only pushes error down to the next row, so that
+#   each row is quantized in one vectorized step.
+ROW_DIFFUSION_DITHER = 'row_diffusion'
+DEFAULT_DITHER = FLOYD_STEINBERG_DITHER
+
+BAYER_MATRIX_4X4 = np.array([
+    [0, 8, 2, 10],
+    [12, 4, 14, 6],
+    [3, 11, 1, 9],
+    [15, 7, 13, 5]], dtype=np.float32)
+# How far (in 0-255 colour units) the Bayer threshold nudges each pixel. The
+# 7 colour palette is coarse, so this is wide.
+BAYER_SPREAD = 96
+# Weights for the error pushed to the 5 pixels below, from 2 columns left to 2
+# columns right.
+ROW_DIFFUSION_WEIGHTS = (1 / 16, 4 / 16, 6 / 16, 4 / 16, 1 / 16)
+# Fraction of each row's error that is carried over. Carrying all of it makes
+# errors pile up down each column, which shows as vertical streaks.
+ROW_DIFFUSION_DAMPING = 0.85
+# Row diffusion has no sideways error flow within a row, so a faint Bayer
+# threshold is added to break up banding.
+ROW_DIFFUSION_BAYER_SPREAD = 48
+
 def determine_central_crop_coordinates(image_width_px, image_height_px, crop_aspect_ratio):
     """Determine cropping box coordinates.
 
@@ -35,20 +101,237 @@ def determine_central_crop_coordinates(image_width_px, image_height_px, crop_asp
         return (0, (image_height_px - crop_height_px) / 2, image_width_px, (image_height_px + crop_height_px) / 2)
 
 
-def burn_date_into_image(img):
-    """Writes the date the image was taken into the image itself.
+def compute_edge_energy(img):
+    """Returns the edge energy of a thumbnail of the given image, as a
+    (height, width) array, along with the thumbnail's scale.
+
+    Edge energy is the gradient magnitude of the greyscale image, i.e. how
+    much each pixel differs from its right and lower neighbours.
+    """
+    scale = min(1, CROP_THUMBNAIL_SIZE / max(img.size))
+    thumbnail_size = (max(2, round(img.width * scale)), max(2, round(img.height * scale)))
+    thumbnail = img.convert('L').resize(thumbnail_size, Image.Resampling.BOX)
+    pixels = np.asarray(thumbnail, dtype=np.float32)
+    energy = np.zeros_like(pixels)
+    energy[:, :-1] += np.abs(np.diff(pixels, axis=1))
+    energy[:-1, :] += np.abs(np.diff(pixels, axis=0))
+    return energy, (thumbnail_size[0] / img.width, thumbnail_size[1] / img.height)
 
-    If no date is found, then this function has no effect.
 
-    See https://en.wikipedia.org/wiki/Exif.
+def determine_content_aware_crop_coordinates(img, crop_aspect_ratio):
+    """Determine the cropping box with the most edge energy.
+
+    The crop is as large as the central crop, and slides along whichever
+    axis the image is too long in. Windows are scored from an integral image
+    (summed-area table) of the edge energy of a small thumbnail, so every
+    position is scored in one vectorized step. Ties, e.g. in featureless
+    images, go to the window nearest the centre.
+
+    Returns a 4-tuple for the upper left corner (x1, y1) and lower right corner
+    (x2, y2).
+    """
+    image_width_px, image_height_px = img.size
+    crop_x1, crop_y1, crop_x2, crop_y2 = determine_central_crop_coordinates(
+        image_width_px, image_height_px, crop_aspect_ratio)
+    crop_width_px, crop_height_px = crop_x2 - crop_x1, crop_y2 - crop_y1
+    if crop_width_px >= image_width_px and crop_height_px >= image_height_px:
+        return (crop_x1, crop_y1, crop_x2, crop_y2)
+
+    energy, (x_scale, y_scale) = compute_edge_energy(img)
+    integral = np.zeros((energy.shape[0] + 1, energy.shape[1] + 1), dtype=np.float64)
+    integral[1:, 1:] = energy.cumsum(axis=0).cumsum(axis=1)
+    is_wide = crop_width_px < image_width_px
+    if is_wide:
+        # Full-height windows, so each one's sum is a difference of the
+        # integral image's bottom row.
+        line_integral = integral[-1, :]
+        window_length = min(max(1, round(crop_width_px * x_scale)), energy.shape[1])
+        scale, crop_length_px, image_length_px = x_scale, crop_width_px, image_width_px
+    else:
+        line_integral = integral[:, -1]
+        window_length = min(max(1, round(crop_height_px * y_scale)), energy.shape[0])
+        scale, crop_length_px, image_length_px = y_scale, crop_height_px, image_height_px
+    window_sums = line_integral[window_length:] - line_integral[:-window_length]
+
+    best_positions = np.flatnonzero(window_sums >= window_sums.max() * (1 - 1e-6))
+    central_position = (len(window_sums) - 1) / 2
+    best_position = best_positions[np.argmin(np.abs(best_positions - central_position))]
+    offset_px = float(min(max(best_position / scale, 0), image_length_px - crop_length_px))
+    if is_wide:
+        return (offset_px, 0, offset_px + crop_width_px, image_height_px)
+    return (0, offset_px, image_width_px, offset_px + crop_height_px)
+
+
+def determine_crop_box(img, crop_aspect_ratio, crop_mode=DEFAULT_CROP_MODE):
+    """Returns the box to crop the image to, as fractions of its width and
+    height, (x1, y1, x2, y2), so that it applies at any decode scale."""
+    if crop_mode == CENTER_CROP:
+        crop_coordinates = determine_central_crop_coordinates(
+            img.width, img.height, crop_aspect_ratio)
+    elif crop_mode == CONTENT_AWARE_CROP:
+        crop_coordinates = determine_content_aware_crop_coordinates(img, crop_aspect_ratio)
+    else:
+        raise ValueError(f"Unknown crop mode '{crop_mode}'.")
+    x1, y1, x2, y2 = crop_coordinates
+    return (round(x1 / img.width, 4), round(y1 / img.height, 4),
+            round(x2 / img.width, 4), round(y2 / img.height, 4))
+
+
+def crop_to_box(img, crop_box):
+    """Returns the image cropped to the given box, as from `determine_crop_box`."""
+    x1, y1, x2, y2 = crop_box
+    return img.crop((round(x1 * img.width), round(y1 * img.height),
+                     round(x2 * img.width), round(y2 * img.height)))
+
+
+def determine_decode_size(image_width_px, image_height_px, target_width_px, target_height_px):
+    """Determine the smallest size an image can be decoded at for display.
+
+    Returns the (width, height) of the image uniformly scaled down such that its
+    central crop to the target's aspect ratio still covers the target size. If
+    the image is already too small to cover the target, its size is returned
+    unchanged.
+    """
+    crop_x1, crop_y1, crop_x2, crop_y2 = determine_central_crop_coordinates(
+        image_width_px, image_height_px, target_width_px / target_height_px)
+    scale = max(target_width_px / (crop_x2 - crop_x1),
+                target_height_px / (crop_y2 - crop_y1))
+    if scale >= 1:
+        return (image_width_px, image_height_px)
+    return (math.ceil(image_width_px * scale), math.ceil(image_height_px * scale))
+
+
+def limit_draft_size(image_size, draft_size, max_decode_pixels):
+    """Returns the size to draft decode an image at, given the size it's
+    wanted at, such that at most `max_decode_pixels` pixels are decoded.
+
+    If decoding at the wanted size would decode too many pixels, a coarser
+    scale is picked instead, down to the coarsest draft scale.
+    """
+    width, height = image_size
+    for scale in (1, 2, 4, MAX_DRAFT_SCALE):
+        if math.ceil(width / scale) * math.ceil(height / scale) <= max_decode_pixels:
+            break
+    draft_width, draft_height = draft_size
+    return (min(draft_width, width // scale), min(draft_height, height // scale))
+
+
+def decode_for_display(img, resolution, max_decode_pixels=None):
+    """Decodes the given lazily opened image at a reduced resolution.
+
+    Only decodes as many pixels as are needed to cover `resolution` after
+    cropping. JPEGs are decoded with DCT scaling (`Image.draft`), which skips
+    most of the decoding work. If that would still decode more than
+    `max_decode_pixels`, they're decoded at a coarser scale, at the cost of
+    detail. Other formats are fully decoded and then downscaled by an integer
+    factor with `Image.reduce`.
+
+    The returned image has its EXIF orientation applied and is in RGB mode.
+    """
+    target_width_px, target_height_px = resolution
+    orientation = img.getexif().get(EXIF_ORIENTATION_TAG, 1)
+    if orientation in TRANSPOSED_ORIENTATIONS:
+        # The stored pixels are rotated relative to how they're displayed.
+        target_width_px, target_height_px = target_height_px, target_width_px
+
+    decode_width_px, decode_height_px = determine_decode_size(
+        img.width, img.height, target_width_px, target_height_px)
+
+    if can_draft(img.format):
+        draft_size = (decode_width_px, decode_height_px)
+        if max_decode_pixels is not None:
+            draft_size = limit_draft_size(img.size, draft_size, max_decode_pixels)
+        # Picks the largest DCT scale (1/2, 1/4 or 1/8) that still yields at
+        # least the requested size.
+        img.draft('RGB', draft_size)
+    elif img.mode != 'RGB':
+        img = img.convert('RGB')
+
+    reduce_factor = min(img.width // decode_width_px,
+                        img.height // decode_height_px)
+    if reduce_factor >= 2:
+        img = img.reduce(reduce_factor)
+
+    return ImageOps.exif_transpose(img)
+
+
+def prepare_for_display(img, resolution, max_decode_pixels=None,
+                        crop_mode=DEFAULT_CROP_MODE, crop_box=None):
+    """Returns the given image decoded, cropped and resized to `resolution`.
+
+    The image is cropped to `crop_box` if given (see `determine_crop_box`),
+    or else to the box picked by `crop_mode`. Either way, the box is kept in
+    the result's `info` under 'crop_box'. The whole image's dHash (see
+    `compute_dhash`) is kept under 'dhash', since the decoded image is at hand.
+
+    The given image is consumed and should not be reused.
+    """
+    width, height = resolution
+    with metrics.span('decode'):
+        img = decode_for_display(img, resolution, max_decode_pixels)
+    with metrics.span('dhash'):
+        dhash = compute_decoded_dhash(img)
+    with metrics.span('crop'):
+        if crop_box is None:
+            crop_box = determine_crop_box(img, width / height, crop_mode)
+        img = crop_to_box(img, crop_box)
+    with metrics.span('resize'):
+        img = img.resize(resolution)
+    img.info['crop_box'] = tuple(crop_box)
+    img.info['dhash'] = dhash
+    return img
+
+
+def compute_dhash(img, hash_size=DHASH_SIZE) -> int:
+    """Returns the difference hash ("dHash") of the given lazily opened image.
+
+    The image is shrunk to `hash_size` + 1 by `hash_size` greyscale pixels,
+    and each bit of the hash says whether a pixel is brighter than its left
+    neighbour. Near-identical images, e.g. burst shots or re-encoded uploads,
+    have hashes that differ in only a few bits.
+
+    JPEGs are decoded at a reduced scale, since only a handful of pixels are
+    needed. The given image is consumed and should not be reused.
+    """
+    if can_draft(img.format):
+        img.draft('L', (hash_size * 8, hash_size * 8))
+    return compute_decoded_dhash(ImageOps.exif_transpose(img), hash_size)
+
+
+def compute_decoded_dhash(img, hash_size=DHASH_SIZE) -> int:
+    """Returns the dHash (see `compute_dhash`) of an already decoded and
+    transposed image."""
+    img = img.convert('L').resize((hash_size + 1, hash_size), Image.Resampling.BOX)
+    pixels = np.asarray(img, dtype=np.int16)
+    bits = pixels[:, 1:] > pixels[:, :-1]
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+def get_exif_date(img):
+    """Returns the EXIF 'DateTime' of the image, or None if it has none.
+
     In the EXIF standard, 306 is the identifier for the 'DateTime' field, which
     tells you when the photo was taken.
     """
     exif_data = img.getexif()
     if not exif_data:
-        return img
+        return None
+    return exif_data.get(306)
+
+
+def burn_date_into_image(img, creation_time=None):
+    """Writes the date the image was taken into the image itself.
+
+    The date is given as an EXIF 'DateTime' string, e.g. from the metadata
+    store. If it isn't given, it's read from the image's EXIF data. If no date
+    is found, then this function has no effect.
 
-    creation_time = exif_data.get(306)
+    See https://en.wikipedia.org/wiki/Exif.
+    In the EXIF standard, 306 is the identifier for the 'DateTime' field, which
+    tells you when the photo was taken.
+    """
+    if creation_time is None:
+        creation_time = get_exif_date(img)
     if not creation_time:
         return img
 
@@ -61,7 +344,7 @@ def burn_date_into_image(img):
     image_draw = ImageDraw.Draw(img)
     img_width, img_height = img.size
     anchor_position = (img_width - 10, img_height - 10)
-    font = ImageFont.truetype(FONT_PATH, FONT_SIZE)
+    font = load_font(FONT_PATH, FONT_SIZE)
     image_draw.text(anchor_position, formatted_time, fill=(0, 0, 0),
                     font=font, anchor="rs", stroke_fill=(255, 255, 255), stroke_width=2)
     return img
@@ -74,3 +357,126 @@ def central_crop(image, aspect_ratio):
     crop_coordinates = determine_central_crop_coordinates(
         image_width_px, image_height_px, aspect_ratio)
     return image.crop(crop_coordinates)
+
+
+def blend_palette(saturation=DEFAULT_SATURATION):
+    """Returns the display palette as a flat [r, g, b, r, g, b, ...] list.
+
+    Mirrors the Inky library's palette blending so that frames palettized here
+    look the same as frames the display driver would have palettized itself.
+    """
+    palette = []
+    for saturated_colour, desaturated_colour in zip(SATURATED_PALETTE, DESATURATED_PALETTE):
+        palette += [int(s * saturation + d * (1 - saturation))
+                    for s, d in zip(saturated_colour, desaturated_colour)]
+    return palette
+
+
+def nearest_palette_indices(pixels, palette_colours):
+    """Returns the index of the nearest palette colour for each RGB pixel.
+
+    `pixels` is an (..., 3) array and `palette_colours` is a (num_colours, 3)
+    array. Minimises the squared distance |p|^2 - 2p.c + |c|^2, dropping |p|^2
+    which doesn't depend on the colour, so that the work is one matrix product.
+    """
+    scores = pixels @ (-2 * palette_colours.T) + \
+        (palette_colours ** 2).sum(axis=1)
+    return scores.argmin(axis=-1).astype(np.uint8)
+
+
+def bayer_thresholds(height, width):
+    """Returns the 4x4 Bayer matrix tiled to the given size, centred on 0."""
+    return np.tile(BAYER_MATRIX_4X4 / 16 - 0.5,
+                   (height // 4 + 1, width // 4 + 1))[:height, :width]
+
+
+def dither_ordered(rgb_pixels, palette_colours):
+    """Quantizes an (height, width, 3) array with ordered (Bayer) dithering."""
+    height, width, _ = rgb_pixels.shape
+    thresholds = bayer_thresholds(height, width)
+    return nearest_palette_indices(
+        rgb_pixels + thresholds[:, :, np.newaxis] * BAYER_SPREAD, palette_colours)
+
+
+def dither_row_diffusion(rgb_pixels, palette_colours):
+    """Quantizes an (height, width, 3) array with row-wise error diffusion.
+
+    Each row is quantized in one vectorized step, and its (damped)
+    quantization error is spread over the row below.
+    """
+    height, width, _ = rgb_pixels.shape
+    thresholds = bayer_thresholds(height, width) * ROW_DIFFUSION_BAYER_SPREAD
+    max_offset = len(ROW_DIFFUSION_WEIGHTS) // 2
+    indices = np.empty((height, width), dtype=np.uint8)
+    carried_error = np.zeros((width, 3), dtype=np.float32)
+    for y in range(height):
+        row = np.clip(rgb_pixels[y] + carried_error, 0, 255)
+        indices[y] = nearest_palette_indices(
+            row + thresholds[y][:, np.newaxis], palette_colours)
+        error = (row - palette_colours[indices[y]]) * ROW_DIFFUSION_DAMPING
+
+        carried_error = np.zeros_like(error)
+        for offset, weight in enumerate(ROW_DIFFUSION_WEIGHTS, -max_offset):
+            if offset < 0:
+                carried_error[:offset] += weight * error[-offset:]
+            elif offset > 0:
+                carried_error[offset:] += weight * error[:-offset]
+            else:
+                carried_error += weight * error
+    return indices
+
+
+def palettize(img, saturation=DEFAULT_SATURATION, dither=DEFAULT_DITHER):
+    """Returns the image quantized to the display's palette, in "P" mode.
+
+    The pixel values of the result are the display's colour indices, so the
+    display driver can show it without doing any colour work of its own.
+    """
+    palette = blend_palette(saturation)
+    img = img.convert('RGB')
+    if dither == FLOYD_STEINBERG_DITHER:
+        palette_image = Image.new('P', (1, 1))
+        palette_image.putpalette(palette)
+        return img.quantize(palette=palette_image,
+                            dither=Image.Dither.FLOYDSTEINBERG)
+
+    palette_colours = np.array(palette, dtype=np.float32).reshape(-1, 3)
+    rgb_pixels = np.asarray(img, dtype=np.float32)
+    if dither == BAYER_DITHER:
+        indices = dither_ordered(rgb_pixels, palette_colours)
+    elif dither == ROW_DIFFUSION_DITHER:
+        indices = dither_row_diffusion(rgb_pixels, palette_colours)
+    else:
+        raise ValueError(f"Unknown dithering method '{dither}'.")
+
+    frame = Image.frombytes('P', img.size, indices.tobytes())
+    frame.putpalette(palette)
+    return frame
+
+
+def render_frame(img, resolution, burn_date=True, saturation=DEFAULT_SATURATION,
+                 dither=DEFAULT_DITHER, exif_date=None, max_decode_pixels=None,
+                 crop_mode=DEFAULT_CROP_MODE, crop_box=None):
+    """Returns a display-ready, palettized frame for the given image.
+
+    Runs the whole processing pipeline: decode, crop, resize, burn in the date
+    and palettize. The given image is consumed and should not be reused.
+
+    The burned in date is `exif_date` if given, or else read from the image.
+    `max_decode_pixels` limits how many pixels are decoded, as in
+    `decode_for_display`. The image is cropped as in `prepare_for_display`,
+    and the frame's `info` carries the crop box and dHash under 'crop_box' and
+    'dhash'.
+    """
+    if burn_date and exif_date is None:
+        exif_date = get_exif_date(img)
+    frame = prepare_for_display(img, resolution, max_decode_pixels, crop_mode, crop_box)
+    crop_box, dhash = frame.info['crop_box'], frame.info['dhash']
+    if burn_date:
+        with metrics.span('date_burn'):
+            frame = burn_date_into_image(frame, exif_date or '')
+    with metrics.span('quantize'):
+        frame = palettize(frame, saturation, dither)
+    frame.info['crop_box'] = crop_box
+    frame.info['dhash'] = dhash
+    return frame
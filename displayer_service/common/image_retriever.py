@@ -1,112 +1,231 @@
 """Provides utilities from fetching images from the image source."""
-import random
+import io
 import os
 import shutil
+import tempfile
 
 from logging import Logger
-from typing import List
+from typing import List, Union
 from pathlib import Path
 from PIL import Image
 from PIL.Image import Image as ImageType
 
-from common.display_config import DisplayConfig
+from common.display_config import ConfigChanges, DisplayConfig
+from common.image_index import ImageIndex
+from common.image_source import ImageSourceUnavailable, run_with_timeout
+from common.metadata_store import MetadataStore
+from common.metrics import metrics
+from common.near_duplicates import NearDuplicateFilter
+from common.shuffle_scheduler import ShuffleScheduler
+from common.weighted_scheduler import WeightedScheduler
 
 
-IMAGE_QUEUE_DIR = "tmp-images"
+SHUFFLE_SCHEDULE_MODE = 'shuffle'
+WEIGHTED_SCHEDULE_MODE = 'weighted'
+
+# A fetched image: either an in-memory buffer or the path of a local copy.
+ImageFile = Union[io.BytesIO, str]
 
 
 class ImageRetriever:
     """Handles the retrieval of images from the image source."""
     logger: Logger
     display_config: DisplayConfig
+    image_index: ImageIndex
+    metadata_store: MetadataStore
+    near_duplicate_filter: NearDuplicateFilter
+    scheduler: Union[ShuffleScheduler, WeightedScheduler]
 
     def __init__(self, logger, display_config):
         self.logger = logger
         self.display_config = display_config
-
-        # Temporary directory to store local copies of the images in the image
-        # buffer.
-        Path(f"./{IMAGE_QUEUE_DIR}").mkdir(parents=True, exist_ok=True)
+        # Temporary directory to store local copies of images too large to
+        # fetch into memory.
+        self.local_copy_dir = display_config.config['retrieval']['local_copy_dir']
+        self.image_index = ImageIndex(logger, display_config)
+        self.metadata_store = MetadataStore(logger, display_config, self.image_index)
+        # Keeps burst shots and re-uploads from being shown back to back.
+        self.near_duplicate_filter = NearDuplicateFilter(
+            logger, display_config, self.metadata_store)
+        # Decides the order images are shown in.
+        self.scheduler = self.create_scheduler()
+        self.display_config.add_listener(self.apply_config_changes)
+
+        Path(self.local_copy_dir).mkdir(parents=True, exist_ok=True)
+
+    def create_scheduler(self):
+        """Returns the scheduler selected in the display config."""
+        schedule_mode = self.display_config.config['schedule']['mode']
+        if schedule_mode == WEIGHTED_SCHEDULE_MODE:
+            return WeightedScheduler(self.logger, self.display_config, self.image_index,
+                                     self.metadata_store, self.near_duplicate_filter)
+        if schedule_mode != SHUFFLE_SCHEDULE_MODE:
+            self.logger.error(
+                f"Unknown schedule mode '{schedule_mode}'. Shuffling instead.")
+        return ShuffleScheduler(self.logger, self.display_config, self.image_index,
+                                self.near_duplicate_filter)
+
+    def apply_config_changes(self, changes: ConfigChanges) -> None:
+        """Applies a reloaded display config to the index and the scheduler."""
+        self.image_index.apply_config_changes(changes)
+        if ('schedule', 'mode') in changes:
+            self.logger.info("The schedule mode has changed. Replacing the scheduler.")
+            self.scheduler = self.create_scheduler()
+        else:
+            self.scheduler.apply_config_changes(changes)
 
     def __del__(self):
-        shutil.rmtree(f"./{IMAGE_QUEUE_DIR}", ignore_errors=True)
+        shutil.rmtree(self.local_copy_dir, ignore_errors=True)
 
     def get_path_of_all_images(self) -> List[str]:
-        """Returns a list of the paths of all the available images from image source."""
-        # Fetch the paths of all the images.
-        all_images = []
-        image_src_dir = self.display_config.config['display']['image_source_dir']
-        self.logger.info(f"Fetching all images in {image_src_dir}.")
-
-        if not os.path.exists(image_src_dir):
-            self.logger.error(f"Directory '{image_src_dir}' does not exist.")
-            # TODO(image retrieval error): return empty for error handling
-
-        images_found = 0
-        for image_basename in os.listdir(image_src_dir):
-            _, file_extension = os.path.splitext(image_basename)
-            image_path = os.path.join(image_src_dir, image_basename)
-            if file_extension.lower() in self.display_config.config['display']['allowed_image_extensions']:
-                images_found += 1
-                all_images.append(image_path)
-
-        if images_found <= 0:
-            self.logger.warning(f"No images found in {image_src_dir}.")
-        else:
-            self.logger.info(f"Found {images_found} images.")
+        """Returns a list of the paths of all the available images from image source.
 
+        Paths are read from the image index rather than by listing the image
+        source directory.
+        """
+        with metrics.span('list'):
+            self.image_index.ensure_built()
+            all_images = self.image_index.get_paths()
+
+        if not all_images:
+            self.logger.warning(
+                f"No images found in {self.image_index.image_source_dir}.")
         return all_images
 
-    def get_random_image(self) -> ImageType:
-        """Retrieves one random image from the image source."""
-        all_images = self.get_path_of_all_images()
-        if not all_images: 
-            raise Exception("No images were found in fetch, in an attempt to get a random image.")
+    def get_random_image_file(self) -> ImageFile:
+        """Retrieves the next scheduled image from the image source.
 
-        # Randomly pick an image from all the images.
-        chosen_image_file_path = random.choice(all_images)
+        Returns the fetched image file (see `fetch_image_file`). The caller
+        should clean it up with `clean_up_image_file` when finished with it.
+        """
+        return self.fetch_image_file(self.choose_next_image_path())
 
-        local_image_copy_path = self.create_local_image_copy(
-            chosen_image_file_path)
+    def choose_next_image_path(self) -> str:
+        """Returns the path of the next scheduled image in the image source.
 
-        return Image.open(local_image_copy_path)
+        The order images are chosen in is up to the scheduler (see
+        `create_scheduler`).
+        """
+        self.image_index.ensure_built()
+        image_path = self.scheduler.next()
+        if image_path is None:
+            raise ImageSourceUnavailable(
+                "No images were found in fetch, in an attempt to get a random image.")
+        return image_path
+
+    def reject_image(self, image_path, reason) -> None:
+        """Stops scheduling the given image, which can't or shouldn't be
+        decoded, until it changes (see `ImageIndex.mark_rejected`)."""
+        self.image_index.mark_rejected(image_path, reason)
+
+    def get_random_image(self) -> ImageType:
+        """Retrieves the next scheduled image from the image source."""
+        return Image.open(self.get_random_image_file())
 
     def get_random_images(self, num_images) -> List[ImageType]:
-        """Retrieves `num_images` number of random images from the image source."""
-        all_images = self.get_path_of_all_images()
-        if not all_images: 
+        """Retrieves the next `num_images` scheduled images from the image source."""
+        self.image_index.ensure_built()
+        if not len(self.image_index):
             raise Exception(f"No images were found in fetch, in an attempt to get {num_images} random images. ")
+        chosen_image_paths = [self.choose_next_image_path()
+                              for _ in range(min(num_images, len(self.image_index)))]
 
+        return [Image.open(self.fetch_image_file(each_image_path))
+                for each_image_path in chosen_image_paths]
 
-        num_images = min(num_images, len(all_images))
-        # Randomly pick an image from all the images.
-        chosen_image_paths = random.sample(all_images, num_images)
+    def fetch_image_file(self, image_path) -> ImageFile:
+        """Fetches the given image from the image source.
 
-        images = []
-        for each_image_path in chosen_image_paths:
-            local_image_copy_path = self.create_local_image_copy(
-                each_image_path)
-            images.append(Image.open(local_image_copy_path))
+        Images up to `in_memory_max_bytes` are streamed into an in-memory
+        buffer with large sequential reads. Larger images are copied to a
+        local file instead, to bound memory usage, in which case the local
+        file's path is returned.
 
-        return images
+        Either way, PIL can't load the image directly from the image files in
+        the rclone mounted directory, so a fetched copy is always returned.
+
+        Raises `ImageSourceUnavailable` if the image can't be read, or if the
+        image source doesn't respond within `source_timeout_secs`.
+        """
+        retrieval_config = self.display_config.config['retrieval']
+        with metrics.span('copy'):
+            return run_with_timeout(self.copy_image_file, image_path,
+                                    timeout_secs=retrieval_config['source_timeout_secs'],
+                                    on_abandoned=self.clean_up_image_file)
+
+    def copy_image_file(self, image_path) -> ImageFile:
+        """Fetches the given image, without a timeout (see `fetch_image_file`)."""
+        retrieval_config = self.display_config.config['retrieval']
+        # The index already has the size, which saves a stat on the mount.
+        entry = self.image_index.get_entry(image_path)
+        image_size = entry['size'] if entry is not None else os.path.getsize(image_path)
+        if image_size > retrieval_config['in_memory_max_bytes']:
+            return self.create_local_image_copy(image_path)
+        return self.read_image_into_memory(image_path, image_size)
+
+    def read_image_into_memory(self, image_path, image_size) -> io.BytesIO:
+        """Reads the given image, expected to be `image_size` bytes, into an
+        in-memory buffer.
+
+        The buffer is allocated up front and read into in place, so only one
+        copy of the image is ever held.
+        """
+        chunk_size = self.display_config.config['retrieval']['read_chunk_size_bytes']
+        image_bytes = io.BytesIO()
+        if image_size:
+            image_bytes.seek(image_size - 1)
+            image_bytes.write(b'\0')
+        num_read = 0
+        # Unbuffered, so each chunk is a single read against the mount.
+        with open(image_path, 'rb', buffering=0) as image_file:
+            with image_bytes.getbuffer() as image_buffer:
+                while num_read < image_size:
+                    num_chunk_bytes = image_file.readinto(
+                        image_buffer[num_read:num_read + chunk_size])
+                    if not num_chunk_bytes:
+                        break
+                    num_read += num_chunk_bytes
+            # The image may have changed size since it was indexed.
+            image_bytes.truncate(num_read)
+            image_bytes.seek(num_read)
+            for chunk in iter(lambda: image_file.read(chunk_size), b''):
+                image_bytes.write(chunk)
+        image_bytes.seek(0)
+        return image_bytes
 
     def create_local_image_copy(self, image_path) -> str:
         """Locally clone the image from the image source (Google Photos).
 
-        This is necessary because PIL fails to load the image directly from the
-        image files in the rclone mounted directory.
+        Copies get unique names, so that album files sharing a basename don't
+        collide.
         """
-        local_image_copy_path = f"./{IMAGE_QUEUE_DIR}/{os.path.basename(image_path)}"
-        shutil.copy(image_path, local_image_copy_path)
+        _, file_extension = os.path.splitext(image_path)
+        # Another retriever may have removed the directory on being collected.
+        Path(self.local_copy_dir).mkdir(parents=True, exist_ok=True)
+        file_descriptor, local_image_copy_path = tempfile.mkstemp(
+            suffix=file_extension, dir=self.local_copy_dir)
+        with open(file_descriptor, 'wb') as local_image_file, \
+                open(image_path, 'rb') as image_file:
+            shutil.copyfileobj(image_file, local_image_file,
+                               self.display_config.config['retrieval']['read_chunk_size_bytes'])
 
         return local_image_copy_path
 
     def clean_up_image(self, img: ImageType):
-        """Cleans up temporary local copy of the given image."""
+        """Cleans up the fetched copy of the given image."""
         if not img:
             return
-        if not os.path.exists(img.filename):
+        img.close()
+        if img.filename:
+            self.clean_up_image_file(img.filename)
+
+    def clean_up_image_file(self, image_file: ImageFile):
+        """Cleans up the given fetched image file."""
+        if not isinstance(image_file, str):
+            image_file.close()
+            return
+        if not os.path.exists(image_file):
             return
-        os.remove(img.filename)
+        os.remove(image_file)
 
     # TODO(image retrieval error): def get_error_image
@@ -0,0 +1,59 @@
+"""Provides guarded access to the (rclone-mounted) image source."""
+import concurrent.futures
+
+from typing import Callable, Optional
+
+
+# Threads that touch the image source. A hung FUSE read can block a thread
+# forever, so callers wait on these with a timeout instead of blocking
+# themselves. The pools are bounded, so hung reads can't pile up threads.
+NUM_SOURCE_IO_THREADS = 4
+source_io_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=NUM_SOURCE_IO_THREADS, thread_name_prefix="image-source-io")
+# Directory scans get a thread of their own, so that a few hung image reads
+# can't hold up re-syncing the image index.
+scan_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=1, thread_name_prefix="image-source-scan")
+
+
+class ImageSourceUnavailable(OSError):
+    """Raised when the image source is missing, empty or not responding."""
+
+
+def run_with_timeout(function, *args, timeout_secs,
+                     executor: Optional[concurrent.futures.Executor] = None,
+                     on_abandoned: Optional[Callable] = None):
+    """Returns `function(*args)`, run on an image source I/O thread (or on the
+    given executor's).
+
+    Raises `ImageSourceUnavailable` if it fails with an `OSError` or doesn't
+    finish within `timeout_secs`. In the latter case, the call is cancelled if
+    it hasn't started yet, so stale calls don't hold up new ones once the
+    mount recovers. Otherwise it's abandoned and left to finish in the
+    background, and its result, if any, is passed to `on_abandoned` to be
+    cleaned up.
+    """
+    future = (executor or source_io_executor).submit(function, *args)
+    try:
+        return future.result(timeout=timeout_secs)
+    except concurrent.futures.TimeoutError:
+        if not future.cancel() and on_abandoned is not None:
+            future.add_done_callback(
+                lambda abandoned_future: _clean_up_abandoned(abandoned_future, on_abandoned))
+        raise ImageSourceUnavailable(
+            f"The image source didn't respond within {timeout_secs} seconds.") from None
+    except ImageSourceUnavailable:
+        raise
+    except OSError as e:
+        raise ImageSourceUnavailable(f"The image source is unavailable: {e}") from e
+
+
+def _clean_up_abandoned(future: concurrent.futures.Future, on_abandoned: Callable) -> None:
+    """Passes the result of an abandoned call to `on_abandoned`, if it
+    succeeded."""
+    if future.cancelled() or future.exception() is not None:
+        return
+    try:
+        on_abandoned(future.result())
+    except OSError:
+        pass
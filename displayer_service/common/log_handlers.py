@@ -0,0 +1,34 @@
+"""Provides custom logging handlers."""
+import collections
+import logging
+
+from typing import List, Tuple
+
+
+class RingBufferHandler(logging.Handler):
+    """Keeps the most recent formatted log lines in memory.
+
+    Lets the debug screen show recent logs without any file I/O.
+    """
+
+    def __init__(self, capacity):
+        super().__init__()
+        self.lines = collections.deque(maxlen=capacity)
+        # Total number of records handled. Changes whenever new lines arrive.
+        self.num_records = 0
+
+    def emit(self, record) -> None:
+        try:
+            message = self.format(record)
+        except Exception:
+            self.handleError(record)
+            return
+        # `handle` already holds the handler's lock.
+        self.lines.extend(message.splitlines())
+        self.num_records += 1
+
+    def get_lines(self) -> Tuple[int, List[str]]:
+        """Returns the number of records handled so far and the buffered lines,
+        oldest first."""
+        with self.lock:
+            return self.num_records, list(self.lines)
@@ -0,0 +1,407 @@
+"""Provides a persistent store of image metadata, crawled in the background."""
+import io
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from logging import Logger
+from typing import Callable, Dict, List, Optional
+from pathlib import Path
+from PIL import ExifTags
+
+from common import image_processor
+from common.decoders import ImageProbe, ImageRejected, check_decode_budget, open_image
+from common.display_config import DisplayConfig
+from common.image_index import ImageIndex
+from common.image_source import ImageSourceUnavailable, run_with_timeout
+from common.metrics import metrics
+
+
+# Enough to hold the headers, including the EXIF data, of almost every image.
+HEADER_READ_BYTES = 256 * 1024
+# The EXIF data of JPEGs starts with this, followed by a TIFF header.
+EXIF_HEADER = b'Exif\x00\x00'
+# IFD1 tags giving where the EXIF thumbnail is, and its length.
+EXIF_THUMBNAIL_OFFSET_TAG = 0x0201
+EXIF_THUMBNAIL_LENGTH_TAG = 0x0202
+
+# Bumped whenever the schema changes. Stores from versions without a
+# migration in `SCHEMA_MIGRATIONS` are rebuilt, since every record can simply
+# be crawled again, though that means reading every image on the image source
+# again.
+METADATA_SCHEMA_VERSION = 3
+METADATA_SCHEMA = """
+CREATE TABLE IF NOT EXISTS image_metadata (
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    exif_date TEXT,
+    orientation INTEGER,
+    width INTEGER,
+    height INTEGER,
+    format TEXT,
+    dhash TEXT,
+    PRIMARY KEY (path, size, mtime)
+)
+"""
+# Crop boxes, as from `image_processor.determine_crop_box`, of each image for
+# each display aspect ratio. They're JSON lists of fractions of the image's
+# width and height.
+CROP_BOX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS crop_boxes (
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    aspect_ratio TEXT NOT NULL,
+    crop_box TEXT NOT NULL,
+    PRIMARY KEY (path, size, mtime, aspect_ratio)
+)
+"""
+# Schema version -> the statements that upgrade a store from it to the next
+# version in place, keeping its records.
+SCHEMA_MIGRATIONS = {
+    # Adds the crop boxes table.
+    2: [CROP_BOX_SCHEMA],
+}
+METADATA_COLUMNS = ('exif_date', 'orientation', 'width', 'height', 'format', 'dhash')
+# Number of crawled records written to the store per transaction.
+CRAWL_BATCH_SIZE = 50
+
+
+def read_file_start(image_path, num_bytes=-1) -> bytes:
+    """Returns up to `num_bytes` from the start of the given file, or the
+    whole file by default."""
+    with open(image_path, 'rb') as image_file:
+        return image_file.read(num_bytes)
+
+
+def read_image_metadata(image_path, decode_config=None, timeout_secs=None) -> dict:
+    """Returns the metadata of the given image, read from its headers.
+
+    Only the start of the file is read, since PIL can't open images on the
+    rclone mount directly and reading whole originals would be wasteful. If
+    the headers don't fit, the whole file is read instead. Reads run on an
+    image source I/O thread, and raise `ImageSourceUnavailable` if they take
+    longer than `timeout_secs` (see `image_source.run_with_timeout`).
+
+    The perceptual hash (see `image_processor.compute_dhash`) is taken from
+    the EXIF thumbnail that most camera JPEGs carry in their headers, and
+    stored as a hex string. Otherwise it's None until the image is first
+    rendered (see `MetadataStore.put_dhash`).
+
+    If `decode_config` is given, the image is checked against its decode
+    budget (see `decoders.check_decode_budget`). Raises `ImageRejected` if it
+    can't or shouldn't be decoded.
+    """
+    header_bytes = run_with_timeout(read_file_start, image_path, HEADER_READ_BYTES,
+                                    timeout_secs=timeout_secs)
+    try:
+        metadata = _parse_image_metadata(io.BytesIO(header_bytes), decode_config)
+    except (OSError, SyntaxError):
+        if len(header_bytes) < HEADER_READ_BYTES:
+            raise
+        header_bytes = run_with_timeout(read_file_start, image_path,
+                                        timeout_secs=timeout_secs)
+        metadata = _parse_image_metadata(io.BytesIO(header_bytes), decode_config)
+    thumbnail_bytes = read_exif_thumbnail(header_bytes)
+    metadata['dhash'] = None
+    if thumbnail_bytes is not None:
+        try:
+            with open_image(io.BytesIO(thumbnail_bytes)) as thumbnail:
+                metadata['dhash'] = format(image_processor.compute_dhash(thumbnail), '016x')
+        except (ImageRejected, OSError, SyntaxError):
+            pass
+    return metadata
+
+
+def read_exif_thumbnail(header_bytes) -> Optional[bytes]:
+    """Returns the JPEG thumbnail embedded in the EXIF data (IFD1) of the
+    given image headers, or None if there isn't one within them."""
+    try:
+        with open_image(io.BytesIO(header_bytes)) as img:
+            thumbnail_ifd = img.getexif().get_ifd(ExifTags.IFD.IFD1)
+    except (AttributeError, ImageRejected, KeyError, OSError, SyntaxError):
+        # Older versions of Pillow can't read IFD1.
+        return None
+    offset = thumbnail_ifd.get(EXIF_THUMBNAIL_OFFSET_TAG)
+    length = thumbnail_ifd.get(EXIF_THUMBNAIL_LENGTH_TAG)
+    exif_start = header_bytes.find(EXIF_HEADER)
+    if offset is None or length is None or exif_start < 0:
+        return None
+    # The offset is from the start of the EXIF data's TIFF header.
+    thumbnail_start = exif_start + len(EXIF_HEADER) + offset
+    thumbnail_bytes = header_bytes[thumbnail_start:thumbnail_start + length]
+    return thumbnail_bytes if len(thumbnail_bytes) == length else None
+
+
+def _parse_image_metadata(image_file, decode_config=None) -> dict:
+    with open_image(image_file) as img:
+        if decode_config is not None:
+            check_decode_budget(ImageProbe.from_image(img), decode_config)
+        exif_data = img.getexif()
+        return {
+            'exif_date': exif_data.get(306),
+            'orientation': exif_data.get(image_processor.EXIF_ORIENTATION_TAG),
+            'width': img.width,
+            'height': img.height,
+            'format': img.format,
+        }
+
+
+def format_aspect_ratio(aspect_ratio) -> str:
+    """Returns the aspect ratio as a key for the crop box table."""
+    return f"{aspect_ratio:.4f}"
+
+
+def lower_thread_priority(logger: Logger, niceness) -> None:
+    """Lowers the CPU and I/O scheduling priority of the calling thread.
+
+    On Linux, each thread has its own niceness, set through its native thread
+    id. Elsewhere, or before Python 3.8, this has no effect.
+    """
+    get_native_id = getattr(threading, 'get_native_id', None)
+    if get_native_id is None or not hasattr(os, 'setpriority'):
+        logger.info("Can't lower the metadata crawler's priority on this platform.")
+        return
+    try:
+        os.setpriority(os.PRIO_PROCESS, get_native_id(), niceness)
+    except OSError as e:
+        logger.error(f"Failed to lower the metadata crawler's priority: {e}")
+
+
+class MetadataStore:
+    """SQLite store of each image's EXIF date, orientation, dimensions, format
+    and perceptual hash.
+
+    Records are keyed by the image's path, size and mtime, so a modified image
+    is simply crawled again. A low priority background crawler fills in
+    records for newly indexed images, so that rendering and scheduling never
+    need to re-open originals on the image source to get at their metadata.
+    """
+    logger: Logger
+    display_config: DisplayConfig
+    image_index: ImageIndex
+
+    def __init__(self, logger, display_config, image_index):
+        self.logger = logger
+        self.display_config = display_config
+        self.image_index = image_index
+
+        # Protects the connection, which is shared between threads.
+        self.lock = threading.Lock()
+        Path(os.path.dirname(os.path.abspath(self.db_path))).mkdir(
+            parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(self.db_path, check_same_thread=False)
+        with self.lock, self.connection:
+            schema_version, = self.connection.execute("PRAGMA user_version").fetchone()
+            while schema_version in SCHEMA_MIGRATIONS:
+                for statement in SCHEMA_MIGRATIONS[schema_version]:
+                    self.connection.execute(statement)
+                schema_version += 1
+            if schema_version != METADATA_SCHEMA_VERSION:
+                self.connection.execute("DROP TABLE IF EXISTS image_metadata")
+                self.connection.execute("DROP TABLE IF EXISTS crop_boxes")
+            self.connection.execute(f"PRAGMA user_version = {METADATA_SCHEMA_VERSION}")
+            self.connection.execute(METADATA_SCHEMA)
+            self.connection.execute(CROP_BOX_SCHEMA)
+
+        # Incremented whenever records are added, so that users of the store
+        # can cheaply tell when to re-read it.
+        self.generation = 0
+        # dHashes of images rendered before they were crawled, by (path, size,
+        # mtime), to be recorded once they are.
+        self.pending_dhashes: Dict[tuple, str] = {}
+        # Called with the records put in the store, to follow it without
+        # re-reading it.
+        self.listeners: List[Callable[[list], None]] = []
+
+    @property
+    def metadata_config(self) -> dict:
+        return self.display_config.config['metadata']
+
+    @property
+    def db_path(self) -> str:
+        return self.metadata_config['db_path']
+
+    def get(self, image_path) -> Optional[dict]:
+        """Returns the metadata of the given image, or None if it hasn't been
+        crawled since it last changed."""
+        entry = self.image_index.get_entry(image_path)
+        if entry is None:
+            return None
+        with self.lock:
+            row = self.connection.execute(
+                f"SELECT {', '.join(METADATA_COLUMNS)} FROM image_metadata "
+                "WHERE path = ? AND size = ? AND mtime = ?",
+                (image_path, entry['size'], entry['mtime'])).fetchone()
+        return dict(zip(METADATA_COLUMNS, row)) if row else None
+
+    def get_all(self) -> Dict[str, dict]:
+        """Returns the metadata of every indexed image that has been crawled."""
+        entries = self.image_index.get_entries()
+        with self.lock:
+            rows = self.connection.execute(
+                f"SELECT path, size, mtime, {', '.join(METADATA_COLUMNS)} "
+                "FROM image_metadata").fetchall()
+        all_metadata = {}
+        for image_path, size, mtime, *values in rows:
+            entry = entries.get(image_path)
+            if entry is not None and entry['size'] == size and entry['mtime'] == mtime:
+                all_metadata[image_path] = dict(zip(METADATA_COLUMNS, values))
+        return all_metadata
+
+    def put_many(self, records) -> None:
+        """Records the metadata of the given versions of images.
+
+        `records` are (image path, index entry, metadata) tuples. They're
+        written in a single transaction.
+        """
+        with self.lock, self.connection:
+            records = [(image_path, entry, self._with_pending_dhash(image_path, entry, metadata))
+                       for image_path, entry, metadata in records]
+            for image_path, entry, metadata in records:
+                # Drop records of earlier versions of the image.
+                self.connection.execute(
+                    "DELETE FROM image_metadata WHERE path = ?", (image_path,))
+                self.connection.execute(
+                    "DELETE FROM crop_boxes WHERE path = ? AND (size != ? OR mtime != ?)",
+                    (image_path, entry['size'], entry['mtime']))
+                self.connection.execute(
+                    f"INSERT INTO image_metadata (path, size, mtime, {', '.join(METADATA_COLUMNS)}) "
+                    f"VALUES (?, ?, ?{', ?' * len(METADATA_COLUMNS)})",
+                    (image_path, entry['size'], entry['mtime'],
+                     *(metadata[column] for column in METADATA_COLUMNS)))
+        self.generation += 1
+        for listener in list(self.listeners):
+            listener(records)
+
+    def _with_pending_dhash(self, image_path, entry, metadata) -> dict:
+        """Fills in the dHash of an image rendered before it was crawled.
+        Expects `lock` to be held."""
+        pending_dhash = self.pending_dhashes.pop(
+            (image_path, entry['size'], entry['mtime']), None)
+        if metadata['dhash'] is not None or pending_dhash is None:
+            return metadata
+        return dict(metadata, dhash=pending_dhash)
+
+    def put_dhash(self, image_path, dhash) -> None:
+        """Records the dHash of the current version of the given image, if it
+        has none yet, e.g. as worked out while rendering it.
+
+        If the image hasn't been crawled yet, the hash is kept until it is.
+        """
+        entry = self.image_index.get_entry(image_path)
+        if entry is None:
+            return
+        version = (image_path, entry['size'], entry['mtime'])
+        with self.lock, self.connection:
+            is_crawled = self.connection.execute(
+                "SELECT 1 FROM image_metadata WHERE path = ? AND size = ? AND mtime = ?",
+                version).fetchone() is not None
+            if not is_crawled:
+                self.pending_dhashes[version] = dhash
+                return
+            num_updated = self.connection.execute(
+                "UPDATE image_metadata SET dhash = ? "
+                "WHERE path = ? AND size = ? AND mtime = ? AND dhash IS NULL",
+                (dhash, *version)).rowcount
+        if not num_updated:
+            return
+        self.generation += 1
+        for listener in list(self.listeners):
+            listener([(image_path, entry, {'dhash': dhash})])
+
+    def add_listener(self, listener: Callable[[list], None]) -> None:
+        """Registers a callback for whenever records are put in the store.
+        It's called with the (image path, index entry, metadata) records. The
+        metadata of records from `put_dhash` only has the 'dhash'."""
+        self.listeners.append(listener)
+
+    def get_crop_box(self, image_path, aspect_ratio) -> Optional[tuple]:
+        """Returns the crop box of the given image for the given aspect
+        ratio, or None if it hasn't been worked out since the image last
+        changed."""
+        entry = self.image_index.get_entry(image_path)
+        if entry is None:
+            return None
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT crop_box FROM crop_boxes "
+                "WHERE path = ? AND size = ? AND mtime = ? AND aspect_ratio = ?",
+                (image_path, entry['size'], entry['mtime'],
+                 format_aspect_ratio(aspect_ratio))).fetchone()
+        return tuple(json.loads(row[0])) if row else None
+
+    def put_crop_box(self, image_path, aspect_ratio, crop_box) -> None:
+        """Records the crop box of the current version of the given image for
+        the given aspect ratio."""
+        entry = self.image_index.get_entry(image_path)
+        if entry is None:
+            return
+        with self.lock, self.connection:
+            # Drop crop boxes of earlier versions of the image.
+            self.connection.execute(
+                "DELETE FROM crop_boxes WHERE path = ? AND (size != ? OR mtime != ?)",
+                (image_path, entry['size'], entry['mtime']))
+            self.connection.execute(
+                "INSERT OR REPLACE INTO crop_boxes "
+                "(path, size, mtime, aspect_ratio, crop_box) VALUES (?, ?, ?, ?, ?)",
+                (image_path, entry['size'], entry['mtime'],
+                 format_aspect_ratio(aspect_ratio), json.dumps(list(crop_box))))
+
+    def get_uncrawled_paths(self) -> list:
+        """Returns the indexed images that have no up-to-date record."""
+        crawled_paths = self.get_all()
+        return [image_path for image_path in self.image_index.get_paths()
+                if image_path not in crawled_paths]
+
+    def crawl(self) -> int:
+        """Records the metadata of every image without an up-to-date record.
+
+        Returns the number of images crawled.
+        """
+        self.image_index.ensure_built()
+        num_crawled = 0
+        records = []
+        for image_path in self.get_uncrawled_paths():
+            entry = self.image_index.get_entry(image_path)
+            if entry is None:
+                continue
+            try:
+                with metrics.span('metadata_crawl'):
+                    metadata = read_image_metadata(
+                        image_path, self.display_config.config['decode'],
+                        self.display_config.config['retrieval']['source_timeout_secs'])
+            except ImageRejected as e:
+                self.image_index.mark_rejected(image_path, str(e))
+                continue
+            except ImageSourceUnavailable as e:
+                # Try again on the next crawl, rather than waiting out the
+                # timeout for every image.
+                self.logger.error(f"Stopped crawling metadata: {e}")
+                break
+            except (OSError, SyntaxError, ValueError) as e:
+                self.logger.error(f"Failed to read the metadata of {image_path}: {e}")
+                continue
+            records.append((image_path, entry, metadata))
+            num_crawled += 1
+            if len(records) == CRAWL_BATCH_SIZE:
+                self.put_many(records)
+                records = []
+        if records:
+            self.put_many(records)
+        if num_crawled:
+            self.logger.info("Crawled the metadata of %s images.", num_crawled)
+        return num_crawled
+
+    def crawl_in_background(self) -> None:
+        """Crawls new images whenever the image index changes, at low priority."""
+        lower_thread_priority(self.logger, self.metadata_config['crawler_niceness'])
+        crawled_generation = None
+        while True:
+            if crawled_generation != self.image_index.generation:
+                crawled_generation = self.image_index.generation
+                self.crawl()
+            time.sleep(self.metadata_config['crawl_poll_secs'])
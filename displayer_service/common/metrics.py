@@ -0,0 +1,191 @@
+"""Provides lightweight timing spans, gauges and counters, and their export.
+
+Metrics are recorded into the process-wide `metrics` registry, similar to how
+`logging` works. Recording only updates in-memory aggregates, so it's cheap
+enough to leave on in production. Exporting happens periodically on a
+background thread:
+- A Prometheus textfile (for node_exporter's textfile collector) with the
+  aggregates.
+- A rolling JSONL trace with one line per recorded span.
+"""
+import collections
+import contextlib
+import json
+import os
+import threading
+import time
+
+from logging import Logger
+from typing import Dict
+
+from common.display_config import DisplayConfig
+
+
+METRIC_NAME_PREFIX = "ink_memories"
+# Caps the spans held in memory between exports.
+MAX_PENDING_TRACE_RECORDS = 10000
+
+
+class SpanStats:
+    """Aggregate timings of one kind of span."""
+    __slots__ = ('count', 'total_secs', 'max_secs', 'last_secs')
+
+    def __init__(self):
+        self.count = 0
+        self.total_secs = 0.0
+        self.max_secs = 0.0
+        self.last_secs = 0.0
+
+
+class Metrics:
+    """Registry of timing spans, gauges and counters."""
+
+    def __init__(self):
+        # Protects everything below.
+        self.lock = threading.Lock()
+        self.span_stats: Dict[str, SpanStats] = {}
+        self.gauges: Dict[str, float] = {}
+        self.counters: Dict[str, float] = {}
+        # Spans recorded since the trace was last written out.
+        self.pending_trace_records = collections.deque(
+            maxlen=MAX_PENDING_TRACE_RECORDS)
+
+    @contextlib.contextmanager
+    def span(self, name):
+        """Times the enclosed block as a span with the given name."""
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_span(name, time.perf_counter() - start_time)
+
+    def record_span(self, name, duration_secs) -> None:
+        with self.lock:
+            stats = self.span_stats.get(name)
+            if stats is None:
+                stats = self.span_stats[name] = SpanStats()
+            stats.count += 1
+            stats.total_secs += duration_secs
+            stats.max_secs = max(stats.max_secs, duration_secs)
+            stats.last_secs = duration_secs
+            self.pending_trace_records.append(
+                (time.time(), name, duration_secs, threading.current_thread().name))
+
+    def set_gauge(self, name, value) -> None:
+        with self.lock:
+            self.gauges[name] = value
+
+    def increment(self, name, amount=1) -> None:
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def get_counter(self, name) -> float:
+        with self.lock:
+            return self.counters.get(name, 0)
+
+    def reset(self) -> None:
+        """Discards everything recorded so far."""
+        with self.lock:
+            self.span_stats.clear()
+            self.gauges.clear()
+            self.counters.clear()
+            self.pending_trace_records.clear()
+
+    def to_prometheus(self) -> str:
+        """Returns the aggregates in the Prometheus text exposition format."""
+        with self.lock:
+            span_stats = {name: (stats.count, stats.total_secs, stats.max_secs, stats.last_secs)
+                          for name, stats in self.span_stats.items()}
+            gauges = dict(self.gauges)
+            counters = dict(self.counters)
+
+        lines = []
+        if span_stats:
+            span_metric = f"{METRIC_NAME_PREFIX}_span_seconds"
+            lines.append(f"# TYPE {span_metric} summary")
+            for name, (count, total_secs, _, _) in sorted(span_stats.items()):
+                lines.append(f'{span_metric}_count{{span="{name}"}} {count}')
+                lines.append(f'{span_metric}_sum{{span="{name}"}} {total_secs:.6f}')
+            for suffix, stat_index in [('max', 2), ('last', 3)]:
+                lines.append(f"# TYPE {span_metric}_{suffix} gauge")
+                for name, stats in sorted(span_stats.items()):
+                    lines.append(
+                        f'{span_metric}_{suffix}{{span="{name}"}} {stats[stat_index]:.6f}')
+        for name, value in sorted(gauges.items()):
+            lines.append(f"# TYPE {METRIC_NAME_PREFIX}_{name} gauge")
+            lines.append(f"{METRIC_NAME_PREFIX}_{name} {value}")
+        for name, value in sorted(counters.items()):
+            lines.append(f"# TYPE {METRIC_NAME_PREFIX}_{name}_total counter")
+            lines.append(f"{METRIC_NAME_PREFIX}_{name}_total {value}")
+        return "\n".join(lines) + "\n"
+
+    def take_trace_records(self) -> list:
+        """Removes and returns the spans recorded since the last call."""
+        with self.lock:
+            trace_records = list(self.pending_trace_records)
+            self.pending_trace_records.clear()
+        return trace_records
+
+
+# The process-wide metrics registry.
+metrics = Metrics()
+
+
+class MetricsExporter:
+    """Periodically exports the metrics registry to disk."""
+    logger: Logger
+    display_config: DisplayConfig
+
+    def __init__(self, logger, display_config, registry=metrics):
+        self.logger = logger
+        self.display_config = display_config
+        self.registry = registry
+
+    @property
+    def metrics_config(self) -> dict:
+        return self.display_config.config['metrics']
+
+    def export(self) -> None:
+        """Writes the Prometheus textfile and appends to the JSONL trace."""
+        self.write_prometheus_textfile()
+        self.append_trace()
+
+    def write_prometheus_textfile(self) -> None:
+        textfile_path = self.metrics_config['prometheus_textfile_path']
+        # The textfile collector may read at any time, so never expose a
+        # partially written file.
+        tmp_textfile_path = f"{textfile_path}.tmp"
+        try:
+            with open(tmp_textfile_path, 'w', encoding='utf-8') as textfile:
+                textfile.write(self.registry.to_prometheus())
+            os.replace(tmp_textfile_path, textfile_path)
+        except OSError as e:
+            self.logger.error(f"Failed to write metrics textfile: {e}")
+
+    def append_trace(self) -> None:
+        """Appends recorded spans to the trace, rolling it over when too big."""
+        trace_records = self.registry.take_trace_records()
+        if not trace_records:
+            return
+
+        trace_file_path = self.metrics_config['trace_file_path']
+        try:
+            if os.path.exists(trace_file_path) and \
+                    os.path.getsize(trace_file_path) >= self.metrics_config['trace_max_bytes']:
+                os.replace(trace_file_path, f"{trace_file_path}.1")
+            with open(trace_file_path, 'a', encoding='utf-8') as trace_file:
+                for timestamp, name, duration_secs, thread_name in trace_records:
+                    trace_file.write(json.dumps({
+                        'ts': round(timestamp, 6),
+                        'span': name,
+                        'secs': round(duration_secs, 6),
+                        'thread': thread_name,
+                    }) + "\n")
+        except OSError as e:
+            self.logger.error(f"Failed to write metrics trace: {e}")
+
+    def export_in_background(self) -> None:
+        """Periodically exports the metrics."""
+        while True:
+            time.sleep(self.metrics_config['export_period_secs'])
+            self.export()
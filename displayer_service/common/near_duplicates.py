@@ -0,0 +1,206 @@
+"""Provides detection of near-duplicate images, by their perceptual hashes."""
+import threading
+
+from logging import Logger
+from typing import Dict, Iterable, List, Optional
+
+from common.display_config import DisplayConfig
+from common.metadata_store import MetadataStore
+
+
+def hamming_distance(hash_a, hash_b) -> int:
+    """Returns the number of bits the two hashes differ in."""
+    return bin(hash_a ^ hash_b).count('1')
+
+
+class BKTree:
+    """Burkhard-Keller tree of perceptual hashes, under the Hamming distance.
+
+    Each node's children are keyed by their distance to it. By the triangle
+    inequality, a search only needs to descend into the children whose key is
+    within `max_distance` of the query's distance to the node, so lookups of
+    small distances visit O(log n) nodes in practice.
+    """
+
+    def __init__(self):
+        # Nodes are [hash, items with that hash, {distance: child node}].
+        self.root = None
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, image_hash, item) -> None:
+        """Adds an item with the given hash."""
+        self.size += 1
+        if self.root is None:
+            self.root = [image_hash, [item], {}]
+            return
+        node = self.root
+        while True:
+            distance = hamming_distance(image_hash, node[0])
+            if distance == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [image_hash, [item], {}]
+                return
+            node = child
+
+    def find(self, image_hash, max_distance) -> List[tuple]:
+        """Returns (distance, item) for every item within `max_distance` of
+        the given hash."""
+        matches = []
+        nodes = [self.root] if self.root is not None else []
+        while nodes:
+            node_hash, items, children = nodes.pop()
+            distance = hamming_distance(image_hash, node_hash)
+            if distance <= max_distance:
+                matches.extend((distance, item) for item in items)
+            for child_distance, child in children.items():
+                if abs(child_distance - distance) <= max_distance:
+                    nodes.append(child)
+        return matches
+
+
+class NearDuplicateFilter:
+    """Tells the schedulers which images to skip as near-duplicates.
+
+    An image is suppressed if an image whose perceptual hash is within
+    `max_distance` of its own was picked in the last `suppression_window`
+    picks. The hashes come from the metadata store, so images that haven't
+    been hashed yet, by the crawler or a render, are never suppressed.
+    """
+    logger: Logger
+    display_config: DisplayConfig
+    metadata_store: MetadataStore
+
+    def __init__(self, logger, display_config, metadata_store):
+        self.logger = logger
+        self.display_config = display_config
+        self.metadata_store = metadata_store
+
+        # Protects all of the state below.
+        self.lock = threading.Lock()
+        self.tree = BKTree()
+        self.hashes: Dict[str, int] = {}
+        # The (size, mtime) of the version of each image that was hashed.
+        self.hashed_versions: Dict[str, tuple] = {}
+        # The image index generation that the tree was last checked against.
+        self.synced_index_generation = None
+        # Number of picks recorded so far, and the pick number each image was
+        # last picked at.
+        self.num_picks = 0
+        self.last_picked: Dict[str, int] = {}
+
+        # Records put in the metadata store since the last sync. Kept apart
+        # from `lock`, so that the crawler never waits on a sync.
+        self.new_records_lock = threading.Lock()
+        self.new_records = []
+        self.metadata_store.add_listener(self.on_records_put)
+
+    @property
+    def near_duplicates_config(self) -> dict:
+        return self.display_config.config['near_duplicates']
+
+    def on_records_put(self, records) -> None:
+        with self.new_records_lock:
+            self.new_records.extend(records)
+
+    def sync(self) -> None:
+        """Brings the tree up to date with the metadata store. Expects `lock`
+        to be held.
+
+        Newly crawled images are added to the tree as is. The tree is only
+        rebuilt when images drop out of the store, i.e. when they're removed
+        from the index or change (and so get a new hash).
+        """
+        with self.new_records_lock:
+            new_records, self.new_records = self.new_records, []
+        index_generation = self.metadata_store.image_index.generation
+        if self.synced_index_generation != index_generation:
+            self.synced_index_generation = index_generation
+            if not self.hashed_versions or self.has_dropped_images():
+                self.rebuild()
+        for image_path, entry, metadata in new_records:
+            if metadata.get('dhash') is None:
+                continue
+            image_hash = int(metadata['dhash'], 16)
+            if image_path in self.hashes:
+                if self.hashes[image_path] != image_hash:
+                    self.rebuild()
+                    break
+                continue
+            self.add(image_path, image_hash, (entry['size'], entry['mtime']))
+
+    def has_dropped_images(self) -> bool:
+        """Whether any hashed image has since been removed or changed."""
+        entries = self.metadata_store.image_index.get_entries()
+        for image_path, version in self.hashed_versions.items():
+            entry = entries.get(image_path)
+            if entry is None or (entry['size'], entry['mtime']) != version:
+                return True
+        return False
+
+    def rebuild(self) -> None:
+        """Rebuilds the tree from the whole metadata store."""
+        self.hashes = {}
+        self.hashed_versions = {}
+        self.tree = BKTree()
+        entries = self.metadata_store.image_index.get_entries()
+        for image_path, metadata in self.metadata_store.get_all().items():
+            entry = entries.get(image_path)
+            if metadata.get('dhash') is None or entry is None:
+                continue
+            self.add(image_path, int(metadata['dhash'], 16), (entry['size'], entry['mtime']))
+        self.logger.info("Indexed the perceptual hashes of %s images.", len(self.hashes))
+
+    def add(self, image_path, image_hash, version) -> None:
+        self.hashes[image_path] = image_hash
+        self.hashed_versions[image_path] = version
+        self.tree.add(image_hash, image_path)
+
+    def find_near_duplicates(self, image_path) -> List[str]:
+        """Returns the other images that are near-duplicates of the given one."""
+        with self.lock:
+            self.sync()
+            return self._find_near_duplicates(image_path)
+
+    def _find_near_duplicates(self, image_path) -> List[str]:
+        image_hash = self.hashes.get(image_path)
+        if image_hash is None:
+            return []
+        return [other_path for _, other_path in
+                self.tree.find(image_hash, self.near_duplicates_config['max_distance'])
+                if other_path != image_path]
+
+    def is_suppressed(self, image_path, upcoming_paths: Optional[Iterable[str]] = None) -> bool:
+        """Whether the given image is a near-duplicate of a recent pick.
+
+        `upcoming_paths` are picks that have been decided but not yet recorded,
+        which count as the most recent picks.
+        """
+        if not self.near_duplicates_config['enabled']:
+            return False
+        window = self.near_duplicates_config['suppression_window']
+        upcoming_paths = set(upcoming_paths or ())
+        with self.lock:
+            self.sync()
+            for other_path in self._find_near_duplicates(image_path):
+                last_picked = self.last_picked.get(other_path)
+                if other_path in upcoming_paths or \
+                        (last_picked is not None and self.num_picks - last_picked <= window):
+                    return True
+        return False
+
+    def record_pick(self, image_path) -> None:
+        """Records that the given image has been picked."""
+        with self.lock:
+            self.last_picked[image_path] = self.num_picks
+            self.num_picks += 1
+            # Forget picks that have dropped out of any window.
+            if len(self.last_picked) > 2 * self.near_duplicates_config['suppression_window']:
+                self.last_picked = {
+                    path: pick for path, pick in self.last_picked.items()
+                    if self.num_picks - pick <= self.near_duplicates_config['suppression_window']}
@@ -0,0 +1,368 @@
+"""Provides background prefetching of rendered frames."""
+import collections
+import threading
+import time
+
+from logging import Logger
+from typing import Optional
+from PIL import Image
+from PIL.Image import Image as ImageType
+
+from common.decoders import ImageRejected
+from common.display_config import DisplayConfig
+from common.display_state import DisplayState
+from common.frame_renderer import FrameRenderer
+from common.image_retriever import ImageRetriever
+from common.image_source import ImageSourceUnavailable
+from common.metrics import metrics
+
+
+# Errors PIL raises on corrupt or truncated images, or malformed metadata.
+# Raised while rendering an image file that was read fine, they mean the
+# image itself is bad, so it's rejected rather than retried.
+DECODE_ERRORS = (OSError, SyntaxError, ValueError)
+# Images rejected in a row before backing off, in case rejecting them doesn't
+# stop them from being picked again.
+MAX_REJECTIONS_IN_A_ROW = 10
+
+class BufferedFrame:
+    """Compact record of a display-ready frame waiting in the buffer.
+
+    Holds the frame as raw palettized pixel data rather than as a PIL image,
+    so that the memory each buffered frame costs is known up front.
+    """
+    __slots__ = ('source_path', 'exif_date', 'frame_key', 'size',
+                 'frame_bytes', 'palette')
+
+    def __init__(self, source_path, exif_date, frame_key, size, frame_bytes, palette):
+        self.source_path = source_path
+        self.exif_date = exif_date
+        self.frame_key = frame_key
+        self.size = size
+        self.frame_bytes = frame_bytes
+        self.palette = palette
+
+    @classmethod
+    def from_frame(cls, source_path, frame: ImageType):
+        """Packs a "P" mode frame from the frame renderer into a record."""
+        return cls(source_path, frame.info.get('exif_date'),
+                   frame.info.get('frame_key'), frame.size, frame.tobytes(),
+                   bytes(frame.getpalette()))
+
+    @property
+    def nbytes(self) -> int:
+        """Returns the number of bytes of image data held by this record."""
+        return len(self.frame_bytes) + len(self.palette)
+
+    def to_image(self) -> ImageType:
+        """Unpacks the record into a "P" mode PIL image."""
+        frame = Image.frombytes('P', self.size, self.frame_bytes)
+        frame.putpalette(self.palette)
+        if self.exif_date:
+            frame.info['exif_date'] = self.exif_date
+        if self.frame_key:
+            frame.info['frame_key'] = self.frame_key
+        return frame
+
+
+class Prefetcher:
+    """Keeps a memory-budgeted buffer of display-ready frames topped up.
+
+    A fixed pool of worker threads retrieves and renders images ahead of
+    time, so taking the next frame never waits on the image source or on
+    image processing (unless the buffer has run dry).
+
+    The buffer is refilled in bursts: once the bytes it holds drain to the low
+    watermark, workers fill it back up to the memory budget and then go idle.
+
+    While the image source is unavailable (e.g. the network or rclone is
+    down), frames are drawn at random from the frame cache instead, and the
+    image source is only retried with exponential backoff.
+    """
+    logger: Logger
+    display_config: DisplayConfig
+    image_retriever: ImageRetriever
+    frame_renderer: FrameRenderer
+    display_state: Optional[DisplayState]
+
+    def __init__(self, logger, display_config, image_retriever, frame_renderer,
+                 display_state=None):
+        self.logger = logger
+        self.display_config = display_config
+        self.image_retriever = image_retriever
+        self.frame_renderer = frame_renderer
+        # If given, the buffer's manifest is persisted so that the buffer can
+        # be restored after a restart.
+        self.display_state = display_state
+        # Serialises writes of the buffer manifest. Never acquired while
+        # holding `condition`.
+        self.manifest_lock = threading.Lock()
+
+        # Protects all of the buffer state below. Notified whenever a frame
+        # is added to or taken from the buffer.
+        self.condition = threading.Condition()
+        self.buffer = collections.deque()
+        # Total `nbytes` of the frames in the buffer.
+        self.buffer_bytes = 0
+        # Number of frames currently being prefetched by the workers.
+        self.num_in_flight = 0
+        # Whether the workers should be refilling the buffer.
+        self.is_filling = True
+        # Until when (in `time.monotonic()` seconds) the image source is
+        # considered unavailable, and how long to wait on its next failure.
+        self.source_offline_until = 0.0
+        self.source_offline_backoff_secs = self.prefetch_config['initial_backoff_secs']
+
+        self.stop_event = threading.Event()
+        self.workers = []
+
+    @property
+    def prefetch_config(self) -> dict:
+        return self.display_config.config['prefetch']
+
+    def start(self) -> None:
+        """Starts the prefetch worker pool."""
+        for worker_num in range(self.prefetch_config['num_workers']):
+            worker = threading.Thread(target=self.run_worker,
+                                      name=f"prefetch-worker-{worker_num}",
+                                      daemon=True)
+            worker.start()
+            self.workers.append(worker)
+        self.logger.info("Started %s prefetch workers.", len(self.workers))
+
+    def stop(self) -> None:
+        """Signals the prefetch workers to exit."""
+        self.stop_event.set()
+        with self.condition:
+            self.condition.notify_all()
+
+    def qsize(self) -> int:
+        """Returns the number of frames ready in the buffer."""
+        with self.condition:
+            return len(self.buffer)
+
+    def update_buffer_gauges(self) -> None:
+        """Publishes the buffer's size. Expects `condition` to be held."""
+        metrics.set_gauge('frame_buffer_frames', len(self.buffer))
+        metrics.set_gauge('frame_buffer_bytes', self.buffer_bytes)
+
+    @property
+    def estimated_frame_bytes(self) -> int:
+        """Returns the expected `nbytes` of a buffered frame."""
+        width, height = self.frame_renderer.resolution
+        # One byte per pixel, plus at most a 256 colour RGB palette.
+        return width * height + 256 * 3
+
+    def get(self, timeout=None) -> Optional[BufferedFrame]:
+        """Takes the next frame from the buffer.
+
+        Blocks until a frame is available, or returns None if `timeout`
+        seconds pass first.
+        """
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.buffer, timeout):
+                return None
+            buffered_frame = self.buffer.popleft()
+            self.buffer_bytes -= buffered_frame.nbytes
+            if self.buffer_bytes <= self.prefetch_config['low_watermark_bytes']:
+                self.is_filling = True
+            self.update_buffer_gauges()
+            self.condition.notify_all()
+        self.save_manifest()
+        return buffered_frame
+
+    def put(self, buffered_frame: BufferedFrame) -> None:
+        """Adds a frame to the back of the buffer."""
+        with self.condition:
+            self.buffer.append(buffered_frame)
+            self.buffer_bytes += buffered_frame.nbytes
+            self.update_buffer_gauges()
+            self.condition.notify_all()
+        self.save_manifest()
+
+    def save_manifest(self) -> None:
+        """Persists the list of frames currently in the buffer."""
+        if self.display_state is None:
+            return
+        with self.manifest_lock:
+            with self.condition:
+                manifest = [{
+                    'source_path': buffered_frame.source_path,
+                    'frame_key': buffered_frame.frame_key,
+                } for buffered_frame in self.buffer]
+            self.display_state.save_buffer_manifest(manifest)
+
+    def restore_buffer(self) -> None:
+        """Refills the buffer with the frames listed in the persisted manifest.
+
+        Frames are read back from the frame cache, so this never touches the
+        image source. Frames that have since been evicted are skipped.
+        """
+        if self.display_state is None:
+            return
+        num_restored = 0
+        for entry in self.display_state.load_buffer_manifest():
+            if self.buffer_bytes + self.estimated_frame_bytes > \
+                    self.prefetch_config['max_buffer_bytes']:
+                break
+            frame = self.frame_renderer.frame_cache.get(entry['frame_key'])
+            if frame is None:
+                continue
+            frame.info['frame_key'] = entry['frame_key']
+            with self.condition:
+                buffered_frame = BufferedFrame.from_frame(
+                    entry['source_path'], frame)
+                self.buffer.append(buffered_frame)
+                self.buffer_bytes += buffered_frame.nbytes
+                self.update_buffer_gauges()
+            num_restored += 1
+        self.logger.info("Restored %s frames into the frame buffer.", num_restored)
+
+    def claim_prefetch_slot(self) -> bool:
+        """Blocks until the buffer has room for another frame and claims it.
+
+        Returns False if the prefetcher was stopped instead.
+        """
+        with self.condition:
+            while not self.stop_event.is_set():
+                if self.is_filling:
+                    claimed_bytes = self.buffer_bytes + \
+                        (self.num_in_flight + 1) * self.estimated_frame_bytes
+                    if claimed_bytes <= self.prefetch_config['max_buffer_bytes']:
+                        self.num_in_flight += 1
+                        return True
+                    self.is_filling = False
+                self.condition.wait()
+            return False
+
+    def run_worker(self) -> None:
+        """Prefetches frames whenever the buffer needs them."""
+        while self.claim_prefetch_slot():
+            buffered_frame = self.prefetch_frame_with_retries()
+            with self.condition:
+                self.num_in_flight -= 1
+                if buffered_frame is not None:
+                    self.buffer.append(buffered_frame)
+                    self.buffer_bytes += buffered_frame.nbytes
+                    self.logger.info("Prefetched a frame. Buffer holds %s frames (%s bytes).",
+                                     len(self.buffer), self.buffer_bytes)
+                    self.update_buffer_gauges()
+                self.condition.notify_all()
+            if buffered_frame is not None:
+                self.save_manifest()
+
+    def prefetch_frame_with_retries(self) -> Optional[BufferedFrame]:
+        """Prefetches a frame, retrying with exponential backoff on failure.
+
+        Falls back to a cached frame while the image source is unavailable.
+        Returns None only if the prefetcher was stopped.
+        """
+        backoff_secs = self.prefetch_config['initial_backoff_secs']
+        num_rejections = 0
+        while not self.stop_event.is_set():
+            if not self.is_source_offline():
+                try:
+                    buffered_frame = self.prefetch_frame()
+                    self.mark_source_online()
+                    return buffered_frame
+                except ImageSourceUnavailable as e:
+                    self.mark_source_offline(e)
+                except ImageRejected:
+                    # The image has been set aside, so move on to the next.
+                    num_rejections += 1
+                    if num_rejections < MAX_REJECTIONS_IN_A_ROW:
+                        continue
+                    num_rejections = 0
+                    metrics.increment('prefetch_failures')
+                    self.logger.info(
+                        "Rejected %s images in a row. Retrying in %s seconds.",
+                        MAX_REJECTIONS_IN_A_ROW, backoff_secs)
+                    self.stop_event.wait(backoff_secs)
+                    backoff_secs = min(backoff_secs * 2,
+                                       self.prefetch_config['max_backoff_secs'])
+                    continue
+                except Exception as e:
+                    metrics.increment('prefetch_failures')
+                    self.logger.error(e)
+                    self.logger.info(
+                        "Failed to prefetch a frame. Retrying in %s seconds.", backoff_secs)
+                    self.stop_event.wait(backoff_secs)
+                    backoff_secs = min(backoff_secs * 2,
+                                       self.prefetch_config['max_backoff_secs'])
+                    continue
+
+            buffered_frame = self.prefetch_cached_frame()
+            if buffered_frame is not None:
+                return buffered_frame
+            metrics.increment('prefetch_failures')
+            self.logger.info(
+                "No cached frames to show while the image source is unavailable. "
+                "Retrying in %s seconds.", backoff_secs)
+            self.stop_event.wait(backoff_secs)
+            backoff_secs = min(backoff_secs * 2,
+                               self.prefetch_config['max_backoff_secs'])
+        return None
+
+    def is_source_offline(self) -> bool:
+        with self.condition:
+            return time.monotonic() < self.source_offline_until
+
+    def mark_source_offline(self, error) -> None:
+        """Stops using the image source for a while after it failed."""
+        with self.condition:
+            offline_secs = self.source_offline_backoff_secs
+            self.source_offline_until = time.monotonic() + offline_secs
+            self.source_offline_backoff_secs = min(
+                offline_secs * 2, self.prefetch_config['max_backoff_secs'])
+        metrics.set_gauge('image_source_available', 0)
+        self.logger.error(error)
+        self.logger.info("Using cached frames for %s seconds.", offline_secs)
+
+    def mark_source_online(self) -> None:
+        with self.condition:
+            was_offline = self.source_offline_until > 0
+            self.source_offline_until = 0.0
+            self.source_offline_backoff_secs = self.prefetch_config['initial_backoff_secs']
+        metrics.set_gauge('image_source_available', 1)
+        if was_offline:
+            self.logger.info("The image source is available again.")
+
+    def prefetch_cached_frame(self) -> Optional[BufferedFrame]:
+        """Returns a random frame from the frame cache, other than those
+        already in the buffer, or None if there isn't one."""
+        with self.condition:
+            buffered_keys = {buffered_frame.frame_key for buffered_frame in self.buffer}
+        frame_cache = self.frame_renderer.frame_cache
+        for frame_key in frame_cache.sample_keys(3, exclude=buffered_keys):
+            frame = frame_cache.get(frame_key)
+            if frame is None:
+                continue
+            frame.info['frame_key'] = frame_key
+            metrics.increment('cached_frames_prefetched')
+            return BufferedFrame.from_frame(
+                frame.info.get('source_path', frame_key), frame)
+        return None
+
+    def prefetch_frame(self) -> BufferedFrame:
+        """Retrieves a random image and renders it into a buffered frame.
+
+        Raises `ImageRejected`, having set the image aside, if the image was
+        retrieved but can't be rendered.
+        """
+        with metrics.span('prefetch_frame'):
+            image_path = self.image_retriever.choose_next_image_path()
+            image_file = self.image_retriever.fetch_image_file(image_path)
+            try:
+                frame = self.frame_renderer.render(image_file, image_path)
+            except ImageRejected as e:
+                self.image_retriever.reject_image(image_path, str(e))
+                raise
+            except ImageSourceUnavailable:
+                raise
+            except DECODE_ERRORS as e:
+                reason = f"Failed to decode the image: {e}"
+                self.image_retriever.reject_image(image_path, reason)
+                raise ImageRejected(reason) from e
+            finally:
+                self.image_retriever.clean_up_image_file(image_file)
+            return BufferedFrame.from_frame(image_path, frame)
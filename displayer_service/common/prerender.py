@@ -0,0 +1,157 @@
+"""Provides batch pre-rendering of the whole album into the frame cache."""
+import concurrent.futures
+import io
+import shutil
+import time
+
+from logging import Logger
+from typing import Callable, Optional
+from PIL import Image
+
+from common.decoders import ImageRejected, plan_decode
+from common.display_config import DisplayConfig
+from common.frame_cache import FrameCache, digest_image_file, make_frame_key
+from common.frame_renderer import get_render_options
+from common.image_index import ImageIndex
+from common.metadata_store import HEADER_READ_BYTES
+from common.render_backends import get_worker_context, render_frame_from_file
+
+
+# Outcomes of pre-rendering an image.
+RENDERED = 'rendered'
+CACHED = 'cached'
+REJECTED = 'rejected'
+FAILED = 'failed'
+
+# Frame cache keys that already exist, as seen by each worker process.
+_cached_keys = frozenset()
+
+
+def _init_worker(cached_keys) -> None:
+    global _cached_keys
+    _cached_keys = cached_keys
+
+
+def prerender_image(image_path, resolution, render_options, decode_config) -> tuple:
+    """Renders the given image, unless its frame is already cached.
+
+    Runs in a worker process. The image is checked against the decode budget
+    from its header first, so that rejected images are never read in full.
+    Otherwise it's read from the image source once, then both digested and
+    rendered from memory. Returns (status, frame key, frame), where the frame
+    is only given if it was rendered, as (size, pixel bytes, palette, EXIF
+    date), or else (status, error, None) if it was rejected (see `decoders`)
+    or failed.
+    """
+    try:
+        with open(image_path, 'rb') as image_file:
+            header_bytes = image_file.read(HEADER_READ_BYTES)
+            try:
+                max_decode_pixels = plan_decode(io.BytesIO(header_bytes), decode_config)
+            except (OSError, SyntaxError):
+                if len(header_bytes) < HEADER_READ_BYTES:
+                    raise
+                # The header doesn't fit, so check the whole file once read.
+                max_decode_pixels = None
+            image_bytes = io.BytesIO()
+            image_bytes.write(header_bytes)
+            shutil.copyfileobj(image_file, image_bytes)
+        image_bytes.seek(0)
+        if max_decode_pixels is None:
+            max_decode_pixels = plan_decode(image_bytes, decode_config)
+        frame_key = make_frame_key(digest_image_file(image_bytes), resolution, render_options)
+        if frame_key in _cached_keys:
+            return (CACHED, frame_key, None)
+        frame = render_frame_from_file(image_bytes, resolution,
+                                       dict(render_options, max_decode_pixels=max_decode_pixels))
+    except ImageRejected as e:
+        return (REJECTED, str(e), None)
+    except Exception as e:
+        return (FAILED, str(e), None)
+    return (RENDERED, frame_key,
+            (frame.size, frame.tobytes(), frame.getpalette(), frame.info.get('exif_date')))
+
+
+def prerender_album(logger: Logger, display_config: DisplayConfig, resolution,
+                    num_processes, on_progress: Optional[Callable] = None) -> dict:
+    """Renders every indexed image into the frame cache, in a process pool.
+
+    The image index is re-synced with the image source first, read-only, as
+    the service owns the index file. Images whose frames are already cached
+    are skipped, and images that are rejected (see `decoders`) are set aside
+    for the rest of the run. `on_progress` is called with
+    (number done, number of images, image path, status) as each image is
+    finished.
+
+    Returns the run's stats: the number of images rendered, already cached,
+    rejected and failed, and the throughput.
+    """
+    resolution = tuple(resolution)
+    render_options = get_render_options(display_config)
+    frame_cache = FrameCache(logger, display_config)
+    image_index = ImageIndex(logger, display_config, read_only=True)
+    image_index.refresh()
+    image_paths = sorted(image_index.get_paths())
+
+    decode_config = display_config.config['decode']
+    stats = {RENDERED: 0, CACHED: 0, REJECTED: 0, FAILED: 0}
+    rendered_keys = []
+    start_time = time.monotonic()
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=num_processes, mp_context=get_worker_context(),
+            initializer=_init_worker,
+            initargs=(frozenset(frame_cache.frame_sizes),)) as executor:
+        # Keep only a couple of images per process in flight, so that the
+        # rendered frames waiting to be cached don't pile up in memory.
+        max_in_flight = 2 * num_processes
+        pending_paths = iter(image_paths)
+        in_flight = {}
+        num_done = 0
+        while True:
+            for image_path in pending_paths:
+                in_flight[executor.submit(prerender_image, image_path, resolution,
+                                          render_options, decode_config)] = image_path
+                if len(in_flight) >= max_in_flight:
+                    break
+            if not in_flight:
+                break
+            done_futures, _ = concurrent.futures.wait(
+                in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done_futures:
+                image_path = in_flight.pop(future)
+                status, frame_key, frame_data = future.result()
+                if status == RENDERED:
+                    frame_size, frame_bytes, palette, exif_date = frame_data
+                    frame = Image.frombytes('P', frame_size, frame_bytes)
+                    frame.putpalette(palette)
+                    if exif_date:
+                        frame.info['exif_date'] = exif_date
+                    frame.info['source_path'] = image_path
+                    frame_cache.put(frame_key, frame)
+                    rendered_keys.append(frame_key)
+                elif status == REJECTED:
+                    image_index.mark_rejected(image_path, frame_key)
+                elif status == FAILED:
+                    logger.error(f"Failed to pre-render {image_path}: {frame_key}")
+                stats[status] += 1
+                num_done += 1
+                if on_progress is not None:
+                    on_progress(num_done, len(image_paths), image_path, status)
+
+    elapsed_secs = time.monotonic() - start_time
+    num_evicted = sum(1 for frame_key in rendered_keys if frame_key not in frame_cache)
+    if num_evicted:
+        logger.warning(
+            f"The album doesn't fit in the frame cache, so {num_evicted} of the frames "
+            "rendered were evicted again. Raise frame_cache.max_size_bytes to keep them.")
+    return {
+        'num_images': len(image_paths),
+        'num_rendered': stats[RENDERED],
+        'num_cached': stats[CACHED],
+        'num_rejected': stats[REJECTED],
+        'num_failed': stats[FAILED],
+        'num_evicted': num_evicted,
+        'elapsed_secs': round(elapsed_secs, 2),
+        'images_per_sec': round(len(image_paths) / elapsed_secs, 2) if elapsed_secs else 0.0,
+        'rendered_per_sec': round(stats[RENDERED] / elapsed_secs, 2) if elapsed_secs else 0.0,
+    }
@@ -0,0 +1,182 @@
+"""Provides backends that run the image processing pipeline."""
+import concurrent.futures
+import io
+import multiprocessing
+
+from logging import Logger
+from PIL import Image
+from PIL.Image import Image as ImageType
+
+from common import image_processor
+from common.decoders import open_image
+from common.display_config import DisplayConfig
+
+try:
+    from multiprocessing import resource_tracker, shared_memory
+except ImportError:
+    # Shared memory needs Python >= 3.8. Only the process pool backend uses it.
+    shared_memory = None
+
+
+IN_PROCESS_BACKEND = 'in_process'
+PROCESS_POOL_BACKEND = 'process_pool'
+
+
+def get_worker_context() -> multiprocessing.context.BaseContext:
+    """Returns the multiprocessing context to start render workers with.
+
+    Workers aren't forked from the (multi-threaded) caller, since a fork could
+    copy a lock, like the metrics or a logging lock, held by another thread,
+    and deadlock the worker.
+    """
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return multiprocessing.get_context('spawn')
+
+
+def render_frame_from_file(image_file, resolution, render_options,
+                           exif_date=None) -> ImageType:
+    """Renders the given image file or path into a palettized frame.
+
+    `exif_date` is the source image's EXIF date, if already known from the
+    metadata store. Otherwise, it's read from the image. Either way, it's kept
+    in the frame's `info` under 'exif_date'.
+    """
+    with open_image(image_file) as img:
+        if exif_date is None:
+            exif_date = image_processor.get_exif_date(img) or ''
+        frame = image_processor.render_frame(img, resolution, exif_date=exif_date,
+                                             **render_options)
+    if exif_date:
+        frame.info['exif_date'] = exif_date
+    return frame
+
+
+def copy_into_shared_memory(image_file: io.BytesIO) -> tuple:
+    """Copies the given in-memory image file into a new shared memory block.
+
+    Returns the block, and how many bytes of it the image takes. The caller is
+    responsible for closing and unlinking the block.
+    """
+    image_buffer = image_file.getbuffer()
+    try:
+        image_shm = shared_memory.SharedMemory(create=True, size=max(1, len(image_buffer)))
+        image_shm.buf[:len(image_buffer)] = image_buffer
+        return image_shm, len(image_buffer)
+    finally:
+        image_buffer.release()
+
+
+def read_from_shared_memory(image_shm_name, image_size) -> io.BytesIO:
+    """Reads an image file out of the caller's shared memory block (see
+    `copy_into_shared_memory`)."""
+    image_shm = shared_memory.SharedMemory(name=image_shm_name)
+    try:
+        with image_shm.buf[:image_size] as image_view:
+            return io.BytesIO(image_view)
+    finally:
+        image_shm.close()
+
+
+def render_frame_into_shared_memory(image_file, resolution, render_options,
+                                    exif_date=None, image_size=None):
+    """Renders a frame and writes its pixels into a new shared memory block.
+
+    Runs in a worker process. `image_file` is an image path, or else the name
+    of a shared memory block holding `image_size` bytes of an image file.
+    Returns the frame's shared memory block's name along with the frame's
+    size, palette, EXIF date, crop box and the source's dHash. The caller is
+    responsible for unlinking the frame's shared memory block.
+    """
+    if image_size is not None:
+        image_file = read_from_shared_memory(image_file, image_size)
+    frame = render_frame_from_file(image_file, resolution, render_options, exif_date)
+    frame_bytes = frame.tobytes()
+    frame_shm = shared_memory.SharedMemory(create=True, size=len(frame_bytes))
+    frame_shm.buf[:len(frame_bytes)] = frame_bytes
+    frame_shm.close()
+    # Ownership passes to the caller, which unlinks the block. Otherwise this
+    # process' resource tracker would also try to clean it up.
+    resource_tracker.unregister(frame_shm._name, 'shared_memory')
+    return (frame_shm.name, frame.size, frame.getpalette(),
+            frame.info.get('exif_date'), frame.info.get('crop_box'),
+            frame.info.get('dhash'))
+
+
+class InProcessRenderBackend:
+    """Runs the image processing pipeline in the calling thread."""
+
+    def render(self, image_file, resolution, render_options, exif_date=None) -> ImageType:
+        return render_frame_from_file(image_file, resolution, render_options, exif_date)
+
+    def shutdown(self) -> None:
+        pass
+
+
+class ProcessPoolRenderBackend:
+    """Runs the image processing pipeline in a pool of worker processes.
+
+    This keeps the CPU-heavy PIL work off the main interpreter's GIL and
+    spreads it across cores on multi-core Pi models. In-memory image files are
+    handed to the workers, and frames handed back, through shared memory
+    rather than pickled.
+
+    Workers are started as in `get_worker_context`.
+    """
+    logger: Logger
+
+    def __init__(self, logger, num_processes):
+        self.logger = logger
+        self.executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=num_processes, mp_context=get_worker_context())
+        self.logger.info(
+            "Started a render process pool with %s processes.", num_processes)
+
+    def render(self, image_file, resolution, render_options, exif_date=None) -> ImageType:
+        image_shm = image_size = None
+        if isinstance(image_file, io.BytesIO):
+            image_shm, image_size = copy_into_shared_memory(image_file)
+            image_file = image_shm.name
+        try:
+            future = self.executor.submit(render_frame_into_shared_memory, image_file,
+                                          resolution, render_options, exif_date, image_size)
+            frame_shm_name, frame_size, palette, exif_date, crop_box, dhash = \
+                future.result()
+        finally:
+            if image_shm is not None:
+                image_shm.close()
+                image_shm.unlink()
+
+        frame_shm = shared_memory.SharedMemory(name=frame_shm_name)
+        try:
+            width, height = frame_size
+            frame = Image.frombytes('P', frame_size,
+                                    bytes(frame_shm.buf[:width * height]))
+        finally:
+            frame_shm.close()
+            frame_shm.unlink()
+
+        frame.putpalette(palette)
+        if exif_date:
+            frame.info['exif_date'] = exif_date
+        frame.info['crop_box'] = crop_box
+        frame.info['dhash'] = dhash
+        return frame
+
+    def shutdown(self) -> None:
+        self.executor.shutdown()
+
+
+def create_render_backend(logger: Logger, display_config: DisplayConfig):
+    """Returns the render backend selected in the display config."""
+    render_config = display_config.config['render']
+    if render_config['backend'] == PROCESS_POOL_BACKEND:
+        if shared_memory is not None:
+            return ProcessPoolRenderBackend(logger, render_config['num_processes'])
+        logger.error(
+            "The process pool render backend needs Python >= 3.8. Rendering in process.")
+        return InProcessRenderBackend()
+    if render_config['backend'] != IN_PROCESS_BACKEND:
+        logger.error(
+            f"Unknown render backend '{render_config['backend']}'. Rendering in process.")
+    return InProcessRenderBackend()
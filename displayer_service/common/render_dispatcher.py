@@ -0,0 +1,100 @@
+"""Provides a dispatcher that serialises display updates onto one thread."""
+import threading
+
+from logging import Logger
+from typing import Callable, Dict, Optional
+
+
+# Intents that can be submitted to the dispatcher.
+NEXT_IMAGE = 'next_image'
+DEBUG_SCREEN = 'debug_screen'
+LAST_FRAME = 'last_frame'
+SERVER_FRAME = 'server_frame'
+SHUTDOWN = 'shutdown'
+
+
+class RenderDispatcher:
+    """Runs display updates on a single render worker thread.
+
+    Callers (e.g. GPIO button callbacks) only submit intents, which returns
+    immediately. At most one intent is pending at a time:
+    - Submitting a different intent than the pending one cancels the stale
+      pending intent.
+    - Submitting the intent that is already pending or in progress is
+      coalesced into it, so repeated presses don't queue up repeated renders.
+    - Once a shutdown is pending, it can't be cancelled.
+    """
+    logger: Logger
+
+    def __init__(self, logger, handlers: Dict[str, Callable[[], None]]):
+        self.logger = logger
+        # Intent -> function that carries it out.
+        self.handlers = handlers
+
+        # Protects the intent state below.
+        self.condition = threading.Condition()
+        self.pending_intent: Optional[str] = None
+        self.in_progress_intent: Optional[str] = None
+
+        self.worker = threading.Thread(
+            target=self.run, name="render-worker", daemon=True)
+
+    def start(self) -> None:
+        """Starts the render worker."""
+        self.worker.start()
+
+    def submit(self, intent) -> bool:
+        """Requests that the given intent be carried out.
+
+        Returns whether the intent was accepted, as opposed to coalesced into
+        an identical intent or dropped in favour of a pending shutdown.
+        """
+        with self.condition:
+            if self.pending_intent == SHUTDOWN:
+                self.logger.info(
+                    "Ignoring '%s' because a shutdown is pending.", intent)
+                return False
+            if self.pending_intent is not None and self.pending_intent != intent:
+                self.logger.info("Cancelled stale pending '%s' in favour of '%s'.",
+                                 self.pending_intent, intent)
+                self.pending_intent = None
+            if intent in (self.pending_intent, self.in_progress_intent):
+                self.logger.info(
+                    "Coalesced '%s' into an identical render.", intent)
+                return False
+            self.pending_intent = intent
+            self.condition.notify_all()
+            return True
+
+    def has_pending(self) -> bool:
+        """Returns whether an intent is waiting behind the in-progress one.
+
+        Long-running handlers can poll this to abandon work that a newer
+        request has made stale.
+        """
+        with self.condition:
+            return self.pending_intent is not None
+
+    def wait_until_idle(self, timeout=None) -> bool:
+        """Blocks until no intent is pending or in progress."""
+        with self.condition:
+            return self.condition.wait_for(
+                lambda: self.pending_intent is None and self.in_progress_intent is None,
+                timeout)
+
+    def run(self) -> None:
+        """Carries out submitted intents, one at a time."""
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.pending_intent is not None)
+                intent = self.in_progress_intent = self.pending_intent
+                self.pending_intent = None
+
+            try:
+                self.handlers[intent]()
+            except Exception:
+                self.logger.exception("Failed to carry out '%s'.", intent)
+            finally:
+                with self.condition:
+                    self.in_progress_intent = None
+                    self.condition.notify_all()
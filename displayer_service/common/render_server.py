@@ -0,0 +1,307 @@
+"""Provides a server of rendered frames, and a client for displays to use it.
+
+Several displays sharing one album can leave the retrieval and rendering to
+one host. The server renders frames for each panel resolution that asks for
+them and serves them over HTTP:
+
+- `GET /frames/<width>x<height>` returns the current frame for that
+  resolution, as a palettized PNG. Each frame's ETag is its fingerprint, so
+  a display polling with `If-None-Match` gets a `304 Not Modified` until the
+  server moves on to the next frame, once per refresh period.
+- `POST /frames/<width>x<height>/next` moves on to the next frame straight
+  away and returns it.
+"""
+import http.server
+import io
+import os
+import re
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from logging import Logger
+from typing import Dict, Optional, Tuple
+from PIL import Image
+from PIL.Image import Image as ImageType
+
+from common.display_config import DisplayConfig
+from common.display_state import get_frame_fingerprint
+from common.frame_cache import FrameCache
+from common.frame_renderer import FrameRenderer
+from common.image_retriever import ImageRetriever
+from common.image_source import ImageSourceUnavailable
+from common.metrics import metrics
+from common.prefetcher import Prefetcher
+
+
+FRAME_PATH_PATTERN = re.compile(r'^/frames/(\d+)x(\d+)(/next)?$')
+# Panels larger than this in either dimension aren't served.
+MAX_FRAME_DIMENSION_PX = 4096
+FRAME_CONTENT_TYPE = 'image/png'
+# Header carrying the file name of the frame's source image, percent-encoded
+# since header values must be latin-1.
+SOURCE_NAME_HEADER = 'X-Frame-Source'
+
+
+class FrameChannel:
+    """The current frame for one panel resolution, and the frames after it.
+
+    Upcoming frames are prefetched, so moving on to the next frame doesn't
+    wait on the image source.
+    """
+    logger: Logger
+    display_config: DisplayConfig
+    prefetcher: Prefetcher
+
+    def __init__(self, logger, display_config, prefetcher):
+        self.logger = logger
+        self.display_config = display_config
+        self.prefetcher = prefetcher
+
+        # Protects the current frame below.
+        self.lock = threading.Lock()
+        self.etag: Optional[str] = None
+        self.png_bytes = b''
+        self.source_name = ''
+        # When (in `time.monotonic()` seconds) the current frame was taken.
+        self.advanced_at = 0.0
+
+    def get_current(self) -> Optional[Tuple[str, bytes, str]]:
+        """Returns the (ETag, PNG bytes, source file name) of the current
+        frame, moving on to the next frame once per refresh period.
+
+        Returns None if there's no frame to serve yet.
+        """
+        with self.lock:
+            refresh_period_secs = self.display_config.config['display']['refresh_period_secs']
+            if self.etag is None or time.monotonic() >= self.advanced_at + refresh_period_secs:
+                self._advance()
+            if self.etag is None:
+                return None
+            return (self.etag, self.png_bytes, self.source_name)
+
+    def advance(self) -> Optional[Tuple[str, bytes, str]]:
+        """Moves on to the next frame and returns it, as in `get_current`."""
+        with self.lock:
+            self._advance()
+            if self.etag is None:
+                return None
+            return (self.etag, self.png_bytes, self.source_name)
+
+    def _advance(self) -> None:
+        """Takes the next frame from the prefetcher. Expects `lock` to be
+        held."""
+        buffered_frame = self.prefetcher.get(
+            timeout=self.display_config.config['render_server']['frame_timeout_secs'])
+        if buffered_frame is None:
+            self.logger.error("Timed out waiting for a frame to serve.")
+            return
+        frame = buffered_frame.to_image()
+        png_file = io.BytesIO()
+        frame.save(png_file, format='PNG')
+        self.etag = f'"{get_frame_fingerprint(frame)}"'
+        self.png_bytes = png_file.getvalue()
+        self.source_name = os.path.basename(buffered_frame.source_path)
+        self.advanced_at = time.monotonic()
+        self.logger.info("Serving %s at %sx%s.", buffered_frame.source_path, *frame.size)
+
+
+class RenderServer:
+    """Serves rendered frames to displays over HTTP (see the module docs).
+
+    Each panel resolution gets its own `FrameChannel` the first time it's
+    asked for, up to `max_resolutions` of them. The channels share the image
+    retriever, so their frames all follow the one schedule, and the frame
+    cache.
+    """
+    logger: Logger
+    display_config: DisplayConfig
+    image_retriever: ImageRetriever
+    frame_cache: FrameCache
+
+    def __init__(self, logger, display_config, image_retriever=None):
+        self.logger = logger
+        self.display_config = display_config
+        self.image_retriever = image_retriever or ImageRetriever(logger, display_config)
+        self.frame_cache = FrameCache(logger, display_config)
+
+        # Protects `channels`.
+        self.lock = threading.Lock()
+        self.channels: Dict[Tuple[int, int], FrameChannel] = {}
+        self.http_server: Optional[http.server.ThreadingHTTPServer] = None
+
+    @property
+    def server_config(self) -> dict:
+        return self.display_config.config['render_server']
+
+    def get_channel(self, resolution) -> Optional[FrameChannel]:
+        """Returns the channel for the given resolution, starting one if
+        needed, or None if too many resolutions are being served already."""
+        with self.lock:
+            channel = self.channels.get(resolution)
+            if channel is not None:
+                return channel
+            if len(self.channels) >= self.server_config['max_resolutions']:
+                return None
+            frame_renderer = FrameRenderer(
+                self.logger, self.display_config, resolution,
+                self.image_retriever.metadata_store, self.frame_cache)
+            prefetcher = Prefetcher(self.logger, self.display_config,
+                                    self.image_retriever, frame_renderer)
+            prefetcher.start()
+            channel = FrameChannel(self.logger, self.display_config, prefetcher)
+            self.channels[resolution] = channel
+            self.logger.info("Started serving frames at %sx%s.", *resolution)
+            return channel
+
+    def start(self) -> None:
+        """Starts listening, without serving requests yet (see `serve`)."""
+        address = (self.server_config['bind_address'], self.server_config['port'])
+        self.http_server = http.server.ThreadingHTTPServer(address, RenderRequestHandler)
+        self.http_server.daemon_threads = True
+        self.http_server.render_server = self
+        self.logger.info("Render server listening on %s:%s.", *self.http_server.server_address[:2])
+
+    @property
+    def port(self) -> int:
+        """The port being listened on, e.g. if `port` was configured as 0."""
+        return self.http_server.server_address[1]
+
+    def serve(self) -> None:
+        """Serves requests until `stop` is called."""
+        if self.http_server is None:
+            self.start()
+        self.http_server.serve_forever()
+
+    def stop(self) -> None:
+        """Stops serving requests and rendering frames."""
+        if self.http_server is not None:
+            self.http_server.shutdown()
+            self.http_server.server_close()
+        with self.lock:
+            for channel in self.channels.values():
+                channel.prefetcher.stop()
+                channel.prefetcher.frame_renderer.shutdown()
+
+
+class RenderRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Handles requests to a `RenderServer`."""
+
+    def do_GET(self):
+        self.handle_frame_request(is_post=False)
+
+    def do_POST(self):
+        self.handle_frame_request(is_post=True)
+
+    def handle_frame_request(self, is_post) -> None:
+        render_server: RenderServer = self.server.render_server
+        path_match = FRAME_PATH_PATTERN.match(self.path.split('?', 1)[0])
+        if path_match is None or bool(path_match.group(3)) != is_post:
+            self.send_error(404)
+            return
+        resolution = (int(path_match.group(1)), int(path_match.group(2)))
+        if not all(0 < dimension <= MAX_FRAME_DIMENSION_PX for dimension in resolution):
+            self.send_error(400, "Unsupported resolution.")
+            return
+        channel = render_server.get_channel(resolution)
+        if channel is None:
+            self.send_error(503, "Too many resolutions are being served.")
+            return
+
+        with metrics.span('serve_frame'):
+            current_frame = channel.advance() if is_post else channel.get_current()
+        if current_frame is None:
+            self.send_response(503)
+            self.send_header('Retry-After', '60')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        etag, png_bytes, source_name = current_frame
+        if not is_post and etag in [
+                tag.strip() for tag in self.headers.get('If-None-Match', '').split(',')]:
+            metrics.increment('frames_not_modified')
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+
+        metrics.increment('frames_served')
+        self.send_response(200)
+        self.send_header('Content-Type', FRAME_CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(png_bytes)))
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header(SOURCE_NAME_HEADER, urllib.parse.quote(source_name))
+        self.end_headers()
+        self.wfile.write(png_bytes)
+
+    def log_message(self, format, *args):
+        self.server.render_server.logger.info(
+            "%s - %s", self.address_string(), format % args)
+
+
+class RenderClient:
+    """Fetches frames for this display from a render server."""
+    logger: Logger
+    display_config: DisplayConfig
+
+    def __init__(self, logger, display_config, resolution):
+        self.logger = logger
+        self.display_config = display_config
+        self.resolution = tuple(resolution)
+        # ETag of the last frame fetched, for conditional requests.
+        self.etag: Optional[str] = None
+
+    @property
+    def client_config(self) -> dict:
+        return self.display_config.config['render_client']
+
+    @property
+    def frame_url(self) -> str:
+        width, height = self.resolution
+        return f"{self.client_config['server_url'].rstrip('/')}/frames/{width}x{height}"
+
+    def fetch_current_frame(self) -> Optional[ImageType]:
+        """Returns the server's current frame, or None if it's the same as the
+        last frame fetched.
+
+        Raises `ImageSourceUnavailable` if the server can't be reached or has
+        no frame to serve.
+        """
+        request = urllib.request.Request(self.frame_url)
+        if self.etag is not None:
+            request.add_header('If-None-Match', self.etag)
+        return self._fetch_frame(request)
+
+    def fetch_next_frame(self) -> ImageType:
+        """Has the server move on to its next frame, and returns it.
+
+        Raises `ImageSourceUnavailable` as `fetch_current_frame` does.
+        """
+        return self._fetch_frame(urllib.request.Request(
+            f"{self.frame_url}/next", data=b'', method='POST'))
+
+    def _fetch_frame(self, request) -> Optional[ImageType]:
+        try:
+            with metrics.span('fetch_frame'):
+                with urllib.request.urlopen(
+                        request, timeout=self.client_config['timeout_secs']) as response:
+                    png_bytes = response.read()
+                    etag = response.headers.get('ETag')
+                    source_name = urllib.parse.unquote(
+                        response.headers.get(SOURCE_NAME_HEADER, ''))
+        except urllib.error.HTTPError as e:
+            if e.code == 304:
+                return None
+            raise ImageSourceUnavailable(
+                f"The render server responded with {e.code} {e.reason}.") from e
+        except (OSError, ValueError) as e:
+            raise ImageSourceUnavailable(f"Failed to reach the render server: {e}") from e
+
+        frame = Image.open(io.BytesIO(png_bytes))
+        frame.load()
+        self.etag = etag
+        self.logger.info("Fetched %s from the render server.", source_name or "a frame")
+        return frame
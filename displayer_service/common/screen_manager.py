@@ -2,28 +2,35 @@
 
 import os
 import logging
+import logging.handlers
+import queue
 import time
 import sys
 import traceback
 import threading
-import queue
 
-from RPi import GPIO
 from logging import Logger
 from PIL import Image
-from inky.auto import auto
 from pathlib import Path
-from typing import Union
+from typing import Optional, Union
 
-from common import image_processor, debug_screen
+from common import debug_screen, image_processor, render_dispatcher
 from common.display_config import DisplayConfig
+from common.display_state import DisplayState, get_frame_fingerprint
+from common.frame_renderer import FrameRenderer
 from common.image_retriever import ImageRetriever
+from common.image_source import ImageSourceUnavailable
+from common.log_handlers import RingBufferHandler
+from common.metrics import metrics
+from common.prefetcher import Prefetcher
+from common.render_dispatcher import RenderDispatcher
+from common.render_server import RenderClient
+from common.simulated_hardware import SimulatedGPIO, SimulatedInky
 
 
 PATH = os.path.dirname(__file__)
 DISPLAY_CONFIG_FILE_PATH = './display_config.json'
-INITIAL_QUEUE_SIZE = 10
-LOG_FILE_PATH = './.ink-memories-log'
+SIMULATED_HARDWARE_BACKEND = 'simulated'
 
 
 class ScreenManager:
@@ -41,48 +48,117 @@ class ScreenManager:
     # Protects multi-threaded access to the screen.
     screen_lock = threading.Lock()
 
-    # Buffer of cached in-memory images.
-    image_queue = queue.Queue()
-
     # Utility for retrieving images from the image source.
-    image_retriever: ImageRetriever
+    image_retriever: Optional[ImageRetriever]
+
+    # Utility for turning images into display-ready frames.
+    frame_renderer: Optional[FrameRenderer]
+
+    # Buffer of display-ready frames, topped up in the background.
+    prefetcher: Optional[Prefetcher]
+
+    # Fetches display-ready frames from a render server. If set, this takes
+    # the place of the image retriever, frame renderer and prefetcher above.
+    render_client: Optional[RenderClient]
+
+    # Persists the last rendered frame and the frame buffer across restarts.
+    display_state: DisplayState
+
+    # Serialises display updates requested by buttons and the refresh timer.
+    render_dispatcher: RenderDispatcher
+
+    # Recent log lines, kept in memory for the debug screen.
+    ring_buffer_handler: RingBufferHandler
+
+    # Set when the refresh period changes, to wake up the refresh timer.
+    refresh_period_changed: threading.Event
 
     # Whether the user is currently in debugging mode.
     # The user can enter debugging mode by pressing the 'B' button.
     # Debugging mode can be exited via a force image refresh ('A' button).
     is_debugging = False
 
-    def __init__(self):
+    def __init__(self, config_file_path=DISPLAY_CONFIG_FILE_PATH):
         with self.screen_lock:
             self.logger = logging.getLogger(__name__)
-            self.initialise_display_config()
+            self.initialise_display_config(config_file_path)
+            self.refresh_period_changed = threading.Event()
+            self.display_config.add_listener(self.apply_config_changes)
             # TODO: make this self.display_config = self.configure_logger().
             self.configure_logger()
 
             self.initialise_eink_display()
             self.initialise_pi()
 
-            self.image_retriever = ImageRetriever(
+            self.display_state = DisplayState(
                 self.logger, self.display_config)
 
-            # Populate the image buffer with some intiial images.
-            # Keep trying until it is populated.
-            chosen_images = None
-            while chosen_images is None:
-                try:
-                    chosen_images = self.image_retriever.get_random_images(
-                        INITIAL_QUEUE_SIZE)
-                except Exception as e:
-                    self.logger.error(e)
-                    self.logger.info(
-                        "Initial population of images has failed. Trying again in 300 seconds.")
-                    time.sleep(300)
-
-            for img in chosen_images:
-                self.image_queue.put(img)
+            if self.display_config.config['render_client']['enabled']:
+                # Frames come ready-rendered from the render server, so
+                # nothing here touches the image source.
+                self.render_client = RenderClient(
+                    self.logger, self.display_config, self.eink_display.resolution)
+                self.image_retriever = self.frame_renderer = self.prefetcher = None
+                self.logger.info("Fetching frames from the render server at %s.",
+                                 self.display_config.config['render_client']['server_url'])
+            else:
+                self.render_client = None
+                self.image_retriever = ImageRetriever(
+                    self.logger, self.display_config)
+                self.frame_renderer = FrameRenderer(
+                    self.logger, self.display_config, self.eink_display.resolution,
+                    self.image_retriever.metadata_store)
+
+                # Restore the frame buffer from before the last shutdown, then
+                # keep it populated in the background. The prefetcher keeps
+                # retrying until the image source is available, so nothing
+                # here waits on it.
+                self.prefetcher = Prefetcher(
+                    self.logger, self.display_config, self.image_retriever,
+                    self.frame_renderer, self.display_state)
+                self.prefetcher.restore_buffer()
+                self.prefetcher.start()
+
+            self.last_frame = self.display_state.load_last_frame()
+            # Fingerprint of the frame on the panel, used to skip refreshes
+            # that wouldn't change anything.
+            self.shown_fingerprint = self.display_state.load_shown_fingerprint()
+
+            # All display updates run on the dispatcher's render worker, so
+            # that button callbacks never block.
+            self.render_dispatcher = RenderDispatcher(self.logger, {
+                render_dispatcher.NEXT_IMAGE: self.show_next_server_frame
+                if self.render_client else self.output_and_queue_image,
+                render_dispatcher.SERVER_FRAME: self.show_current_server_frame,
+                render_dispatcher.DEBUG_SCREEN: self.push_debugger_update,
+                render_dispatcher.LAST_FRAME: self.show_last_frame,
+                render_dispatcher.SHUTDOWN: self.shutdown_pi,
+            })
+            self.render_dispatcher.start()
+
+            if self.last_frame is not None and \
+                    self.display_config.config['state']['show_last_frame_on_startup']:
+                self.render_dispatcher.submit(render_dispatcher.LAST_FRAME)
+
+    @property
+    def is_simulated(self) -> bool:
+        """Whether the display and buttons are simulated rather than real."""
+        return self.display_config.config['hardware']['backend'] == SIMULATED_HARDWARE_BACKEND
 
     def initialise_eink_display(self) -> None:
         """Initialises the e-ink display for usage."""
+        if self.is_simulated:
+            hardware_config = self.display_config.config['hardware']
+            self.eink_display = SimulatedInky(
+                self.logger, hardware_config['simulated_resolution'],
+                hardware_config['simulated_output_dir'],
+                hardware_config['simulated_refresh_secs'])
+            self.logger.info("Initialised the simulated eInk display.")
+            return
+
+        # Imported here so that the simulated backend works without the
+        # Inky library's hardware dependencies.
+        from inky.auto import auto
         try:
             self.eink_display = auto(ask_user=True, verbose=True)
         except TypeError:
@@ -97,13 +173,28 @@ class ScreenManager:
         """Creates a custom (non-root) logger.
 
         Expects that the display config has already been populated.
+
+        Records are handed off through a queue and written out by a listener
+        thread, so logging never blocks the render or GPIO threads on the SD
+        card. The log file is rotated by size, and recent lines are also kept
+        in memory for the debug screen.
         """
+        logging_config = self.display_config.config['logging']
         formatter = logging.Formatter(
             '[%(asctime)s] %(message)s', datefmt="%Y-%m-%d %H:%M")
-        file_handler = logging.FileHandler(LOG_FILE_PATH)
+        file_handler = logging.handlers.RotatingFileHandler(
+            logging_config['log_file_path'], maxBytes=logging_config['max_bytes'],
+            backupCount=logging_config['backup_count'], encoding='utf-8')
         file_handler.setFormatter(formatter)
-
-        self.logger.addHandler(file_handler)
+        self.ring_buffer_handler = RingBufferHandler(
+            logging_config['ring_buffer_size'])
+        self.ring_buffer_handler.setFormatter(formatter)
+
+        log_queue = queue.Queue()
+        self.log_listener = logging.handlers.QueueListener(
+            log_queue, file_handler, self.ring_buffer_handler)
+        self.log_listener.start()
+        self.logger.addHandler(logging.handlers.QueueHandler(log_queue))
         self.logger.info('Initialised custom logger.')
 
         # Tees the log output to stdout.
@@ -123,29 +214,39 @@ class ScreenManager:
             sys.exit(1)
         sys.excepthook = custom_exception_hook
 
-    def initialise_display_config(self):
+    def initialise_display_config(self, config_file_path):
         """Initialises the display config."""
         self.display_config = DisplayConfig(
-            self.logger, DISPLAY_CONFIG_FILE_PATH)
+            self.logger, config_file_path)
 
     def initialise_pi(self):
         """Initialises the Pi's hardware settings."""
+        if self.is_simulated:
+            self.gpio = SimulatedGPIO()
+        else:
+            from RPi import GPIO
+            self.gpio = GPIO
+
         # Set up RPi.GPIO with the "BCM" numbering scheme. This is necessary
         # to map number GPIO pins to each screen button.
-        GPIO.setmode(GPIO.BCM)
+        self.gpio.setmode(self.gpio.BCM)
 
         # Buttons connect to ground when pressed, so we should set them up
         # with a "PULL UP", which weakly pulls the input signal to 3.3V.
-        GPIO.setup(list(self.pins_to_buttons.keys()),
-                   GPIO.IN, pull_up_down=GPIO.PUD_UP)
+        self.gpio.setup(list(self.pins_to_buttons.keys()),
+                        self.gpio.IN, pull_up_down=self.gpio.PUD_UP)
 
         for each_pin_num in self.pins_to_buttons.keys():
-            GPIO.add_event_detect(each_pin_num, GPIO.FALLING,
-                                  self.handle_button_press, bouncetime=250)
+            self.gpio.add_event_detect(each_pin_num, self.gpio.FALLING,
+                                       self.handle_button_press, bouncetime=250)
 
     def refresh_in_background(self) -> None:
         """Periodically displays a new image."""
-        image_refresh_period_secs = self.display_config.config['display']['refresh_period_secs']
+        if self.last_frame is not None and \
+                self.display_config.config['state']['show_last_frame_on_startup']:
+            # The last frame is being shown in lieu of the first refresh.
+            self.wait_for_next_refresh()
+
         while True:
             self.logger.info("Automatic image refresh requested.")
 
@@ -153,74 +254,138 @@ class ScreenManager:
                 self.logger.info(
                     "Debugging mode is ON. Skipping image refresh."
                 )
+            elif self.render_client is not None:
+                # The render server decides when there's a new image.
+                self.render_dispatcher.submit(render_dispatcher.SERVER_FRAME)
             else:
-                self.output_and_queue_image()
+                self.render_dispatcher.submit(render_dispatcher.NEXT_IMAGE)
 
-            self.logger.info("Waiting for %s seconds.",
-                             image_refresh_period_secs)
-            time.sleep(image_refresh_period_secs)
+            self.wait_for_next_refresh()
 
-    def queue_image(self):
-        """Adds a random image to image buffer"""
-        try:
-            self.image_queue.put(self.image_retriever.get_random_image())
-        except Exception as e:
-            self.logger.error(e)
-            self.logger.info(
-                "Failed to queue image. Size of queue: %s", self.image_queue.qsize())
+    @property
+    def refresh_period_secs(self) -> float:
+        """How long to wait between automatic refreshes. When fetching frames
+        from a render server, this is how often to poll it."""
+        if self.render_client is not None:
+            return self.display_config.config['render_client']['poll_secs']
+        return self.display_config.config['display']['refresh_period_secs']
 
-    def output_and_queue_image(self):
-        """Displays the next image in the image queue, and adds a new image to the queue."""
-        self.logger.info("Image queue size is %s.", self.image_queue.qsize())
+    def wait_for_next_refresh(self) -> None:
+        """Waits for the refresh period.
 
-        try:
-            next_image = self.image_queue.get()
-        except queue.Empty:
-            self.logger.error(
-                "Tried to set the next image, but queue was empty.")
+        If the refresh period is changed in the meantime, the wait is cut short
+        or extended to match.
+        """
+        start_time = time.monotonic()
+        while True:
+            image_refresh_period_secs = self.refresh_period_secs
+            remaining_secs = start_time + image_refresh_period_secs - time.monotonic()
+            if remaining_secs <= 0:
+                return
+            self.logger.info("Waiting for %s seconds.", round(remaining_secs))
+            self.refresh_period_changed.wait(remaining_secs)
+            self.refresh_period_changed.clear()
+
+    def apply_config_changes(self, changes) -> None:
+        """Applies a reloaded display config to the refresh timer."""
+        if ('display', 'refresh_period_secs') in changes or \
+                ('render_client', 'poll_secs') in changes:
+            self.refresh_period_changed.set()
 
-            self.logger.info("Repopulating the image buffer.")
-            chosen_images = self.image_retriever.get_random_images(
-                INITIAL_QUEUE_SIZE)
-            for img in chosen_images:
-                self.image_queue.put(img)
+    def output_and_queue_image(self):
+        """Displays the next frame in the frame buffer.
 
-            next_image = self.image_queue.get()
+        The prefetcher replaces the frame in the background.
+        """
+        with metrics.span('output_image'):
+            self.logger.info("Frame buffer size is %s.", self.prefetcher.qsize())
+
+            with metrics.span('wait_for_frame'):
+                buffered_frame = self.prefetcher.get(timeout=0)
+                if buffered_frame is None:
+                    metrics.increment('frame_buffer_underruns')
+                    self.logger.error(
+                        "Tried to set the next image, but the frame buffer was empty. Waiting for the prefetcher.")
+                while buffered_frame is None:
+                    # Give up on this image if the user has since asked for
+                    # something else, e.g. the debug screen.
+                    if self.render_dispatcher.has_pending():
+                        self.logger.info("Abandoning stale image refresh.")
+                        return
+                    buffered_frame = self.prefetcher.get(timeout=1)
+
+            self.logger.info("Displaying %s.", buffered_frame.source_path)
+            self.show_frame(buffered_frame.to_image())
+
+    def show_next_server_frame(self):
+        """Displays the render server's next frame."""
+        try:
+            frame = self.render_client.fetch_next_frame()
+        except ImageSourceUnavailable as e:
+            self.logger.error(f"Failed to fetch the next frame: {e}")
+            return
+        self.show_frame(frame)
 
-        # Create a copy of the image to prevent mutating the original
-        # Otherwise, image metadata may get lost in drawing. 
-        img_copy = next_image.copy()
-        img_copy  = self.resize_image(img_copy)
-        img_copy = image_processor.burn_date_into_image(img_copy)
+    def show_current_server_frame(self):
+        """Displays the render server's current frame, if it has changed."""
+        try:
+            frame = self.render_client.fetch_current_frame()
+        except ImageSourceUnavailable as e:
+            self.logger.error(f"Failed to fetch the current frame: {e}")
+            return
+        if frame is None:
+            self.logger.info("The render server has no new frame.")
+            return
+        self.show_frame(frame)
 
+    def show_frame(self, frame):
+        """Displays a rendered frame, and persists it as the last frame."""
+        with self.screen_lock:
+            self.show_image(frame)
+        self.last_frame = frame
+        with metrics.span('save_last_frame'):
+            self.display_state.save_last_frame(frame)
+
+    def show_last_frame(self):
+        """Displays the frame that was last rendered before a restart."""
+        self.logger.info("Displaying the last rendered frame.")
         with self.screen_lock:
-            self.show_image(img_copy)
-        self.image_retriever.clean_up_image(next_image)
+            self.show_image(self.last_frame)
 
-        # Run as thread to make consecutive A presses instant response.
-        enqueue_thread = threading.Thread(target=self.queue_image)
-        enqueue_thread.start()
+    def show_image(self, img):
+        """Writes the given image to the e-ink display.
 
-    def resize_image(self, img):
+        The image is palettized first, unless it already is, so that it can be
+        compared against the frame on the panel. If they're identical, the
+        (slow) panel refresh is skipped.
         """
-        Preprocess the image by cropping and resizing if needed.
-        """
-        # Pre-process the image.
-        width, height = self.eink_display.resolution
-        img = image_processor.central_crop(img,  width / height)
-        img = img.resize(self.eink_display.resolution)
+        if img.mode != 'P':
+            render_config = self.display_config.config['render']
+            img = image_processor.palettize(
+                img, render_config['saturation'], render_config['dither'])
+        fingerprint = get_frame_fingerprint(img)
+        if fingerprint == self.shown_fingerprint and \
+                self.display_config.config['display']['skip_identical_refreshes']:
+            metrics.increment('skipped_refreshes')
+            self.logger.debug("The frame is already on the display. Skipping the refresh.")
+            return
 
-        self.logger.info("Finished preprocessing image.")
-        return img
+        # The panel's contents are unknown if the refresh is interrupted, e.g.
+        # by a power cut, so forget the old fingerprint until it completes.
+        self.shown_fingerprint = None
+        self.display_state.save_shown_fingerprint('')
 
-    def show_image(self, img):
-        """Sets a new random image chosen from the images source.
-        """        
         # Writing the image to the screen.
-        self.eink_display.set_image(img)
-        self.eink_display.show()
+        with metrics.span('show'):
+            self.eink_display.set_image(img)
+            self.eink_display.show()
+        metrics.increment('panel_refreshes')
+        self.shown_fingerprint = fingerprint
+        self.display_state.save_shown_fingerprint(fingerprint)
 
-        self.logger.info("Done writing image.")
+        # Logged at debug level, like the rest of the refresh's own logs, so
+        # that showing the debug screen doesn't change the logs it shows.
+        self.logger.debug("Done writing image.")
 
     def push_debugger_update(self):
         """Displays the debug mode screen.
@@ -231,14 +396,10 @@ class ScreenManager:
         Flipping on debug mode will not pre-empt any in-progress screen
         refreshes.
         """
-        if self.screen_lock.locked():
-            self.logger.info(
-                "Attempted to enter debug mode while screen was busy. Skipping.")
-            return
-
         with self.screen_lock:
             # Ensure the image fits into the eink display's resolution.
-            debug_screen_img = debug_screen.transform_logs_to_image(LOG_FILE_PATH)
+            debug_screen_img = debug_screen.transform_ring_buffer_to_image(
+                self.ring_buffer_handler)
             debug_screen_img = debug_screen_img.resize(
                 self.eink_display.resolution)
             self.show_image(debug_screen_img)
@@ -246,6 +407,9 @@ class ScreenManager:
     def handle_button_press(self, pressed_pin):
         """Executes specific actions on button presses.
 
+        Runs on the GPIO callback thread, so this only submits intents to the
+        render dispatcher and never touches the display itself.
+
         Labels and their GPIO pins:
         A --> 5
         B --> 6
@@ -255,27 +419,23 @@ class ScreenManager:
         label = self.pins_to_buttons[pressed_pin]
         if label == 'A':
             self.logger.info("User pressed A. Forcing refresh image.")
-            if self.screen_lock.locked():
-                self.logger.info(
-                    "Skipping image refresh because refresh is already underway.")
-                return
             self.is_debugging = False
-            self.output_and_queue_image()
+            self.render_dispatcher.submit(render_dispatcher.NEXT_IMAGE)
         elif label == 'B':
+            # Logged at debug level, so that pressing B again doesn't change
+            # the logs on the debug screen and force a refresh.
+            self.logger.debug(
+                "User pressed B. " + ("Refreshing debugger." if self.is_debugging else "Entering debugging mode."))
             self.is_debugging = True
-            self.logger.info(
-                "User pressed B. " + ("Entering debugging mode." if self.is_debugging else "Refreshing debugger."))
-            self.push_debugger_update()
+            self.render_dispatcher.submit(render_dispatcher.DEBUG_SCREEN)
         elif label == 'C':
             self.logger.info(
                 "User pressed C. Nothing is implemented for this button.")
         elif label == 'D':
             self.logger.info("User pressed D. Shutting down the Pi.")
 
-            # Only commence shutdown after the image finishes refreshing,
-            # if it is currently refreshing.
-            with self.screen_lock:
-                self.shutdown_pi()
+            # The shutdown runs after any in-progress refresh finishes.
+            self.render_dispatcher.submit(render_dispatcher.SHUTDOWN)
 
     def shutdown_pi(self):
         """Gracefully shuts down the host system.
@@ -285,7 +445,26 @@ class ScreenManager:
         """
         self.logger.info("Shutting down!")
         if os.geteuid() != 0:
+            # Keep running as before, with the prefetcher and renderer intact.
             self.logger.error(
                 "Failed to shut down because this process is not executing with root privileges.")
         else:
+            if self.prefetcher is not None:
+                self.prefetcher.stop()
+            if self.frame_renderer is not None:
+                self.frame_renderer.shutdown()
+            # Flush any queued logs before the system goes down.
+            self.stop_logging()
             os.system('systemctl poweroff')
+
+    def stop_logging(self):
+        """Writes out any queued log records and detaches the custom logger's
+        handlers."""
+        if self.log_listener is None:
+            return
+        self.log_listener.stop()
+        for handler in list(self.logger.handlers):
+            self.logger.removeHandler(handler)
+        for handler in self.log_listener.handlers:
+            handler.close()
+        self.log_listener = None
@@ -0,0 +1,254 @@
+"""Provides a persisted shuffle-bag schedule of the images to display."""
+import json
+import os
+import random
+import threading
+
+from logging import Logger
+from pathlib import Path
+from typing import List, Optional
+
+from common.display_config import ConfigChanges, DisplayConfig
+from common.image_index import ImageIndex
+from common.metrics import metrics
+from common.near_duplicates import NearDuplicateFilter
+
+
+SCHEDULE_FORMAT_VERSION = 1
+SCHEDULE_FILE_NAME = "schedule.json"
+SCHEDULE_CURSOR_FILE_NAME = "schedule-cursor.json"
+
+
+class ShuffleScheduler:
+    """Walks a shuffled permutation of the image index, one cycle at a time.
+
+    Every indexed image is shown once per cycle before any image repeats, and
+    each pick is O(1). When a cycle is exhausted, the images are reshuffled
+    into a new cycle.
+
+    The schedule follows the image index as it changes:
+    - New images are inserted at random positions in the unplayed part of the
+      current cycle, without reshuffling it.
+    - Removed images are skipped when they come up.
+    - If the image source directory changes, the schedule is reseeded.
+
+    The permutation is persisted whenever it changes, and the position within
+    it after every pick, so the schedule survives restarts.
+
+    If a near-duplicate filter is given, images it suppresses are skipped for
+    the rest of the cycle.
+    """
+    logger: Logger
+    display_config: DisplayConfig
+    image_index: ImageIndex
+    near_duplicate_filter: Optional[NearDuplicateFilter]
+
+    def __init__(self, logger, display_config, image_index, near_duplicate_filter=None):
+        self.logger = logger
+        self.display_config = display_config
+        self.image_index = image_index
+        self.near_duplicate_filter = near_duplicate_filter
+
+        # Protects all of the schedule state below.
+        self.lock = threading.Lock()
+        self.seed = random.getrandbits(32)
+        # Number of cycles started since the schedule was seeded.
+        self.cycle = 0
+        # This cycle's permutation of image paths, and the position in it of
+        # the next pick.
+        self.order: List[str] = []
+        self.cursor = 0
+        # The set of currently indexed paths. Paths in `order` that aren't in
+        # here have been removed from the image source.
+        self.live_paths = set()
+        # The image index generation that `live_paths` was synced at.
+        self.synced_generation = None
+        # The previous cycle's last pick, so that it isn't repeated
+        # back-to-back at the start of the next cycle.
+        self.last_pick: Optional[str] = None
+
+        self.load()
+
+    @property
+    def schedule_path(self) -> str:
+        return os.path.join(self.display_config.config['state']['state_dir'],
+                            SCHEDULE_FILE_NAME)
+
+    @property
+    def cursor_path(self) -> str:
+        return os.path.join(self.display_config.config['state']['state_dir'],
+                            SCHEDULE_CURSOR_FILE_NAME)
+
+    def load(self) -> None:
+        """Restores the persisted schedule, if there is one for this album."""
+        try:
+            with open(self.schedule_path, 'r', encoding='utf-8') as schedule_file:
+                schedule_dict = json.load(schedule_file)
+        except FileNotFoundError:
+            return
+        except (OSError, json.JSONDecodeError) as e:
+            self.logger.error(f"Failed to load the schedule: {e}")
+            return
+
+        if schedule_dict.get('version') != SCHEDULE_FORMAT_VERSION or \
+                schedule_dict.get('image_source_dir') != self.image_index.image_source_dir:
+            self.logger.info("The album has changed. Reseeding the schedule.")
+            return
+
+        cursor = 0
+        try:
+            with open(self.cursor_path, 'r', encoding='utf-8') as cursor_file:
+                cursor_dict = json.load(cursor_file)
+            if cursor_dict.get('cycle') == schedule_dict['cycle']:
+                cursor = cursor_dict['cursor']
+        except (OSError, json.JSONDecodeError):
+            # Replaying part of a cycle beats losing the whole schedule.
+            pass
+
+        with self.lock:
+            self.seed = schedule_dict['seed']
+            self.cycle = schedule_dict['cycle']
+            self.order = schedule_dict['order']
+            self.cursor = min(cursor, len(self.order))
+        self.logger.info("Restored the schedule at %s of %s images in cycle %s.",
+                         self.cursor, len(self.order), self.cycle)
+
+    def apply_config_changes(self, changes: ConfigChanges) -> None:
+        """Reseeds the schedule if the image source directory has changed."""
+        if ('display', 'image_source_dir') not in changes:
+            return
+        with self.lock:
+            self.seed = random.getrandbits(32)
+            self.cycle = 0
+            self.order = []
+            self.cursor = 0
+            self.synced_generation = None
+        self.logger.info("The album has changed. Reseeding the schedule.")
+
+    def save_order(self) -> None:
+        """Persists the current cycle's permutation. Expects `lock` to be held."""
+        self._write_json(self.schedule_path, {
+            'version': SCHEDULE_FORMAT_VERSION,
+            'image_source_dir': self.image_index.image_source_dir,
+            'seed': self.seed,
+            'cycle': self.cycle,
+            'order': self.order,
+        })
+        self.save_cursor()
+
+    def save_cursor(self) -> None:
+        """Persists the position within the current cycle. Expects `lock` to be
+        held."""
+        self._write_json(self.cursor_path,
+                         {'cycle': self.cycle, 'cursor': self.cursor})
+
+    def _write_json(self, file_path, json_dict) -> None:
+        """Atomically writes the given dict to a JSON file."""
+        tmp_file_path = f"{file_path}.tmp"
+        try:
+            Path(os.path.dirname(file_path)).mkdir(parents=True, exist_ok=True)
+            with open(tmp_file_path, 'w', encoding='utf-8') as json_file:
+                json.dump(json_dict, json_file)
+            os.replace(tmp_file_path, file_path)
+        except OSError as e:
+            self.logger.error(f"Failed to save the schedule: {e}")
+
+    def sync(self) -> None:
+        """Applies any changes to the image index. Expects `lock` to be held."""
+        if self.synced_generation == self.image_index.generation:
+            return
+        self.synced_generation = self.image_index.generation
+        indexed_paths = set(self.image_index.get_paths())
+
+        new_paths = list(indexed_paths.difference(self.order))
+        self.live_paths = indexed_paths
+        remaining_paths = self.order[self.cursor:]
+        # With nothing left in this cycle, new images simply join the next one.
+        if not new_paths or not remaining_paths:
+            return
+
+        # Scatter the new images into random slots between the remaining ones,
+        # leaving the remaining images' relative order untouched.
+        rng = random.Random()
+        rng.shuffle(new_paths)
+        slots = sorted(rng.randint(0, len(remaining_paths)) for _ in new_paths)
+        merged_paths = []
+        previous_slot = 0
+        for slot, new_path in zip(slots, new_paths):
+            merged_paths.extend(remaining_paths[previous_slot:slot])
+            merged_paths.append(new_path)
+            previous_slot = slot
+        merged_paths.extend(remaining_paths[previous_slot:])
+        self.order[self.cursor:] = merged_paths
+        self.logger.info("Added %s new images to the schedule.", len(new_paths))
+        self.save_order()
+
+    def start_cycle(self) -> None:
+        """Reshuffles the indexed images into a new cycle. Expects `lock` to be
+        held."""
+        self.cycle += 1
+        self.order = sorted(self.live_paths)
+        random.Random(f"{self.seed}:{self.cycle}").shuffle(self.order)
+        if len(self.order) > 1 and self.order[0] == self.last_pick:
+            self.order[0], self.order[-1] = self.order[-1], self.order[0]
+        self.cursor = 0
+        self.logger.info("Started cycle %s of the schedule with %s images.",
+                         self.cycle, len(self.order))
+        self.save_order()
+
+    def next(self) -> Optional[str]:
+        """Returns the next image path in the schedule, or None if the image
+        index is empty."""
+        with self.lock:
+            self.sync()
+            if not self.live_paths:
+                return None
+            # Once every image has been suppressed, take the next one anyway.
+            num_suppressed = 0
+            while True:
+                while self.cursor < len(self.order):
+                    image_path = self.order[self.cursor]
+                    self.cursor += 1
+                    if image_path not in self.live_paths:
+                        continue
+                    if num_suppressed < len(self.live_paths) and self.is_suppressed(image_path):
+                        num_suppressed += 1
+                        metrics.increment('near_duplicates_suppressed')
+                        continue
+                    self.last_pick = image_path
+                    self.save_cursor()
+                    if self.near_duplicate_filter is not None:
+                        self.near_duplicate_filter.record_pick(image_path)
+                    return image_path
+                self.start_cycle()
+
+    def is_suppressed(self, image_path, upcoming_paths=None) -> bool:
+        """Whether the given image is a near-duplicate of a recent pick."""
+        return self.near_duplicate_filter is not None and \
+            self.near_duplicate_filter.is_suppressed(image_path, upcoming_paths)
+
+    def peek(self, num_images) -> List[str]:
+        """Returns up to `num_images` upcoming picks without consuming them.
+
+        Only looks ahead within the current cycle, unless it's exhausted, in
+        which case the next cycle is started.
+        """
+        with self.lock:
+            self.sync()
+            upcoming_paths = self._upcoming_paths(num_images)
+            if not upcoming_paths and self.live_paths:
+                self.start_cycle()
+                upcoming_paths = self._upcoming_paths(num_images)
+            return upcoming_paths
+
+    def _upcoming_paths(self, num_images) -> List[str]:
+        """Returns up to `num_images` upcoming picks in the current cycle.
+        Expects `lock` to be held."""
+        upcoming_paths = []
+        for image_path in self.order[self.cursor:]:
+            if len(upcoming_paths) == num_images:
+                break
+            if image_path in self.live_paths and \
+                    not self.is_suppressed(image_path, upcoming_paths):
+                upcoming_paths.append(image_path)
+        return upcoming_paths
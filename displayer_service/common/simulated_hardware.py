@@ -0,0 +1,100 @@
+"""Provides simulated stand-ins for the Pi's hardware.
+
+These let the displayer service run, and be tested, on machines without an
+Inky display or GPIO pins.
+"""
+import os
+import threading
+import time
+
+from logging import Logger
+from pathlib import Path
+
+from common import image_processor
+
+
+class SimulatedInky:
+    """Simulated Inky Impression display that writes each shown frame to a PNG.
+
+    Mirrors the subset of the Inky library's display API that the displayer
+    service uses. `show` blocks for `refresh_secs` to model the real panel's
+    refresh latency.
+    """
+    # Colour indices, as in the Inky library.
+    BLACK = 0
+    WHITE = 1
+    GREEN = 2
+    BLUE = 3
+    RED = 4
+    YELLOW = 5
+    ORANGE = 6
+    CLEAN = 7
+
+    logger: Logger
+
+    def __init__(self, logger, resolution, output_dir, refresh_secs):
+        self.logger = logger
+        self.resolution = tuple(resolution)
+        self.output_dir = output_dir
+        self.refresh_secs = refresh_secs
+
+        self.border_colour = self.WHITE
+        self.image = None
+        # Number of times the panel has been refreshed.
+        self.num_refreshes = 0
+
+        Path(self.output_dir).mkdir(parents=True, exist_ok=True)
+
+    def set_border(self, colour) -> None:
+        self.border_colour = colour
+
+    def set_image(self, image, saturation=image_processor.DEFAULT_SATURATION) -> None:
+        """Buffers an image to be shown, palettizing it if necessary."""
+        if image.mode != 'P':
+            image = image_processor.palettize(image, saturation)
+        self.image = image
+
+    def show(self) -> None:
+        """Refreshes the simulated panel with the buffered image."""
+        time.sleep(self.refresh_secs)
+        self.num_refreshes += 1
+        frame_path = os.path.join(
+            self.output_dir, f"frame-{self.num_refreshes:05d}.png")
+        self.image.save(frame_path)
+        self.logger.debug("Simulated display showed %s.", frame_path)
+
+
+class SimulatedGPIO:
+    """Simulated RPi.GPIO module, whose buttons are pressed programmatically.
+
+    Mirrors the subset of the RPi.GPIO API that the displayer service uses.
+    """
+    BCM = 11
+    IN = 1
+    PUD_UP = 22
+    FALLING = 32
+
+    def __init__(self):
+        self.mode = None
+        # Pin number -> event detection callback.
+        self.callbacks = {}
+
+    def setmode(self, mode) -> None:
+        self.mode = mode
+
+    def setup(self, channels, direction, pull_up_down=None) -> None:
+        pass
+
+    def add_event_detect(self, channel, edge, callback=None, bouncetime=None) -> None:
+        self.callbacks[channel] = callback
+
+    def press(self, channel) -> threading.Thread:
+        """Simulates pressing the button on the given pin.
+
+        Like RPi.GPIO, the callback runs on a separate thread, which is
+        returned.
+        """
+        callback_thread = threading.Thread(
+            target=self.callbacks[channel], args=(channel,), daemon=True)
+        callback_thread.start()
+        return callback_thread
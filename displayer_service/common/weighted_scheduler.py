@@ -0,0 +1,345 @@
+"""Provides weighted random selection of the images to display."""
+import collections
+import datetime
+import os
+import random
+import threading
+
+from logging import Logger
+from typing import Dict, List, Optional
+
+from common.display_config import ConfigChanges, DisplayConfig
+from common.image_index import ImageIndex
+from common.metadata_store import MetadataStore
+from common.metrics import metrics
+from common.near_duplicates import NearDuplicateFilter
+
+
+# How many times to redraw an image that the near-duplicate filter suppresses,
+# before settling for it.
+MAX_SUPPRESSED_DRAWS = 8
+
+
+class FenwickTree:
+    """Fenwick (binary indexed) tree over a list of non-negative weights.
+
+    Supports updating a weight and drawing an index with probability
+    proportional to its weight, both in O(log n).
+    """
+
+    def __init__(self, weights):
+        self.weights = list(weights)
+        # 1-based tree of partial sums, built in O(n).
+        self.tree = [0.0] + self.weights
+        for position in range(1, len(self.tree)):
+            parent = position + (position & -position)
+            if parent < len(self.tree):
+                self.tree[parent] += self.tree[position]
+        # Highest power of 2 within the tree, for the binary search in `find`.
+        self.top_bit = 1 << (len(self.weights).bit_length() - 1) if self.weights else 0
+
+    def __len__(self):
+        return len(self.weights)
+
+    @property
+    def total(self) -> float:
+        total = 0.0
+        position = len(self.weights)
+        while position > 0:
+            total += self.tree[position]
+            position -= position & -position
+        return total
+
+    def update(self, index, weight) -> None:
+        """Sets the weight at the given index."""
+        delta = weight - self.weights[index]
+        self.weights[index] = weight
+        position = index + 1
+        while position < len(self.tree):
+            self.tree[position] += delta
+            position += position & -position
+
+    def find(self, target) -> int:
+        """Returns the first index whose cumulative weight exceeds `target`."""
+        position = 0
+        step = self.top_bit
+        while step:
+            next_position = position + step
+            if next_position < len(self.tree) and self.tree[next_position] <= target:
+                position = next_position
+                target -= self.tree[next_position]
+            step >>= 1
+        # Guard against floating point error pushing past the last weight.
+        return min(position, len(self.weights) - 1)
+
+    def draw(self, rng=random) -> int:
+        """Returns a random index, chosen with probability proportional to its
+        weight."""
+        return self.find(rng.random() * self.total)
+
+
+def get_taken_date(entry) -> datetime.date:
+    """Returns the date an image was taken, from its EXIF date if it has been
+    crawled, or else from its mtime."""
+    exif_date = entry.get('exif_date')
+    if exif_date:
+        try:
+            return datetime.datetime.strptime(exif_date, "%Y:%m:%d %H:%M:%S").date()
+        except ValueError:
+            pass
+    return datetime.date.fromtimestamp(entry['mtime'])
+
+
+class RecentRule:
+    """Favours images added to the image source in the last `days` days."""
+
+    def __init__(self, weight, days=30):
+        self.weight = weight
+        self.days = days
+
+    def get_weight(self, image_path, entry, today: datetime.date) -> float:
+        added_date = datetime.date.fromtimestamp(entry['mtime'])
+        return self.weight if (today - added_date).days <= self.days else 1.0
+
+
+class OnThisDayRule:
+    """Favours images taken on this day of the year, in earlier years."""
+
+    def __init__(self, weight, window_days=0):
+        self.weight = weight
+        # How many days either side of today still count as "this day".
+        self.window_days = window_days
+
+    def get_weight(self, image_path, entry, today: datetime.date) -> float:
+        image_date = get_taken_date(entry)
+        if image_date.year >= today.year:
+            return 1.0
+        try:
+            anniversary = image_date.replace(year=today.year)
+        except ValueError:
+            # 29 February, in a year that isn't a leap year.
+            anniversary = image_date.replace(year=today.year, day=28)
+        is_anniversary = abs((today - anniversary).days) <= self.window_days
+        return self.weight if is_anniversary else 1.0
+
+
+class FavouritesRule:
+    """Favours the images with the given file names."""
+
+    def __init__(self, weight, file_names=()):
+        self.weight = weight
+        self.file_names = set(file_names)
+
+    def get_weight(self, image_path, entry, today: datetime.date) -> float:
+        return self.weight if os.path.basename(image_path) in self.file_names else 1.0
+
+
+# Rule name, as used in the display config -> weighting rule class.
+WEIGHTING_RULES = {
+    'recent': RecentRule,
+    'on_this_day': OnThisDayRule,
+    'favourites': FavouritesRule,
+}
+
+
+def create_weighting_rules(logger: Logger, rule_configs: List[dict]) -> list:
+    """Returns the weighting rules described by the display config."""
+    weighting_rules = []
+    for rule_config in rule_configs:
+        rule_params = dict(rule_config)
+        rule_name = rule_params.pop('rule', None)
+        if rule_name not in WEIGHTING_RULES:
+            logger.error(f"Unknown weighting rule '{rule_name}'. Ignoring it.")
+            continue
+        try:
+            weighting_rules.append(WEIGHTING_RULES[rule_name](**rule_params))
+        except TypeError as e:
+            logger.error(f"Invalid weighting rule '{rule_name}': {e}")
+    return weighting_rules
+
+
+class WeightedScheduler:
+    """Draws images at random, weighted by the configured weighting rules.
+
+    Each image's weight is the product of the weights every rule gives it.
+    Weights are kept in a Fenwick tree, so drawing an image and updating an
+    image's weight are both O(log n). Weights are recomputed in full only when
+    the image index changes, or once a day for date-based rules. Newly crawled
+    images are reweighted one by one.
+
+    Unlike the shuffle-bag schedule, images can repeat before every image has
+    been shown, which is what lets favoured images be shown more often. An
+    image is never picked twice in a row, though. If a near-duplicate filter
+    is given, images it suppresses are redrawn.
+    """
+    logger: Logger
+    display_config: DisplayConfig
+    image_index: ImageIndex
+    metadata_store: Optional[MetadataStore]
+    near_duplicate_filter: Optional[NearDuplicateFilter]
+
+    def __init__(self, logger, display_config, image_index, metadata_store=None,
+                 near_duplicate_filter=None, today_fn=datetime.date.today):
+        self.logger = logger
+        self.display_config = display_config
+        self.image_index = image_index
+        # If given, images are dated by their crawled EXIF dates.
+        self.metadata_store = metadata_store
+        self.near_duplicate_filter = near_duplicate_filter
+        self.today_fn = today_fn
+        self.weighting_rules = create_weighting_rules(
+            logger, display_config.config['schedule']['weighting_rules'])
+
+        # Protects all of the state below.
+        self.lock = threading.Lock()
+        # Index entries, with their crawled EXIF dates, as last weighted.
+        self.entries: Dict[str, dict] = {}
+        self.paths: List[str] = []
+        self.path_positions: Dict[str, int] = {}
+        self.tree = FenwickTree([])
+        # The image index generation, and the day, that the weights were
+        # computed for.
+        self.synced_generation = None
+        self.synced_day: Optional[datetime.date] = None
+        # Picks drawn ahead of time, so that upcoming picks can be peeked.
+        self.upcoming_paths = collections.deque()
+        self.last_pick: Optional[str] = None
+        self.rng = random.Random()
+
+        # Records put in the metadata store since the last sync. Kept apart
+        # from `lock`, so that the crawler never waits on a sync.
+        self.new_records_lock = threading.Lock()
+        self.new_records = []
+        if self.metadata_store is not None:
+            self.metadata_store.add_listener(self.on_records_put)
+
+    def get_weight(self, image_path, entry, today) -> float:
+        weight = 1.0
+        for weighting_rule in self.weighting_rules:
+            weight *= weighting_rule.get_weight(image_path, entry, today)
+        return weight
+
+    def on_records_put(self, records) -> None:
+        with self.new_records_lock:
+            self.new_records.extend(records)
+
+    def sync(self) -> None:
+        """Brings the weights up to date with the index, the metadata store
+        and the day. Expects `lock` to be held.
+
+        Newly crawled EXIF dates only reweight their own images. The weights
+        are only recomputed in full when the index or the day changes.
+        """
+        with self.new_records_lock:
+            new_records, self.new_records = self.new_records, []
+        today = self.today_fn()
+        generation = self.image_index.generation
+        if self.synced_generation != generation or self.synced_day != today:
+            self.synced_generation = generation
+            self.synced_day = today
+            self.reweight_all(today)
+            return
+        for image_path, entry, metadata in new_records:
+            if 'exif_date' not in metadata:
+                continue
+            position = self.path_positions.get(image_path)
+            synced_entry = self.entries.get(image_path)
+            if position is None or synced_entry is None or \
+                    (synced_entry['size'], synced_entry['mtime']) != \
+                    (entry['size'], entry['mtime']):
+                continue
+            self.entries[image_path] = dict(synced_entry, exif_date=metadata['exif_date'])
+            self.tree.update(position, self.get_weight(
+                image_path, self.entries[image_path], today))
+
+    def reweight_all(self, today) -> None:
+        """Recomputes every image's weight. Expects `lock` to be held."""
+        entries = self.image_index.get_entries()
+        if self.metadata_store is not None:
+            # The store reads its own, possibly newer, snapshot of the index.
+            for image_path, metadata in self.metadata_store.get_all().items():
+                entry = entries.get(image_path)
+                if entry is not None:
+                    entries[image_path] = dict(entry, exif_date=metadata['exif_date'])
+        self.entries = entries
+        self.paths = sorted(entries)
+        self.path_positions = {image_path: position
+                               for position, image_path in enumerate(self.paths)}
+        self.tree = FenwickTree(self.get_weight(image_path, entries[image_path], today)
+                                for image_path in self.paths)
+        self.upcoming_paths = collections.deque(
+            image_path for image_path in self.upcoming_paths if image_path in entries)
+        self.logger.info("Weighted %s images for %s.", len(self.paths), today)
+
+    def apply_config_changes(self, changes: ConfigChanges) -> None:
+        """Reweights the images if the weighting rules have changed."""
+        if ('schedule', 'weighting_rules') not in changes:
+            return
+        with self.lock:
+            self.weighting_rules = create_weighting_rules(
+                self.logger, self.display_config.config['schedule']['weighting_rules'])
+            self.synced_generation = None
+
+    def set_weight(self, image_path, weight) -> None:
+        """Overrides the weight of the given image until the weights are next
+        recomputed."""
+        with self.lock:
+            self.sync()
+            position = self.path_positions.get(image_path)
+            if position is not None:
+                self.tree.update(position, weight)
+
+    def draw(self) -> Optional[str]:
+        """Draws a random image, redrawing near-duplicates of recent picks.
+        Expects `lock` to be held."""
+        image_path = self.draw_once()
+        if self.near_duplicate_filter is None:
+            return image_path
+        for _ in range(MAX_SUPPRESSED_DRAWS):
+            if image_path is None or not self.near_duplicate_filter.is_suppressed(
+                    image_path, self.upcoming_paths):
+                break
+            metrics.increment('near_duplicates_suppressed')
+            image_path = self.draw_once()
+        return image_path
+
+    def draw_once(self) -> Optional[str]:
+        """Draws a random image. Expects `lock` to be held."""
+        if not self.paths or self.tree.total <= 0:
+            return None
+        # Never show an image twice in a row, by leaving the previous pick
+        # out of the draw, unless it's the only image with any weight.
+        previous_path = self.upcoming_paths[-1] if self.upcoming_paths else self.last_pick
+        previous_position = self.path_positions.get(previous_path)
+        if previous_position is None:
+            return self.paths[self.tree.draw(self.rng)]
+        previous_weight = self.tree.weights[previous_position]
+        self.tree.update(previous_position, 0.0)
+        try:
+            if self.tree.total <= 0:
+                return previous_path
+            return self.paths[self.tree.draw(self.rng)]
+        finally:
+            self.tree.update(previous_position, previous_weight)
+
+    def next(self) -> Optional[str]:
+        """Returns the next image path, or None if the image index is empty."""
+        with self.lock:
+            self.sync()
+            image_path = self.upcoming_paths.popleft() if self.upcoming_paths else self.draw()
+            if image_path is not None:
+                self.last_pick = image_path
+                if self.near_duplicate_filter is not None:
+                    self.near_duplicate_filter.record_pick(image_path)
+            return image_path
+
+    def peek(self, num_images) -> List[str]:
+        """Returns the next `num_images` picks without consuming them."""
+        with self.lock:
+            self.sync()
+            while len(self.upcoming_paths) < num_images:
+                image_path = self.draw()
+                if image_path is None:
+                    break
+                self.upcoming_paths.append(image_path)
+            return list(self.upcoming_paths)[:num_images]
@@ -1,20 +1,69 @@
 #!/usr/bin/python3
 
+"""Renders images with the display's image processing pipeline.
+
+Usage:
+    python display_image.py [show] $IMAGE_FILE_PATH
+        Shows the given image on the eInk display.
+    python display_image.py prerender [--config display_config.json]
+                                      [--resolution WIDTHxHEIGHT] [--processes N]
+        Renders every image in the album into the frame cache ahead of time,
+        so the display never has to wait on rendering.
+"""
+
+import argparse
+import logging
 import os
 import sys
 from PIL import Image
-from inky.auto import auto
 from common import image_processor
 
 
 PATH = os.path.dirname(__file__)
+SUBCOMMANDS = ('show', 'prerender')
 
-if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("USage: python display_image.py $IMAGE_FILE_PATH")
-        sys.exit(1)
 
-    image_file_path = sys.argv[1]
+def parse_resolution(resolution) -> tuple:
+    """Parses a 'WIDTHxHEIGHT' resolution."""
+    try:
+        width, height = (int(dimension) for dimension in resolution.lower().split('x'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"'{resolution}' isn't of the form WIDTHxHEIGHT.")
+    if width <= 0 or height <= 0:
+        raise argparse.ArgumentTypeError(f"'{resolution}' must be positive.")
+    return (width, height)
+
+
+def parse_args(argv) -> argparse.Namespace:
+    """Parses the command line. A lone image path is taken to mean `show`,
+    as it was before there were subcommands."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    show_parser = subparsers.add_parser('show', help="Show an image on the eInk display.")
+    show_parser.add_argument('image_file_path', help="Path of the image to show.")
+
+    prerender_parser = subparsers.add_parser(
+        'prerender', help="Render the whole album into the frame cache.")
+    prerender_parser.add_argument('--config', default='./display_config.json',
+                                  help="Path of the display config.")
+    prerender_parser.add_argument(
+        '--resolution', type=parse_resolution,
+        help="Resolution to render at, e.g. 600x448. Defaults to the connected "
+             "panel's resolution, or the simulated display's if the config's "
+             "hardware backend is simulated.")
+    prerender_parser.add_argument(
+        '--processes', type=int, default=os.cpu_count() or 1,
+        help="Number of images to render in parallel. Defaults to the number of CPUs.")
+
+    if argv and argv[0] not in SUBCOMMANDS and not argv[0].startswith('-'):
+        argv = ['show', *argv]
+    return parser.parse_args(argv)
+
+
+def show_image(image_file_path):
+    from inky.auto import auto
+
     if not os.path.exists(image_file_path):
         print(f"Error: File '{image_file_path}' does not exist.")
         sys.exit(1)
@@ -30,12 +79,55 @@ if __name__ == "__main__":
         pass
 
     # Image processing.
-    filename = sys.argv[1]
-    img = Image.open(os.path.join(PATH, filename))
-    width, height = inky_display.resolution
-    img = image_processor.central_crop(img, width / height)
-    img = img.resize(inky_display.resolution)
+    img = Image.open(os.path.join(PATH, image_file_path))
+    img = image_processor.prepare_for_display(img, inky_display.resolution)
 
     # Display the logo image
     inky_display.set_image(img)
     inky_display.show()
+
+
+def get_panel_resolution(display_config) -> tuple:
+    """Returns the resolution of the display the config drives."""
+    from common.screen_manager import SIMULATED_HARDWARE_BACKEND
+
+    hardware_config = display_config.config['hardware']
+    if hardware_config['backend'] == SIMULATED_HARDWARE_BACKEND:
+        return tuple(hardware_config['simulated_resolution'])
+
+    from inky.auto import auto
+    return tuple(auto(ask_user=True, verbose=True).resolution)
+
+
+def prerender(args):
+    from common.display_config import DisplayConfig
+    from common.prerender import prerender_album
+
+    logging.basicConfig(level=logging.WARNING,
+                        format='[%(asctime)s] %(message)s', datefmt='%Y-%m-%d %H:%M')
+    logger = logging.getLogger(__name__)
+    display_config = DisplayConfig(logger, args.config)
+    resolution = args.resolution or get_panel_resolution(display_config)
+
+    def print_progress(num_done, num_images, image_path, status):
+        print(f"[{num_done}/{num_images}] {status}: {image_path}")
+
+    print(f"Pre-rendering the album at {resolution[0]}x{resolution[1]} "
+          f"with {args.processes} processes...")
+    stats = prerender_album(logger, display_config, resolution, max(1, args.processes),
+                            on_progress=print_progress)
+    print(f"Rendered {stats['num_rendered']}, already cached {stats['num_cached']}, "
+          f"rejected {stats['num_rejected']}, failed {stats['num_failed']} "
+          f"of {stats['num_images']} images "
+          f"in {stats['elapsed_secs']}s ({stats['images_per_sec']} images/s, "
+          f"{stats['rendered_per_sec']} renders/s).")
+    if stats['num_failed']:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    args = parse_args(sys.argv[1:])
+    if args.command == 'show':
+        show_image(args.image_file_path)
+    else:
+        prerender(args)
@@ -0,0 +1,53 @@
+#!/usr/bin/python3
+
+"""Runs the render server, which serves rendered frames to displays on the LAN.
+
+Run this on a host with access to the image source, and set
+`render_client.enabled` and `render_client.server_url` in each display's
+config to fetch frames from it.
+
+Usage: python serve_frames.py [--config display_config.json]
+"""
+
+import argparse
+import logging
+import threading
+
+from common.display_config import DisplayConfig
+from common.metrics import MetricsExporter
+from common.render_server import RenderServer
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--config', default='./display_config.json',
+                        help="Path of the display config.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO,
+                        format='[%(asctime)s] %(message)s', datefmt='%Y-%m-%d %H:%M')
+    logger = logging.getLogger(__name__)
+    display_config = DisplayConfig(logger, args.config)
+    render_server = RenderServer(logger, display_config)
+
+    image_retriever = render_server.image_retriever
+    threading.Thread(target=image_retriever.image_index.refresh_in_background,
+                     daemon=True).start()
+    threading.Thread(target=image_retriever.metadata_store.crawl_in_background,
+                     daemon=True).start()
+    if display_config.config['config_reload']['enabled']:
+        threading.Thread(target=display_config.watch_in_background, daemon=True).start()
+    if display_config.config['metrics']['export_enabled']:
+        metrics_exporter = MetricsExporter(logger, display_config)
+        threading.Thread(target=metrics_exporter.export_in_background, daemon=True).start()
+
+    try:
+        render_server.serve()
+    except KeyboardInterrupt:
+        logger.info("Exiting program...")
+    finally:
+        render_server.stop()
+
+
+if __name__ == "__main__":
+    main()
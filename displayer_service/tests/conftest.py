@@ -0,0 +1,28 @@
+"""Fixtures shared between the unit test suites."""
+import logging
+import pytest
+
+from common.display_config import DisplayConfig
+
+
+@pytest.fixture()
+def display_config(tmp_path):
+    """The test display config, with everything the service writes to disk
+    redirected into the test's temporary directory.
+
+    Test modules that need other settings override this fixture, building on
+    it and changing only the keys they care about.
+    """
+    display_config = DisplayConfig(
+        logging.getLogger(), './tests/test_display_config.json')
+    config = display_config.config
+    config['hardware']['simulated_output_dir'] = str(tmp_path / 'simulated-display')
+    config['image_index']['index_file_path'] = str(tmp_path / 'index.json')
+    config['metadata']['db_path'] = str(tmp_path / 'metadata.sqlite3')
+    config['retrieval']['local_copy_dir'] = str(tmp_path / 'local-copies')
+    config['frame_cache']['cache_dir'] = str(tmp_path / 'frame-cache')
+    config['state']['state_dir'] = str(tmp_path / 'state')
+    config['logging']['log_file_path'] = str(tmp_path / 'log')
+    config['metrics']['prometheus_textfile_path'] = str(tmp_path / 'metrics.prom')
+    config['metrics']['trace_file_path'] = str(tmp_path / 'trace.jsonl')
+    return display_config
@@ -0,0 +1,71 @@
+"""Unit tests for the debug screen."""
+import logging
+import pytest
+
+from unittest import mock
+
+from common import debug_screen
+from common.fonts import load_font
+from common.log_handlers import RingBufferHandler
+
+
+@pytest.fixture()
+def logs_path(tmp_path):
+    logs_path = tmp_path / 'log'
+    logs_path.write_text(''.join(f"line {line_num}\n" for line_num in range(100)))
+    return str(logs_path)
+
+
+class TestDebugScreen:
+    """Unit test suite for the debug screen."""
+
+    def test_read_last_lines(self, logs_path):
+        last_lines = debug_screen.read_last_lines(logs_path, 3)
+
+        assert last_lines == ['line 97', 'line 98', 'line 99']
+
+    def test_read_last_lines_across_blocks(self, logs_path):
+        last_lines = debug_screen.read_last_lines(logs_path, 5, block_size=4)
+
+        assert last_lines == ['line 95', 'line 96', 'line 97', 'line 98', 'line 99']
+
+    def test_read_last_lines_of_short_file(self, tmp_path):
+        logs_path = tmp_path / 'log'
+        logs_path.write_text("first\nsecond")
+
+        assert debug_screen.read_last_lines(str(logs_path), 22) == ['first', 'second']
+
+    def test_read_last_lines_of_empty_file(self, tmp_path):
+        logs_path = tmp_path / 'log'
+        logs_path.write_text("")
+
+        assert debug_screen.read_last_lines(str(logs_path), 22) == []
+
+    def test_reuses_render_until_new_lines_are_logged(self, logs_path):
+        with mock.patch.object(debug_screen, 'render_log_lines',
+                               wraps=debug_screen.render_log_lines) as render_log_lines:
+            first_img = debug_screen.transform_logs_to_image(logs_path)
+            second_img = debug_screen.transform_logs_to_image(logs_path)
+            assert render_log_lines.call_count == 1
+            assert second_img.tobytes() == first_img.tobytes()
+
+            with open(logs_path, 'a') as logs_file:
+                logs_file.write("a new line\n")
+            debug_screen.transform_logs_to_image(logs_path)
+            assert render_log_lines.call_count == 2
+
+    def test_reuses_render_of_unchanged_ring_buffer(self):
+        ring_buffer_handler = RingBufferHandler(debug_screen.MAX_LINES)
+        with mock.patch.object(debug_screen, 'render_log_lines',
+                               wraps=debug_screen.render_log_lines) as render_log_lines:
+            debug_screen.transform_ring_buffer_to_image(ring_buffer_handler)
+            debug_screen.transform_ring_buffer_to_image(ring_buffer_handler)
+            assert render_log_lines.call_count == 1
+
+            ring_buffer_handler.handle(logging.makeLogRecord({'msg': "a new line"}))
+            debug_screen.transform_ring_buffer_to_image(ring_buffer_handler)
+            assert render_log_lines.call_count == 2
+
+    def test_fonts_are_loaded_once(self):
+        assert load_font(debug_screen.FONT_PATH, debug_screen.FONT_SIZE) is \
+            load_font(debug_screen.FONT_PATH, debug_screen.FONT_SIZE)
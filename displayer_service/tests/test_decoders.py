@@ -0,0 +1,82 @@
+"""Unit tests for the decoder registry and decode budgets."""
+import io
+import pytest
+
+from PIL import Image
+
+from common import decoders
+from common.decoders import ImageProbe, ImageRejected, check_decode_budget, plan_decode
+
+
+DECODE_CONFIG = {
+    'max_pixels': 50 * 1000 * 1000,
+    'max_memory_bytes': 192 * 1024 * 1024,
+    'max_secs': 30,
+}
+
+
+def encode_test_image(size, image_format, mode='RGB'):
+    image_file = io.BytesIO()
+    Image.new(mode, size).save(image_file, format=image_format)
+    image_file.seek(0)
+    return image_file
+
+
+class TestDecodeBudget:
+    """Unit test suite for checking images against the decode budget."""
+
+    def test_small_image_is_within_budget(self):
+        assert plan_decode('./test-images/cherry.jpg', DECODE_CONFIG) == \
+            DECODE_CONFIG['max_pixels']
+
+    def test_huge_jpeg_is_draft_decoded(self):
+        # 1/8 of a 200 MP JPEG is only ~3 MP.
+        probe = ImageProbe('JPEG', (20000, 10000), 'RGB')
+
+        assert probe.min_decode_pixels == 2500 * 1250
+        assert check_decode_budget(probe, DECODE_CONFIG) == DECODE_CONFIG['max_pixels']
+
+    def test_huge_png_is_rejected(self):
+        with pytest.raises(ImageRejected):
+            check_decode_budget(ImageProbe('PNG', (10000, 10000), 'RGBA'), DECODE_CONFIG)
+
+    def test_memory_and_time_budgets(self):
+        # 40 MP is within the pixel budget, but as RGBA converted to RGB it
+        # takes 7 bytes per pixel, and PNGs decode at 0.4s per megapixel.
+        probe = ImageProbe('PNG', (8000, 5000), 'RGBA')
+
+        assert probe.get_max_decode_pixels(DECODE_CONFIG) == \
+            DECODE_CONFIG['max_memory_bytes'] // 7
+        assert probe.get_max_decode_pixels(dict(DECODE_CONFIG, max_secs=8)) == 20 * 1000 * 1000
+
+    def test_plan_decode_reads_only_the_header(self):
+        image_file = encode_test_image((4000, 3000), 'PNG')
+        image_file = io.BytesIO(image_file.getvalue()[:1024])
+
+        assert plan_decode(image_file, DECODE_CONFIG) == DECODE_CONFIG['max_pixels']
+
+
+class TestOpenImage:
+    """Unit test suite for opening images with the registered decoders."""
+
+    def test_opens_registered_formats(self):
+        for image_format in ['JPEG', 'PNG', 'WEBP']:
+            with decoders.open_image(encode_test_image((8, 8), image_format)) as img:
+                assert img.format == image_format
+
+    def test_rejects_unregistered_formats(self, monkeypatch):
+        monkeypatch.delitem(decoders.DECODERS, 'WEBP')
+
+        with pytest.raises(ImageRejected):
+            decoders.open_image(encode_test_image((8, 8), 'WEBP'))
+
+    def test_rejects_non_images(self):
+        with pytest.raises(ImageRejected):
+            decoders.open_image(io.BytesIO(b'not an image'))
+
+    def test_rejects_heif_without_pillow_heif(self, monkeypatch):
+        monkeypatch.delitem(decoders.DECODERS, 'HEIF', raising=False)
+        heif_file = io.BytesIO(b'\0\0\0\x18ftypheic' + bytes(64))
+
+        with pytest.raises(ImageRejected, match='pillow-heif'):
+            decoders.open_image(heif_file)
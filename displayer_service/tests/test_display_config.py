@@ -0,0 +1,187 @@
+"""Unit tests for the display config and its hot reloading."""
+import json
+import logging
+import os
+import threading
+import pytest
+
+from common import file_watcher
+from common.display_config import DisplayConfig, DEFAULT_DISPLAY_CONFIG, \
+    get_config_changes, merge_config, validate_config
+from common.file_watcher import FileWatcher
+
+
+def write_config(config_file_path, display_config_dict):
+    """Atomically replaces the config file, as editors do."""
+    tmp_config_file_path = f"{config_file_path}.tmp"
+    with open(tmp_config_file_path, 'w', encoding='utf-8') as config_file:
+        json.dump(display_config_dict, config_file)
+    os.replace(tmp_config_file_path, config_file_path)
+
+
+@pytest.fixture()
+def config_file_path(tmp_path):
+    config_file_path = str(tmp_path / 'display_config.json')
+    write_config(config_file_path, {"display": {"refresh_period_secs": 3600}})
+    return config_file_path
+
+
+class TestValidateConfig:
+    """Unit test suite for display config validation."""
+
+    def test_default_config_is_valid(self):
+        assert validate_config(DEFAULT_DISPLAY_CONFIG) == []
+
+    def test_wrong_type(self):
+        config = merge_config(DEFAULT_DISPLAY_CONFIG,
+                              {"display": {"allowed_image_extensions": ".jpg"}})
+
+        assert validate_config(config) == [
+            "'display.allowed_image_extensions' must be of type list, not str."]
+
+    def test_numbers_are_interchangeable(self):
+        config = merge_config(DEFAULT_DISPLAY_CONFIG, {"display": {"refresh_period_secs": 0.5}})
+
+        assert validate_config(config) == []
+
+    def test_non_positive_refresh_period(self):
+        config = merge_config(DEFAULT_DISPLAY_CONFIG, {"display": {"refresh_period_secs": 0}})
+
+        assert validate_config(config) == ["'display.refresh_period_secs' must be positive."]
+
+    def test_unset_image_source_dir(self):
+        config = merge_config(DEFAULT_DISPLAY_CONFIG, {"display": {"image_source_dir": " "}})
+
+        assert validate_config(config) == ["'display.image_source_dir' must be set."]
+
+    def test_missing_section(self):
+        config = merge_config(DEFAULT_DISPLAY_CONFIG, {"render": None})
+
+        assert validate_config(config) == ["'render' must be an object."]
+
+
+class TestLoad:
+    """Unit test suite for loading the display config on startup."""
+
+    def test_exits_if_image_source_dir_unset(self, config_file_path):
+        write_config(config_file_path, {"display": {"image_source_dir": ""}})
+
+        with pytest.raises(SystemExit):
+            DisplayConfig(logging.getLogger(), config_file_path)
+
+
+class TestConfigChanges:
+    """Unit test suite for diffing display configs."""
+
+    def test_changed_keys(self):
+        new_config = merge_config(DEFAULT_DISPLAY_CONFIG, {
+            "display": {"image_source_dir": "/album"},
+            "schedule": {"mode": "weighted"},
+        })
+
+        assert get_config_changes(DEFAULT_DISPLAY_CONFIG, new_config) == {
+            ('display', 'image_source_dir'), ('schedule', 'mode')}
+
+    def test_no_changes(self):
+        assert get_config_changes(DEFAULT_DISPLAY_CONFIG,
+                                  merge_config(DEFAULT_DISPLAY_CONFIG, {})) == set()
+
+
+class TestReload:
+    """Unit test suite for reloading the display config."""
+
+    def test_swaps_in_valid_config(self, config_file_path):
+        display_config = DisplayConfig(logging.getLogger(), config_file_path)
+        changes = []
+        display_config.add_listener(changes.append)
+
+        write_config(config_file_path, {"display": {"refresh_period_secs": 60}})
+
+        assert display_config.reload()
+        assert display_config.config['display']['refresh_period_secs'] == 60
+        assert changes == [{('display', 'refresh_period_secs')}]
+
+    def test_keeps_config_if_invalid(self, config_file_path):
+        display_config = DisplayConfig(logging.getLogger(), config_file_path)
+        old_config = display_config.config
+        changes = []
+        display_config.add_listener(changes.append)
+
+        write_config(config_file_path, {"display": {"refresh_period_secs": -1}})
+        assert not display_config.reload()
+        with open(config_file_path, 'w', encoding='utf-8') as config_file:
+            config_file.write('{')
+        assert not display_config.reload()
+
+        assert display_config.config is old_config
+        assert changes == []
+
+    def test_warns_about_startup_only_settings(self, config_file_path, caplog):
+        display_config = DisplayConfig(logging.getLogger(), config_file_path)
+
+        write_config(config_file_path, {
+            "display": {"refresh_period_secs": 3600},
+            "render": {"backend": "process_pool", "num_processes": 4},
+            "metadata": {"crawler_niceness": 10},
+        })
+        with caplog.at_level(logging.WARNING):
+            assert display_config.reload()
+
+        warnings = [record.getMessage() for record in caplog.records
+                    if record.levelno == logging.WARNING]
+        for config_key in ['render.backend', 'render.num_processes', 'metadata.crawler_niceness']:
+            assert f"'{config_key}' only takes effect after a restart." in warnings
+
+    def test_listener_errors_are_contained(self, config_file_path):
+        display_config = DisplayConfig(logging.getLogger(), config_file_path)
+        changes = []
+
+        def broken_listener(_):
+            raise RuntimeError("Broken listener.")
+        display_config.add_listener(broken_listener)
+        display_config.add_listener(changes.append)
+
+        write_config(config_file_path, {"display": {"refresh_period_secs": 60}})
+
+        assert display_config.reload()
+        assert len(changes) == 1
+
+
+class TestFileWatcher:
+    """Unit test suite for watching the config file."""
+
+    @pytest.mark.parametrize('use_inotify', [True, False])
+    def test_reports_changes(self, config_file_path, monkeypatch, use_inotify):
+        if not use_inotify:
+            monkeypatch.setattr(file_watcher, '_load_libc', lambda: None)
+        watcher = FileWatcher(logging.getLogger(), config_file_path, poll_secs=0.05)
+        changed = threading.Event()
+        watcher_thread = threading.Thread(
+            target=watcher.watch, args=(changed.set,), daemon=True)
+        watcher_thread.start()
+
+        # Let the watcher take its first look at the file.
+        assert not changed.wait(0.2)
+        write_config(config_file_path, {"display": {"refresh_period_secs": 60}})
+
+        assert changed.wait(5)
+        watcher.stop()
+        watcher_thread.join(5)
+        assert not watcher_thread.is_alive()
+
+    def test_watch_in_background_reloads(self, config_file_path):
+        display_config = DisplayConfig(logging.getLogger(), config_file_path)
+        display_config.config['config_reload']['poll_secs'] = 0.05
+        reloaded = threading.Event()
+        display_config.add_listener(lambda _: reloaded.set())
+        watcher_thread = threading.Thread(
+            target=display_config.watch_in_background, daemon=True)
+        watcher_thread.start()
+
+        assert not reloaded.wait(0.2)
+        write_config(config_file_path, {"display": {"refresh_period_secs": 60}})
+
+        assert reloaded.wait(5)
+        assert display_config.config['display']['refresh_period_secs'] == 60
+        display_config.stop_watching()
+        watcher_thread.join(5)
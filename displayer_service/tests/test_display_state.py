@@ -0,0 +1,73 @@
+"""Unit tests for display state persistence."""
+import logging
+import pytest
+
+from PIL import Image
+
+from common.display_state import DisplayState, get_frame_fingerprint
+
+
+@pytest.fixture()
+def display_state(display_config):
+    return DisplayState(logging.getLogger(), display_config)
+
+
+class TestDisplayState:
+    """Unit test suite for display state persistence."""
+
+    def test_last_frame_round_trip(self, display_state):
+        frame = Image.new('P', (6, 4), 3)
+        frame.putpalette([0, 0, 0] * 256)
+
+        display_state.save_last_frame(frame)
+        last_frame = display_state.load_last_frame()
+
+        assert last_frame.mode == 'P'
+        assert last_frame.tobytes() == frame.tobytes()
+
+    def test_no_last_frame(self, display_state):
+        assert display_state.load_last_frame() is None
+
+    def test_buffer_manifest_round_trip(self, display_state):
+        manifest = [{'source_path': 'a.jpg', 'frame_key': 'key-a'}]
+
+        display_state.save_buffer_manifest(manifest)
+
+        assert display_state.load_buffer_manifest() == manifest
+
+    def test_corrupt_buffer_manifest(self, display_state):
+        with open(display_state.buffer_manifest_path, 'w') as manifest_file:
+            manifest_file.write('{')
+
+        assert display_state.load_buffer_manifest() == []
+
+    def test_shown_fingerprint_round_trip(self, display_state):
+        display_state.save_shown_fingerprint("abc123")
+
+        assert display_state.load_shown_fingerprint() == "abc123"
+
+    def test_no_shown_fingerprint(self, display_state):
+        assert display_state.load_shown_fingerprint() is None
+
+        display_state.save_shown_fingerprint('')
+
+        assert display_state.load_shown_fingerprint() is None
+
+
+class TestFrameFingerprint:
+    """Unit test suite for frame fingerprints."""
+
+    def test_identical_frames_match(self):
+        frame = Image.new('P', (6, 4), 3)
+        same_frame = Image.new('P', (6, 4), 3)
+
+        assert get_frame_fingerprint(frame) == get_frame_fingerprint(same_frame)
+
+    def test_different_frames_differ(self):
+        frame = Image.new('P', (6, 4), 3)
+        changed_frame = frame.copy()
+        changed_frame.putpixel((5, 3), 2)
+
+        assert get_frame_fingerprint(frame) != get_frame_fingerprint(changed_frame)
+        assert get_frame_fingerprint(frame) != \
+            get_frame_fingerprint(Image.new('P', (4, 6), 3))
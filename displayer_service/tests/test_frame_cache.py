@@ -0,0 +1,96 @@
+"""Unit tests for the frame cache and frame renderer."""
+import io
+import logging
+import os
+
+from PIL import Image
+
+from common.frame_cache import FrameCache, digest_image_file, make_frame_key
+from common.frame_renderer import FrameRenderer
+
+
+TEST_IMAGE_PATH = "./test-images/watermelon.jpg"
+
+
+def make_frame(colour_index):
+    frame = Image.new('P', (60, 40), colour_index)
+    frame.putpalette([0, 0, 0, 255, 255, 255, 255, 0, 0])
+    return frame
+
+
+class TestFrameCache:
+    """Unit test suite for the frame cache."""
+
+    def test_digest_path_matches_file_object(self):
+        with open(TEST_IMAGE_PATH, 'rb') as image_file:
+            image_bytes = io.BytesIO(image_file.read())
+
+        assert digest_image_file(TEST_IMAGE_PATH) == digest_image_file(image_bytes)
+        assert image_bytes.tell() == 0
+
+    def test_frame_key_depends_on_options(self):
+        key = make_frame_key('abc', (600, 448), {'burn_date': True})
+
+        assert key == make_frame_key('abc', (600, 448), {'burn_date': True})
+        assert key != make_frame_key('abc', (600, 448), {'burn_date': False})
+        assert key != make_frame_key('abc', (640, 400), {'burn_date': True})
+
+    def test_put_then_get(self, display_config):
+        frame_cache = FrameCache(logging.getLogger(), display_config)
+        frame_cache.put('key', make_frame(2))
+
+        frame = frame_cache.get('key')
+
+        assert frame.mode == 'P'
+        assert frame.getpixel((0, 0)) == 2
+        assert frame_cache.get('missing') is None
+        assert frame_cache.hit_rate == 0.5
+
+    def test_evicts_least_recently_used(self, display_config):
+        frame_cache = FrameCache(logging.getLogger(), display_config)
+        frame_cache.put('a', make_frame(0))
+        frame_size = frame_cache.total_size_bytes
+        display_config.config['frame_cache']['max_size_bytes'] = frame_size * 2
+        frame_cache.put('b', make_frame(0))
+        frame_cache.get('a')
+
+        frame_cache.put('c', make_frame(0))
+
+        assert 'a' in frame_cache
+        assert 'b' not in frame_cache
+        assert 'c' in frame_cache
+        assert not os.path.exists(frame_cache.frame_path('b'))
+
+    def test_persists_across_instances(self, display_config):
+        FrameCache(logging.getLogger(), display_config).put('key', make_frame(1))
+
+        assert 'key' in FrameCache(logging.getLogger(), display_config)
+
+
+class TestFrameRenderer:
+    """Unit test suite for the frame renderer."""
+
+    def test_render_caches_frame(self, display_config):
+        frame_renderer = FrameRenderer(
+            logging.getLogger(), display_config, (600, 448))
+
+        frame = frame_renderer.render(TEST_IMAGE_PATH)
+
+        assert frame.mode == 'P'
+        assert frame.size == (600, 448)
+        assert frame_renderer.get_frame_key(TEST_IMAGE_PATH) in \
+            frame_renderer.frame_cache
+        cached_frame = frame_renderer.render(TEST_IMAGE_PATH)
+        assert cached_frame.tobytes() == frame.tobytes()
+        assert frame_renderer.frame_cache.num_hits == 1
+
+    def test_render_keeps_exif_date(self, display_config):
+        frame_renderer = FrameRenderer(
+            logging.getLogger(), display_config, (600, 448))
+
+        frame = frame_renderer.render(TEST_IMAGE_PATH)
+        cached_frame = frame_renderer.render(TEST_IMAGE_PATH)
+
+        assert frame.info['exif_date'] == "2023:03:06 15:03:42"
+        assert cached_frame.info['exif_date'] == "2023:03:06 15:03:42"
+        assert cached_frame.info['frame_key'] == frame.info['frame_key']
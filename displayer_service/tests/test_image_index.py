@@ -0,0 +1,119 @@
+"""Unit tests for the image index."""
+import logging
+import os
+import shutil
+import pytest
+
+from common.image_index import ImageIndex
+
+
+TEST_IMAGE_DIR = "./test-images"
+
+
+@pytest.fixture()
+def image_source_dir(tmp_path):
+    """A writable copy of a few test images."""
+    source_dir = tmp_path / 'album'
+    source_dir.mkdir()
+    for basename in ['avocado.jpg', 'cherry.jpg', 'rose.png']:
+        shutil.copy(os.path.join(TEST_IMAGE_DIR, basename), source_dir)
+    (source_dir / 'notes.txt').write_text('not an image')
+    return source_dir
+
+
+@pytest.fixture()
+def display_config(display_config, image_source_dir):
+    display_config.config['display']['image_source_dir'] = str(
+        image_source_dir)
+    return display_config
+
+
+class TestImageIndex:
+    """Unit test suite for the image index."""
+
+    def test_refresh_builds_index(self, display_config, image_source_dir):
+        image_index = ImageIndex(logging.getLogger(), display_config)
+
+        assert image_index.refresh() == (3, 0, 0)
+        assert set(image_index.get_paths()) == {
+            os.path.join(str(image_source_dir), basename)
+            for basename in ['avocado.jpg', 'cherry.jpg', 'rose.png']}
+        entry = image_index.get_entry(
+            os.path.join(str(image_source_dir), 'rose.png'))
+        assert entry['extension'] == '.png'
+        assert entry['size'] == os.path.getsize(
+            os.path.join(TEST_IMAGE_DIR, 'rose.png'))
+
+    def test_refresh_applies_diff(self, display_config, image_source_dir):
+        image_index = ImageIndex(logging.getLogger(), display_config)
+        image_index.refresh()
+
+        os.remove(image_source_dir / 'cherry.jpg')
+        shutil.copy(os.path.join(TEST_IMAGE_DIR, 'duck.jpg'), image_source_dir)
+        with open(image_source_dir / 'avocado.jpg', 'ab') as image_file:
+            image_file.write(b'\0')
+
+        assert image_index.refresh() == (1, 1, 1)
+        assert len(image_index) == 3
+        assert os.path.join(str(image_source_dir), 'cherry.jpg') \
+            not in image_index.get_paths()
+
+    def test_index_persists_across_instances(self, display_config):
+        ImageIndex(logging.getLogger(), display_config).refresh()
+
+        reloaded_index = ImageIndex(logging.getLogger(), display_config)
+
+        assert reloaded_index.is_built
+        assert len(reloaded_index) == 3
+
+    def test_index_rebuilt_when_source_dir_changes(self, display_config):
+        ImageIndex(logging.getLogger(), display_config).refresh()
+        display_config.config['display']['image_source_dir'] = TEST_IMAGE_DIR
+
+        reloaded_index = ImageIndex(logging.getLogger(), display_config)
+
+        assert not reloaded_index.is_built
+
+    def test_sample_returns_distinct_paths(self, display_config):
+        image_index = ImageIndex(logging.getLogger(), display_config)
+        image_index.refresh()
+
+        assert len(set(image_index.sample(3))) == 3
+        assert len(image_index.sample(10)) == 3
+
+    def test_rejected_images_are_set_aside(self, display_config, image_source_dir):
+        image_index = ImageIndex(logging.getLogger(), display_config)
+        image_index.refresh()
+        rose_path = os.path.join(str(image_source_dir), 'rose.png')
+
+        image_index.mark_rejected(rose_path, "Too large.")
+        reloaded_index = ImageIndex(logging.getLogger(), display_config)
+
+        for index in [image_index, reloaded_index]:
+            assert rose_path not in index.get_paths()
+            assert index.get_rejected() == {rose_path: "Too large."}
+            assert index.refresh() == (0, 0, 0)
+            assert len(index) == 2
+
+    def test_changed_rejected_images_are_retried(self, display_config, image_source_dir):
+        image_index = ImageIndex(logging.getLogger(), display_config)
+        image_index.refresh()
+        rose_path = os.path.join(str(image_source_dir), 'rose.png')
+        image_index.mark_rejected(rose_path, "Too large.")
+
+        with open(rose_path, 'ab') as image_file:
+            image_file.write(b'\0')
+
+        assert image_index.refresh() == (0, 1, 0)
+        assert rose_path in image_index.get_paths()
+        assert image_index.get_rejected() == {}
+
+    def test_decode_budget_change_clears_rejections(self, display_config, image_source_dir):
+        image_index = ImageIndex(logging.getLogger(), display_config)
+        image_index.refresh()
+        image_index.mark_rejected(os.path.join(str(image_source_dir), 'rose.png'), "Too large.")
+
+        image_index.apply_config_changes({('decode', 'max_pixels')})
+
+        assert len(image_index) == 3
+        assert image_index.get_rejected() == {}
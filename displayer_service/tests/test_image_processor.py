@@ -1,5 +1,10 @@
+import io
 import unittest
-from common.image_processor import determine_central_crop_coordinates, central_crop
+from PIL import Image, ImageDraw
+from common.image_processor import determine_central_crop_coordinates, central_crop, \
+    determine_content_aware_crop_coordinates, determine_crop_box, CONTENT_AWARE_CROP, \
+    determine_decode_size, decode_for_display, limit_draft_size, prepare_for_display, palettize, \
+    render_frame, blend_palette, compute_dhash, BAYER_DITHER, ROW_DIFFUSION_DITHER
 
 class TestImageProcessorDetermineCropCoordinates(unittest.TestCase):
     def test_determine_central_crop_coordinates_wide(self):
@@ -23,5 +28,203 @@ class TestImageProcessorDetermineCropCoordinates(unittest.TestCase):
         self.assertEqual(expected_crop_coordinates, actual_crop_coordinates)
 
 
+def make_striped_image(size, stripes_box):
+    """Returns a white image with black stripes in the given box."""
+    img = Image.new('RGB', size, 'white')
+    image_draw = ImageDraw.Draw(img)
+    x1, y1, x2, y2 = stripes_box
+    for x in range(x1, x2, 8):
+        image_draw.line((x, y1, x, y2), fill='black', width=3)
+    return img
+
+
+class TestImageProcessorContentAwareCrop(unittest.TestCase):
+    def test_keeps_detail_at_top_of_portrait(self):
+        img = make_striped_image((448, 1200), (0, 50, 448, 300))
+
+        x1, y1, x2, y2 = determine_content_aware_crop_coordinates(img, 600 / 448)
+
+        self.assertEqual((0, 448), (x1, x2))
+        self.assertLessEqual(y1, 50)
+        self.assertGreaterEqual(y2, 300)
+        self.assertAlmostEqual(448 / (600 / 448), y2 - y1)
+
+    def test_keeps_detail_at_side_of_landscape(self):
+        img = make_striped_image((2000, 500), (1700, 0, 1950, 500))
+
+        x1, y1, x2, y2 = determine_content_aware_crop_coordinates(img, 1)
+
+        self.assertEqual((0, 500), (y1, y2))
+        self.assertLessEqual(x1, 1700)
+        self.assertGreaterEqual(x2, 1950)
+
+    def test_featureless_image_is_cropped_centrally(self):
+        img = Image.new('RGB', (1000, 500), 'white')
+
+        self.assertEqual(determine_central_crop_coordinates(1000, 500, 1),
+                         determine_content_aware_crop_coordinates(img, 1))
+
+    def test_crop_box_is_relative(self):
+        img = Image.new('RGB', (1000, 500), 'white')
+
+        self.assertEqual((0.25, 0.0, 0.75, 1.0),
+                         determine_crop_box(img, 1, CONTENT_AWARE_CROP))
+        with self.assertRaises(ValueError):
+            determine_crop_box(img, 1, 'unknown')
+
+    def test_prepare_for_display_uses_given_crop_box(self):
+        img = make_striped_image((1000, 500), (0, 0, 250, 500))
+
+        cropped_img = prepare_for_display(img, (100, 100), crop_box=(0.5, 0.0, 1.0, 1.0))
+
+        self.assertEqual((0.5, 0.0, 1.0, 1.0), cropped_img.info['crop_box'])
+        self.assertEqual((255, 255, 255), cropped_img.getpixel((50, 50)))
+
+
+class TestImageProcessorReducedDecode(unittest.TestCase):
+    def test_determine_decode_size_wide(self):
+        # The 2:1 image is cropped to its central 1000x1000 square, which needs
+        # to cover 100x100.
+        self.assertEqual((200, 100), determine_decode_size(2000, 1000, 100, 100))
+
+    def test_determine_decode_size_tall(self):
+        self.assertEqual((100, 200), determine_decode_size(1000, 2000, 100, 100))
+
+    def test_determine_decode_size_small_image(self):
+        self.assertEqual((50, 50), determine_decode_size(50, 50, 100, 100))
+
+    def test_decode_jpeg_uses_draft(self):
+        img = Image.open('./test-images/cherry.jpg')
+        decoded_img = decode_for_display(img, (600, 448))
+
+        # 5472x3648 is DCT-scaled by 1/8 which still covers 600x448 post-crop.
+        self.assertEqual((684, 456), decoded_img.size)
+        self.assertEqual('RGB', decoded_img.mode)
+
+    def test_decode_jpeg_within_pixel_budget(self):
+        img = Image.open('./test-images/cherry.jpg')
+        decoded_img = decode_for_display(img, (2400, 1792), max_decode_pixels=1000 * 1000)
+
+        # 1/2 scale would cover 2400x1792, but it's over budget, so 1/8 is used.
+        self.assertEqual((684, 456), decoded_img.size)
+
+    def test_limit_draft_size(self):
+        self.assertEqual((2000, 1000), limit_draft_size((4000, 2000), (2000, 1000), 4000 * 2000))
+        self.assertEqual((1000, 500), limit_draft_size((4000, 2000), (2000, 1000), 1000 * 1000))
+        self.assertEqual((500, 250), limit_draft_size((4000, 2000), (2000, 1000), 1))
+        self.assertEqual((300, 200), limit_draft_size((4000, 2000), (300, 200), 1000 * 1000))
+
+    def test_decode_png_uses_reduce(self):
+        img = Image.open('./test-images/rose.png')
+        decoded_img = decode_for_display(img, (600, 448))
+
+        self.assertEqual((634, 919), decoded_img.size)
+        self.assertEqual('RGB', decoded_img.mode)
+
+    def test_decode_applies_exif_orientation(self):
+        img = Image.new('RGB', (2000, 1000), 'white')
+        exif = img.getexif()
+        # Rotated 90 degrees clockwise.
+        exif[274] = 6
+        exif[306] = "2023:03:06 15:03:42"
+        image_bytes = io.BytesIO()
+        img.save(image_bytes, 'JPEG', exif=exif.tobytes())
+        image_bytes.seek(0)
+
+        decoded_img = decode_for_display(Image.open(image_bytes), (600, 448))
+
+        self.assertGreater(decoded_img.height, decoded_img.width)
+        self.assertEqual("2023:03:06 15:03:42", decoded_img.getexif().get(306))
+
+    def test_prepare_for_display(self):
+        for image_path in ['./test-images/cherry.jpg', './test-images/sheep.png',
+                           './test-images/eggplant.jpg']:
+            img = prepare_for_display(Image.open(image_path), (600, 448))
+            self.assertEqual((600, 448), img.size)
+
+
+class TestImageProcessorPalettize(unittest.TestCase):
+    def test_palettize_uses_display_colour_indices(self):
+        img = Image.open('./test-images/avocado.jpg')
+        frame = palettize(img)
+
+        self.assertEqual('P', frame.mode)
+        self.assertLessEqual(max(frame.tobytes()), 6)
+
+    def test_palettize_pure_colours(self):
+        img = Image.new('RGB', (2, 1))
+        img.putpixel((0, 0), (255, 255, 255))
+        img.putpixel((1, 0), (0, 0, 0))
+        frame = palettize(img)
+
+        self.assertEqual([1, 0], list(frame.tobytes()))
+
+    def test_numpy_dithering_uses_display_colour_indices(self):
+        img = prepare_for_display(Image.open('./test-images/avocado.jpg'), (600, 448))
+        for dither in [BAYER_DITHER, ROW_DIFFUSION_DITHER]:
+            frame = palettize(img, dither=dither)
+
+            self.assertEqual('P', frame.mode)
+            self.assertEqual((600, 448), frame.size)
+            self.assertLessEqual(max(frame.tobytes()), 6)
+            self.assertEqual(blend_palette(), frame.getpalette()[:21])
+
+    def test_numpy_dithering_keeps_black_and_white(self):
+        for colour, colour_index in [((0, 0, 0), 0), ((255, 255, 255), 1)]:
+            img = Image.new('RGB', (8, 8), colour)
+            for dither in [BAYER_DITHER, ROW_DIFFUSION_DITHER]:
+                frame = palettize(img, dither=dither)
+
+                self.assertEqual({colour_index}, set(frame.tobytes()))
+
+    def test_numpy_dithering_mixes_colours(self):
+        img = Image.new('RGB', (16, 16), (128, 128, 128))
+        for dither in [BAYER_DITHER, ROW_DIFFUSION_DITHER]:
+            frame = palettize(img, dither=dither)
+
+            # Grey isn't in the palette, so it has to be approximated by a mix.
+            self.assertGreater(len(set(frame.tobytes())), 1)
+
+    def test_unknown_dithering_method(self):
+        with self.assertRaises(ValueError):
+            palettize(Image.new('RGB', (2, 2)), dither='unknown')
+
+    def test_render_frame(self):
+        frame = render_frame(Image.open('./test-images/watermelon.jpg'), (600, 448))
+
+        self.assertEqual('P', frame.mode)
+        self.assertEqual((600, 448), frame.size)
+
+
+def bit_difference(hash_a, hash_b):
+    return bin(hash_a ^ hash_b).count('1')
+
+
+def encode_jpeg(img, quality=90):
+    image_file = io.BytesIO()
+    img.save(image_file, format='JPEG', quality=quality)
+    image_file.seek(0)
+    return Image.open(image_file)
+
+
+class TestImageProcessorPerceptualHash(unittest.TestCase):
+    def test_dhash_of_reencoded_image_is_close(self):
+        original = Image.open('./test-images/watermelon.jpg').convert('RGB')
+        original_hash = compute_dhash(encode_jpeg(original))
+        resized_hash = compute_dhash(encode_jpeg(original.resize((300, 200)), quality=40))
+
+        self.assertLessEqual(bit_difference(original_hash, resized_hash), 6)
+
+    def test_dhash_of_different_images_is_far(self):
+        gradient = Image.linear_gradient('L').convert('RGB')
+        left_to_right = compute_dhash(encode_jpeg(gradient.rotate(90)))
+        right_to_left = compute_dhash(encode_jpeg(gradient.rotate(-90)))
+
+        self.assertGreater(bit_difference(left_to_right, right_to_left), 32)
+
+    def test_dhash_is_64_bits(self):
+        self.assertLess(compute_dhash(Image.open('./test-images/watermelon.jpg')), 1 << 64)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -1,20 +1,21 @@
 """Unit tests for image retriever."""
+import io
 import logging
 import pytest
 import os
+import shutil
 
 from common.image_retriever import ImageRetriever
-from common.display_config import DisplayConfig
+from common.image_source import ImageSourceUnavailable
+from common.weighted_scheduler import WeightedScheduler
 
 
 TEST_IMAGE_DIR = "./test-images"
 
 
 @pytest.fixture()
-def image_retriever():
-    """TODO"""
-    display_config = DisplayConfig(
-        logging.getLogger(), './tests/test_display_config.json')
+def image_retriever(display_config):
+    """Image retriever reading from the test images, with a throwaway index."""
     yield ImageRetriever(logging.getLogger(), display_config)
 
 
@@ -37,8 +38,94 @@ class TestImageRetriever:
 
         assert actual_images == expected_images
 
-    def test_get_random_image():
-        """TODO"""
+    def test_get_random_image(self, image_retriever):
+        """A random image is fetched from the image source."""
+        img = image_retriever.get_random_image()
 
-    def test_get_random_images():
-        """TODO"""
+        img.load()
+        assert img.format in ('JPEG', 'PNG')
+        image_retriever.clean_up_image(img)
+
+    def test_get_random_images(self, image_retriever):
+        """Distinct random images are fetched from the image source."""
+        images = image_retriever.get_random_images(3)
+
+        assert len(images) == 3
+        for img in images:
+            image_retriever.clean_up_image(img)
+
+    def test_fetch_small_image_into_memory(self, image_retriever):
+        """Small images are read into memory rather than copied to disk."""
+        image_path = f"{TEST_IMAGE_DIR}/duck.jpg"
+        image_file = image_retriever.fetch_image_file(image_path)
+
+        assert isinstance(image_file, io.BytesIO)
+        with open(image_path, 'rb') as source_file:
+            assert image_file.getvalue() == source_file.read()
+        image_retriever.clean_up_image_file(image_file)
+
+    def test_read_image_of_changed_size_into_memory(self, image_retriever):
+        """Images that changed size since they were indexed are read in full."""
+        image_retriever.display_config.config['retrieval']['read_chunk_size_bytes'] = 1000
+        image_path = f"{TEST_IMAGE_DIR}/duck.jpg"
+        with open(image_path, 'rb') as source_file:
+            image_bytes = source_file.read()
+
+        for indexed_size in [0, 100, len(image_bytes), 2 * len(image_bytes)]:
+            image_file = image_retriever.read_image_into_memory(image_path, indexed_size)
+            assert image_file.getvalue() == image_bytes
+            assert image_file.tell() == 0
+
+    def test_fetch_large_image_to_disk(self, image_retriever):
+        """Images above the in-memory threshold are copied to local disk."""
+        image_retriever.display_config.config['retrieval']['in_memory_max_bytes'] = 1024
+        image_path = f"{TEST_IMAGE_DIR}/duck.jpg"
+
+        first_copy_path = image_retriever.fetch_image_file(image_path)
+        second_copy_path = image_retriever.fetch_image_file(image_path)
+
+        assert first_copy_path != second_copy_path
+        assert os.path.getsize(first_copy_path) == os.path.getsize(image_path)
+        image_retriever.clean_up_image_file(first_copy_path)
+        image_retriever.clean_up_image_file(second_copy_path)
+        assert not os.path.exists(first_copy_path)
+
+    def test_fetch_from_unavailable_source(self, image_retriever):
+        """Failing to read from the image source is reported as it being unavailable."""
+        with pytest.raises(ImageSourceUnavailable):
+            image_retriever.fetch_image_file(f"{TEST_IMAGE_DIR}/missing.jpg")
+
+    def test_applies_new_image_source_dir(self, image_retriever, tmp_path):
+        """Changing the image source directory re-syncs the index and the schedule."""
+        image_retriever.get_path_of_all_images()
+        new_image_source_dir = tmp_path / 'album'
+        new_image_source_dir.mkdir()
+        shutil.copy(f"{TEST_IMAGE_DIR}/duck.jpg", new_image_source_dir)
+        shutil.copy(f"{TEST_IMAGE_DIR}/rose.png", new_image_source_dir)
+
+        image_retriever.display_config.config['display']['image_source_dir'] = \
+            str(new_image_source_dir)
+        image_retriever.apply_config_changes({('display', 'image_source_dir')})
+
+        expected_images = {str(new_image_source_dir / 'duck.jpg'),
+                           str(new_image_source_dir / 'rose.png')}
+        assert set(image_retriever.get_path_of_all_images()) == expected_images
+        assert {image_retriever.choose_next_image_path() for _ in range(2)} == expected_images
+
+    def test_applies_new_extensions(self, image_retriever):
+        """Changing the allowed extensions re-syncs the index."""
+        image_retriever.get_path_of_all_images()
+
+        image_retriever.display_config.config['display']['allowed_image_extensions'] = ['.png']
+        image_retriever.apply_config_changes({('display', 'allowed_image_extensions')})
+
+        assert all(image_path.endswith('.png')
+                   for image_path in image_retriever.get_path_of_all_images())
+
+    def test_applies_new_schedule_mode(self, image_retriever):
+        """Changing the schedule mode replaces the scheduler."""
+        image_retriever.display_config.config['schedule']['mode'] = 'weighted'
+        image_retriever.apply_config_changes({('schedule', 'mode')})
+
+        assert isinstance(image_retriever.scheduler, WeightedScheduler)
+        assert image_retriever.choose_next_image_path().startswith(TEST_IMAGE_DIR)
@@ -0,0 +1,73 @@
+"""Unit tests for guarded access to the image source."""
+import concurrent.futures
+import threading
+import pytest
+
+from common import image_source
+from common.image_source import ImageSourceUnavailable, run_with_timeout
+
+
+class TestRunWithTimeout:
+    """Unit test suite for running image source I/O with a timeout."""
+
+    def test_returns_result(self):
+        assert run_with_timeout(sum, [1, 2], timeout_secs=5) == 3
+
+    def test_times_out_on_hung_io(self):
+        hung_io = threading.Event()
+
+        with pytest.raises(ImageSourceUnavailable):
+            run_with_timeout(hung_io.wait, timeout_secs=0.05)
+        hung_io.set()
+
+    def test_wraps_os_errors(self):
+        with pytest.raises(ImageSourceUnavailable):
+            run_with_timeout(open, '/nonexistent/image.jpg', timeout_secs=5)
+
+    def test_propagates_other_errors(self):
+        with pytest.raises(ValueError):
+            run_with_timeout(int, 'not a number', timeout_secs=5)
+
+    def test_cancels_queued_calls_on_timeout(self):
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        hung_io = threading.Event()
+        queued_calls = []
+        with pytest.raises(ImageSourceUnavailable):
+            run_with_timeout(hung_io.wait, timeout_secs=0.05, executor=executor)
+        with pytest.raises(ImageSourceUnavailable):
+            run_with_timeout(queued_calls.append, 'stale', timeout_secs=0.05,
+                             executor=executor)
+
+        hung_io.set()
+        executor.shutdown(wait=True)
+
+        assert queued_calls == []
+
+    def test_cleans_up_after_abandoned_calls(self):
+        hung_io = threading.Event()
+        cleaned_up = []
+        cleaned_up_event = threading.Event()
+
+        def clean_up(result):
+            cleaned_up.append(result)
+            cleaned_up_event.set()
+
+        with pytest.raises(ImageSourceUnavailable):
+            run_with_timeout(lambda: hung_io.wait() and 'late copy', timeout_secs=0.05,
+                             on_abandoned=clean_up)
+        hung_io.set()
+
+        assert cleaned_up_event.wait(5)
+        assert cleaned_up == ['late copy']
+
+    def test_scans_dont_wait_on_hung_reads(self):
+        hung_io = threading.Event()
+        for _ in range(image_source.NUM_SOURCE_IO_THREADS):
+            with pytest.raises(ImageSourceUnavailable):
+                run_with_timeout(hung_io.wait, timeout_secs=0.01)
+
+        try:
+            assert run_with_timeout(sum, [1, 2], timeout_secs=5,
+                                    executor=image_source.scan_executor) == 3
+        finally:
+            hung_io.set()
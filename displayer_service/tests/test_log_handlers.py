@@ -0,0 +1,36 @@
+"""Unit tests for the custom logging handlers."""
+import logging
+import pytest
+
+from common.log_handlers import RingBufferHandler
+
+
+@pytest.fixture()
+def ring_buffer_logger():
+    ring_buffer_handler = RingBufferHandler(3)
+    ring_buffer_handler.setFormatter(logging.Formatter('%(message)s'))
+    logger = logging.getLogger('test_log_handlers')
+    logger.propagate = False
+    logger.addHandler(ring_buffer_handler)
+    yield logger, ring_buffer_handler
+    logger.removeHandler(ring_buffer_handler)
+
+
+class TestRingBufferHandler:
+    """Unit test suite for the in-memory ring buffer log handler."""
+
+    def test_keeps_most_recent_lines(self, ring_buffer_logger):
+        logger, ring_buffer_handler = ring_buffer_logger
+        for line_num in range(5):
+            logger.warning("line %s", line_num)
+
+        num_records, lines = ring_buffer_handler.get_lines()
+
+        assert num_records == 5
+        assert lines == ['line 2', 'line 3', 'line 4']
+
+    def test_splits_multiline_records(self, ring_buffer_logger):
+        logger, ring_buffer_handler = ring_buffer_logger
+        logger.warning("first\nsecond")
+
+        assert ring_buffer_handler.get_lines() == (1, ['first', 'second'])
@@ -0,0 +1,232 @@
+"""Unit tests for the image metadata store."""
+import logging
+import os
+import sqlite3
+import pytest
+
+from PIL import Image
+
+from common import metadata_store as metadata_store_module
+from common.frame_renderer import FrameRenderer
+from common.image_index import ImageIndex
+from common.image_processor import compute_dhash
+from common.image_source import ImageSourceUnavailable
+from common.metadata_store import MetadataStore, read_image_metadata
+
+EXIF_DATE = "2023:03:06 15:03:42"
+
+
+def save_test_image(image_path, size=(64, 48), exif_date=EXIF_DATE, orientation=None):
+    exif = Image.Exif()
+    if exif_date:
+        exif[306] = exif_date
+    if orientation:
+        exif[274] = orientation
+    Image.new('RGB', size, 'red').save(image_path, format='JPEG', exif=exif.tobytes())
+
+
+@pytest.fixture()
+def display_config(display_config, tmp_path):
+    image_source_dir = tmp_path / 'images'
+    image_source_dir.mkdir()
+    save_test_image(str(image_source_dir / 'dated.jpg'), orientation=6)
+    save_test_image(str(image_source_dir / 'undated.jpg'), size=(30, 20), exif_date=None)
+
+    display_config.config['display']['image_source_dir'] = str(image_source_dir)
+    return display_config
+
+
+@pytest.fixture()
+def metadata_store(display_config):
+    image_index = ImageIndex(logging.getLogger(), display_config)
+    return MetadataStore(logging.getLogger(), display_config, image_index)
+
+
+def image_path_of(display_config, file_name):
+    return os.path.join(display_config.config['display']['image_source_dir'], file_name)
+
+
+class TestMetadataStore:
+    """Unit test suite for the image metadata store."""
+
+    def test_read_image_metadata(self, display_config):
+        metadata = read_image_metadata(image_path_of(display_config, 'dated.jpg'))
+
+        assert metadata == {'exif_date': EXIF_DATE, 'orientation': 6,
+                            'width': 64, 'height': 48, 'format': 'JPEG',
+                            'dhash': None}
+
+    def test_dhash_from_exif_thumbnail(self, display_config):
+        image_path = './test-images/watermelon.jpg'
+
+        metadata = read_image_metadata(image_path)
+
+        full_dhash = compute_dhash(Image.open(image_path))
+        assert bin(int(metadata['dhash'], 16) ^ full_dhash).count('1') <= 4
+
+    def test_reads_only_headers(self, display_config, metadata_store, monkeypatch):
+        read_sizes = []
+
+        def read_file_start(image_path, num_bytes=-1):
+            read_sizes.append(num_bytes)
+            with open(image_path, 'rb') as image_file:
+                return image_file.read(num_bytes)
+        monkeypatch.setattr(metadata_store_module, 'read_file_start', read_file_start)
+
+        assert metadata_store.crawl() == 2
+        assert read_sizes == [metadata_store_module.HEADER_READ_BYTES] * 2
+
+    def test_crawl_stops_when_source_is_unavailable(self, metadata_store, monkeypatch):
+        def hung_read(image_path, num_bytes=-1):
+            raise ImageSourceUnavailable("Timed out.")
+        monkeypatch.setattr(metadata_store_module, 'read_file_start', hung_read)
+
+        assert metadata_store.crawl() == 0
+        assert len(metadata_store.get_uncrawled_paths()) == 2
+
+    def test_renderer_fills_in_dhash(self, display_config, metadata_store):
+        dated_path = image_path_of(display_config, 'dated.jpg')
+        undated_path = image_path_of(display_config, 'undated.jpg')
+        metadata_store.image_index.refresh()
+        frame_renderer = FrameRenderer(logging.getLogger(), display_config, (60, 40),
+                                       metadata_store)
+
+        # Rendered before being crawled, and after.
+        frame_renderer.render(undated_path, undated_path)
+        metadata_store.crawl()
+        frame_renderer.render(dated_path, dated_path)
+
+        assert metadata_store.get(undated_path)['dhash'] is not None
+        assert metadata_store.get(dated_path)['dhash'] is not None
+
+    def test_crawl(self, display_config, metadata_store):
+        assert metadata_store.crawl() == 2
+
+        dated_metadata = metadata_store.get(image_path_of(display_config, 'dated.jpg'))
+        undated_metadata = metadata_store.get(image_path_of(display_config, 'undated.jpg'))
+        assert dated_metadata['exif_date'] == EXIF_DATE
+        assert undated_metadata['exif_date'] is None
+        assert (undated_metadata['width'], undated_metadata['height']) == (30, 20)
+
+    def test_crawl_rejects_images_over_decode_budget(self, display_config, metadata_store):
+        image_path = image_path_of(display_config, 'large.png')
+        Image.new('RGB', (200, 100)).save(image_path)
+        display_config.config['decode']['max_pixels'] = 10000
+
+        assert metadata_store.crawl() == 2
+
+        assert list(metadata_store.image_index.get_rejected()) == [image_path]
+        assert image_path not in metadata_store.image_index.get_paths()
+        assert metadata_store.get_uncrawled_paths() == []
+
+    def test_crawls_each_version_once(self, display_config, metadata_store):
+        metadata_store.crawl()
+        assert metadata_store.crawl() == 0
+
+        image_path = image_path_of(display_config, 'undated.jpg')
+        save_test_image(image_path, size=(40, 20), exif_date=None)
+        os.utime(image_path, (0, 0))
+        metadata_store.image_index.refresh()
+
+        assert metadata_store.get(image_path) is None
+        assert metadata_store.crawl() == 1
+        assert metadata_store.get(image_path)['width'] == 40
+
+    def test_survives_restart(self, display_config, metadata_store):
+        metadata_store.crawl()
+
+        restarted_store = MetadataStore(
+            logging.getLogger(), display_config, metadata_store.image_index)
+
+        assert set(restarted_store.get_all()) == {
+            image_path_of(display_config, 'dated.jpg'),
+            image_path_of(display_config, 'undated.jpg')}
+
+    def test_rebuilds_store_from_older_schema(self, display_config, metadata_store):
+        metadata_store.crawl()
+        metadata_store.connection.close()
+        connection = sqlite3.connect(display_config.config['metadata']['db_path'])
+        with connection:
+            connection.execute("PRAGMA user_version = 1")
+        connection.close()
+
+        restarted_store = MetadataStore(
+            logging.getLogger(), display_config, metadata_store.image_index)
+
+        assert restarted_store.get_all() == {}
+        assert restarted_store.crawl() == 2
+        assert restarted_store.get(image_path_of(display_config, 'dated.jpg'))['exif_date'] == \
+            EXIF_DATE
+
+    def test_migrates_store_without_crop_boxes(self, display_config, metadata_store):
+        metadata_store.crawl()
+        with metadata_store.connection:
+            metadata_store.connection.execute("DROP TABLE crop_boxes")
+            metadata_store.connection.execute("PRAGMA user_version = 2")
+        metadata_store.connection.close()
+
+        restarted_store = MetadataStore(
+            logging.getLogger(), display_config, metadata_store.image_index)
+
+        assert len(restarted_store.get_all()) == 2
+        assert restarted_store.crawl() == 0
+        image_path = image_path_of(display_config, 'dated.jpg')
+        restarted_store.put_crop_box(image_path, 1.0, (0.0, 0.0, 1.0, 1.0))
+        assert restarted_store.get_crop_box(image_path, 1.0) == (0.0, 0.0, 1.0, 1.0)
+        schema_version, = restarted_store.connection.execute("PRAGMA user_version").fetchone()
+        assert schema_version == metadata_store_module.METADATA_SCHEMA_VERSION
+
+    def test_renderer_reads_date_from_store(self, display_config, metadata_store):
+        image_path = image_path_of(display_config, 'undated.jpg')
+        metadata_store.crawl()
+        stored_metadata = metadata_store.get(image_path)
+        stored_metadata['exif_date'] = "2001:02:03 04:05:06"
+        metadata_store.put_many([(image_path, metadata_store.image_index.get_entry(image_path),
+                                  stored_metadata)])
+        frame_renderer = FrameRenderer(logging.getLogger(), display_config, (60, 40),
+                                       metadata_store)
+
+        frame = frame_renderer.render(image_path, image_path)
+
+        assert frame.info['exif_date'] == "2001:02:03 04:05:06"
+
+    def test_crop_boxes(self, display_config, metadata_store):
+        image_path = image_path_of(display_config, 'dated.jpg')
+        metadata_store.image_index.refresh()
+        metadata_store.put_crop_box(image_path, 600 / 448, (0.0, 0.1, 1.0, 0.9))
+
+        assert metadata_store.get_crop_box(image_path, 600 / 448) == (0.0, 0.1, 1.0, 0.9)
+        assert metadata_store.get_crop_box(image_path, 1.0) is None
+
+        save_test_image(image_path, size=(40, 20))
+        os.utime(image_path, (0, 0))
+        metadata_store.image_index.refresh()
+        assert metadata_store.get_crop_box(image_path, 600 / 448) is None
+
+    def test_crawl_drops_crop_boxes_of_earlier_versions(self, display_config, metadata_store):
+        image_path = image_path_of(display_config, 'dated.jpg')
+        metadata_store.image_index.refresh()
+        metadata_store.put_crop_box(image_path, 1.0, (0.0, 0.1, 1.0, 0.9))
+
+        save_test_image(image_path, size=(40, 20))
+        os.utime(image_path, (0, 0))
+        metadata_store.image_index.refresh()
+        metadata_store.crawl()
+
+        assert metadata_store.connection.execute(
+            "SELECT COUNT(*) FROM crop_boxes").fetchone() == (0,)
+
+    def test_renderer_keeps_crop_box_in_store(self, display_config, metadata_store):
+        image_path = image_path_of(display_config, 'undated.jpg')
+        metadata_store.image_index.refresh()
+        display_config.config['render']['crop_mode'] = 'content_aware'
+        frame_renderer = FrameRenderer(logging.getLogger(), display_config, (40, 40),
+                                       metadata_store)
+
+        frame = frame_renderer.render(image_path, image_path)
+        assert metadata_store.get_crop_box(image_path, 1.0) == frame.info['crop_box']
+
+        metadata_store.put_crop_box(image_path, 1.0, (0.0, 0.0, 0.5, 1.0))
+        frame_renderer.frame_cache.discard(frame.info['frame_key'])
+        assert frame_renderer.render(image_path, image_path).info['crop_box'] == \
+            (0.0, 0.0, 0.5, 1.0)
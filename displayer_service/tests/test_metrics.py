@@ -0,0 +1,98 @@
+"""Unit tests for the timing spans, gauges and their export."""
+import json
+import logging
+import pytest
+
+from common.display_config import DisplayConfig
+from common.metrics import Metrics, MetricsExporter
+
+
+@pytest.fixture()
+def registry():
+    return Metrics()
+
+
+@pytest.fixture()
+def exporter(tmp_path, registry):
+    display_config = DisplayConfig(
+        logging.getLogger(), './tests/test_display_config.json')
+    metrics_config = display_config.config['metrics']
+    metrics_config['prometheus_textfile_path'] = str(tmp_path / 'metrics.prom')
+    metrics_config['trace_file_path'] = str(tmp_path / 'trace.jsonl')
+    return MetricsExporter(logging.getLogger(), display_config, registry)
+
+
+class TestMetrics:
+    """Unit test suite for the metrics registry."""
+
+    def test_span_aggregates(self, registry):
+        registry.record_span('decode', 0.5)
+        registry.record_span('decode', 0.25)
+        with registry.span('show'):
+            pass
+
+        decode_stats = registry.span_stats['decode']
+        assert decode_stats.count == 2
+        assert decode_stats.total_secs == 0.75
+        assert decode_stats.max_secs == 0.5
+        assert decode_stats.last_secs == 0.25
+        assert registry.span_stats['show'].count == 1
+
+    def test_span_recorded_on_exception(self, registry):
+        with pytest.raises(ValueError):
+            with registry.span('copy'):
+                raise ValueError()
+
+        assert registry.span_stats['copy'].count == 1
+
+    def test_prometheus_format(self, registry):
+        registry.record_span('decode', 0.5)
+        registry.set_gauge('frame_buffer_frames', 3)
+        registry.increment('panel_refreshes')
+        registry.increment('panel_refreshes')
+
+        lines = registry.to_prometheus().splitlines()
+
+        assert '# TYPE ink_memories_span_seconds summary' in lines
+        assert 'ink_memories_span_seconds_count{span="decode"} 1' in lines
+        assert 'ink_memories_span_seconds_sum{span="decode"} 0.500000' in lines
+        assert 'ink_memories_span_seconds_max{span="decode"} 0.500000' in lines
+        assert 'ink_memories_frame_buffer_frames 3' in lines
+        assert 'ink_memories_panel_refreshes_total 2' in lines
+
+
+class TestMetricsExporter:
+    """Unit test suite for exporting metrics to disk."""
+
+    def test_writes_prometheus_textfile(self, registry, exporter):
+        registry.set_gauge('frame_buffer_bytes', 1024)
+
+        exporter.export()
+
+        with open(exporter.metrics_config['prometheus_textfile_path']) as textfile:
+            assert 'ink_memories_frame_buffer_bytes 1024' in textfile.read()
+
+    def test_appends_trace(self, registry, exporter):
+        registry.record_span('decode', 0.5)
+        exporter.export()
+        registry.record_span('show', 0.25)
+        exporter.export()
+
+        with open(exporter.metrics_config['trace_file_path']) as trace_file:
+            trace_records = [json.loads(line) for line in trace_file]
+        assert [record['span'] for record in trace_records] == ['decode', 'show']
+        assert trace_records[0]['secs'] == 0.5
+
+    def test_rolls_over_trace(self, registry, exporter):
+        exporter.metrics_config['trace_max_bytes'] = 1
+        trace_file_path = exporter.metrics_config['trace_file_path']
+
+        registry.record_span('decode', 0.5)
+        exporter.export()
+        registry.record_span('show', 0.25)
+        exporter.export()
+
+        with open(trace_file_path) as trace_file:
+            assert [json.loads(line)['span'] for line in trace_file] == ['show']
+        with open(f"{trace_file_path}.1") as rolled_trace_file:
+            assert [json.loads(line)['span'] for line in rolled_trace_file] == ['decode']
@@ -0,0 +1,250 @@
+"""Unit tests for near-duplicate detection."""
+import logging
+import random
+import pytest
+
+from common.near_duplicates import BKTree, NearDuplicateFilter, hamming_distance
+from common.shuffle_scheduler import ShuffleScheduler
+from common.weighted_scheduler import WeightedScheduler
+
+
+class FakeImageIndex:
+    """Image index over a list of paths."""
+    image_source_dir = "/album"
+
+    def __init__(self, paths):
+        self.paths = list(paths)
+        self.generation = 1
+
+    def get_paths(self):
+        return list(self.paths)
+
+    def get_entries(self):
+        return {image_path: {'size': 1, 'mtime': 0.0, 'extension': '.jpg'}
+                for image_path in self.paths}
+
+
+class FakeMetadataStore:
+    """Metadata store over a dict of image paths to hashes."""
+
+    def __init__(self, hashes):
+        self.image_index = FakeImageIndex(hashes)
+        self.hashes = dict(hashes)
+        self.listeners = []
+        self.num_reads = 0
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def put_hashes(self, hashes):
+        """Records the hashes of newly crawled images."""
+        self.hashes.update(hashes)
+        self.image_index.paths.extend(
+            image_path for image_path in hashes if image_path not in self.image_index.paths)
+        records = [(image_path, {'size': 1, 'mtime': 0.0}, {'dhash': format(image_hash, '016x')})
+                   for image_path, image_hash in hashes.items()]
+        for listener in self.listeners:
+            listener(records)
+
+    def remove_images(self, image_paths):
+        for image_path in image_paths:
+            del self.hashes[image_path]
+            self.image_index.paths.remove(image_path)
+        self.image_index.generation += 1
+
+    def get_all(self):
+        self.num_reads += 1
+        return {image_path: {'dhash': None if image_hash is None else format(image_hash, '016x')}
+                for image_path, image_hash in self.hashes.items()}
+
+
+@pytest.fixture()
+def display_config(display_config):
+    display_config.config['near_duplicates'].update({
+        'max_distance': 4,
+        'suppression_window': 3,
+    })
+    return display_config
+
+
+# Two bursts of near-identical shots, and some unrelated images.
+BURST_A = {'/album/a1.jpg': 0x0, '/album/a2.jpg': 0x1, '/album/a3.jpg': 0x3}
+BURST_B = {'/album/b1.jpg': 0xff00, '/album/b2.jpg': 0xff01}
+OTHERS = {f"/album/other-{image_num}.jpg": image_hash for image_num, image_hash in enumerate([
+    0x00ff_00ff_00ff_00ff, 0x0f0f_0f0f_0f0f_0f0f, 0x3333_3333_3333_3333,
+    0x5555_5555_5555_5555, 0xffff_ffff_0000_0000], start=1)}
+ALBUM_HASHES = {**BURST_A, **BURST_B, **OTHERS}
+
+
+def make_filter(display_config, hashes=ALBUM_HASHES):
+    return NearDuplicateFilter(logging.getLogger(), display_config,
+                               FakeMetadataStore(hashes))
+
+
+class TestBKTree:
+    """Unit test suite for the BK-tree."""
+
+    def test_matches_brute_force(self):
+        rng = random.Random(1)
+        hashes = [rng.getrandbits(64) for _ in range(500)]
+        # Add near-duplicates of some of the hashes.
+        hashes += [image_hash ^ (1 << rng.randrange(64)) for image_hash in hashes[:100]]
+        tree = BKTree()
+        for item, image_hash in enumerate(hashes):
+            tree.add(image_hash, item)
+
+        for query in hashes[:50] + [rng.getrandbits(64) for _ in range(50)]:
+            expected = sorted((hamming_distance(query, image_hash), item)
+                              for item, image_hash in enumerate(hashes)
+                              if hamming_distance(query, image_hash) <= 10)
+            assert sorted(tree.find(query, 10)) == expected
+
+        assert len(tree) == 600
+
+    def test_keeps_identical_hashes(self):
+        tree = BKTree()
+        tree.add(0b1010, 'a')
+        tree.add(0b1010, 'b')
+
+        assert sorted(tree.find(0b1010, 0)) == [(0, 'a'), (0, 'b')]
+
+    def test_empty_tree(self):
+        assert BKTree().find(0, 64) == []
+
+
+class TestNearDuplicateFilter:
+    """Unit test suite for the near-duplicate filter."""
+
+    def test_finds_near_duplicates(self, display_config):
+        near_duplicate_filter = make_filter(display_config)
+
+        assert sorted(near_duplicate_filter.find_near_duplicates('/album/a1.jpg')) == \
+            ['/album/a2.jpg', '/album/a3.jpg']
+        assert near_duplicate_filter.find_near_duplicates('/album/other-1.jpg') == []
+
+    def test_suppresses_within_window(self, display_config):
+        near_duplicate_filter = make_filter(display_config)
+
+        near_duplicate_filter.record_pick('/album/a1.jpg')
+        assert near_duplicate_filter.is_suppressed('/album/a2.jpg')
+        assert not near_duplicate_filter.is_suppressed('/album/a1.jpg')
+        assert not near_duplicate_filter.is_suppressed('/album/b1.jpg')
+
+        for image_num in range(1, 4):
+            near_duplicate_filter.record_pick(f"/album/other-{image_num}.jpg")
+        assert not near_duplicate_filter.is_suppressed('/album/a2.jpg')
+
+    def test_upcoming_picks_count_as_recent(self, display_config):
+        near_duplicate_filter = make_filter(display_config)
+
+        assert near_duplicate_filter.is_suppressed('/album/b2.jpg', ['/album/b1.jpg'])
+
+    def test_uncrawled_images_are_not_suppressed(self, display_config):
+        near_duplicate_filter = make_filter(
+            display_config, {'/album/a1.jpg': 0x0, '/album/a2.jpg': None})
+
+        near_duplicate_filter.record_pick('/album/a1.jpg')
+
+        assert not near_duplicate_filter.is_suppressed('/album/a2.jpg')
+
+    def test_disabled(self, display_config):
+        display_config.config['near_duplicates']['enabled'] = False
+        near_duplicate_filter = make_filter(display_config)
+
+        near_duplicate_filter.record_pick('/album/a1.jpg')
+
+        assert not near_duplicate_filter.is_suppressed('/album/a2.jpg')
+
+    def test_follows_metadata_store(self, display_config):
+        near_duplicate_filter = make_filter(display_config, {})
+        near_duplicate_filter.record_pick('/album/a1.jpg')
+        assert not near_duplicate_filter.is_suppressed('/album/a2.jpg')
+
+        near_duplicate_filter.metadata_store.put_hashes(BURST_A)
+
+        assert near_duplicate_filter.is_suppressed('/album/a2.jpg')
+
+    def test_adds_new_hashes_without_rebuilding(self, display_config):
+        near_duplicate_filter = make_filter(display_config, OTHERS)
+        metadata_store = near_duplicate_filter.metadata_store
+        near_duplicate_filter.find_near_duplicates('/album/other-1.jpg')
+
+        for image_path, image_hash in {**BURST_A, **BURST_B}.items():
+            metadata_store.put_hashes({image_path: image_hash})
+            near_duplicate_filter.find_near_duplicates(image_path)
+
+        assert metadata_store.num_reads == 1
+        assert len(near_duplicate_filter.tree) == len(ALBUM_HASHES)
+        assert near_duplicate_filter.find_near_duplicates('/album/b1.jpg') == ['/album/b2.jpg']
+
+    def test_rebuilds_when_images_are_removed(self, display_config):
+        near_duplicate_filter = make_filter(display_config)
+        metadata_store = near_duplicate_filter.metadata_store
+        near_duplicate_filter.find_near_duplicates('/album/a1.jpg')
+
+        metadata_store.remove_images(['/album/a2.jpg'])
+
+        assert near_duplicate_filter.find_near_duplicates('/album/a1.jpg') == ['/album/a3.jpg']
+        assert metadata_store.num_reads == 2
+
+    def test_rebuilds_when_hashes_change(self, display_config):
+        near_duplicate_filter = make_filter(display_config)
+        near_duplicate_filter.find_near_duplicates('/album/a1.jpg')
+
+        near_duplicate_filter.metadata_store.put_hashes({'/album/a2.jpg': 0xff00})
+
+        assert near_duplicate_filter.find_near_duplicates('/album/a1.jpg') == ['/album/a3.jpg']
+        assert len(near_duplicate_filter.tree) == len(ALBUM_HASHES)
+
+
+def count_adjacent_near_duplicates(near_duplicate_filter, picks):
+    return sum(1 for pick, next_pick in zip(picks, picks[1:])
+               if next_pick in near_duplicate_filter.find_near_duplicates(pick))
+
+
+class TestSchedulersSuppressNearDuplicates:
+    """Unit test suite for the schedulers' use of the near-duplicate filter."""
+
+    def test_shuffle_shows_one_image_per_burst(self, display_config):
+        display_config.config['near_duplicates']['suppression_window'] = 20
+        near_duplicate_filter = make_filter(display_config)
+        scheduler = ShuffleScheduler(logging.getLogger(), display_config,
+                                     FakeImageIndex(ALBUM_HASHES), near_duplicate_filter)
+
+        picks = [scheduler.next() for _ in range(len(OTHERS) + 2)]
+
+        assert len(set(picks) & set(BURST_A)) == 1
+        assert len(set(picks) & set(BURST_B)) == 1
+        assert set(OTHERS) <= set(picks)
+
+    def test_shuffle_falls_back_when_everything_is_suppressed(self, display_config):
+        near_duplicate_filter = make_filter(display_config, BURST_A)
+        scheduler = ShuffleScheduler(logging.getLogger(), display_config,
+                                     FakeImageIndex(BURST_A), near_duplicate_filter)
+
+        picks = [scheduler.next() for _ in range(10)]
+
+        assert None not in picks
+
+    def test_shuffle_peek_skips_near_duplicates(self, display_config):
+        display_config.config['near_duplicates']['suppression_window'] = 20
+        near_duplicate_filter = make_filter(display_config)
+        scheduler = ShuffleScheduler(logging.getLogger(), display_config,
+                                     FakeImageIndex(ALBUM_HASHES), near_duplicate_filter)
+
+        upcoming_paths = scheduler.peek(len(ALBUM_HASHES))
+
+        assert len(upcoming_paths) == len(OTHERS) + 2
+        assert upcoming_paths == [scheduler.next() for _ in upcoming_paths]
+
+    def test_weighted_avoids_adjacent_near_duplicates(self, display_config):
+        near_duplicate_filter = make_filter(display_config)
+        scheduler = WeightedScheduler(logging.getLogger(), display_config,
+                                      FakeImageIndex(ALBUM_HASHES),
+                                      near_duplicate_filter=near_duplicate_filter)
+        scheduler.rng = random.Random(0)
+
+        picks = [scheduler.next() for _ in range(200)]
+
+        assert count_adjacent_near_duplicates(near_duplicate_filter, picks) == 0
+        assert set(picks) == set(ALBUM_HASHES)
@@ -0,0 +1,311 @@
+"""Unit tests for the prefetcher."""
+import logging
+import threading
+import time
+import pytest
+
+from PIL import Image
+
+from common.decoders import ImageRejected
+from common.display_state import DisplayState
+from common.frame_cache import FrameCache
+from common.image_source import ImageSourceUnavailable
+from common import prefetcher as prefetcher_module
+from common.prefetcher import BufferedFrame, Prefetcher
+
+
+class FakeImageRetriever:
+    """Hands out fake image files, failing the first `num_failures` times."""
+
+    def __init__(self, num_failures=0):
+        self.num_failures = num_failures
+        self.num_fetches = 0
+        self.cleaned_up_paths = []
+        self.lock = threading.Lock()
+
+    def choose_next_image_path(self):
+        with self.lock:
+            self.num_fetches += 1
+            if self.num_fetches <= self.num_failures:
+                raise OSError("Image source is unavailable.")
+            return f"image-{self.num_fetches}.jpg"
+
+    def fetch_image_file(self, image_path):
+        return image_path
+
+    def clean_up_image_file(self, image_file_path):
+        with self.lock:
+            self.cleaned_up_paths.append(image_file_path)
+
+
+class FakeFrameRenderer:
+    """Renders every image into the same small frame."""
+    resolution = (10, 10)
+
+    def render(self, image_file, source_path=None):
+        frame = Image.new('P', self.resolution, 1)
+        frame.putpalette([0, 0, 0, 255, 255, 255] * 128)
+        frame.info['exif_date'] = "2023:03:06 15:03:42"
+        return frame
+
+
+# Frames from the fake renderer are 100 bytes of pixels plus a 768 byte palette.
+FRAME_BYTES = 868
+
+
+@pytest.fixture()
+def display_config(display_config):
+    display_config.config['prefetch'].update({
+        'num_workers': 3,
+        'max_buffer_bytes': 4 * FRAME_BYTES,
+        'low_watermark_bytes': 2 * FRAME_BYTES,
+        'initial_backoff_secs': 0.01,
+        'max_backoff_secs': 0.02,
+    })
+    return display_config
+
+
+def make_prefetcher(display_config, image_retriever):
+    prefetcher = Prefetcher(logging.getLogger(), display_config,
+                            image_retriever, FakeFrameRenderer())
+    prefetcher.start()
+    return prefetcher
+
+
+def wait_for_buffer_size(prefetcher, size):
+    with prefetcher.condition:
+        assert prefetcher.condition.wait_for(
+            lambda: len(prefetcher.buffer) == size and prefetcher.num_in_flight == 0,
+            timeout=5)
+
+
+class TestPrefetcher:
+    """Unit test suite for the prefetcher."""
+
+    def test_fills_to_high_watermark(self, display_config):
+        image_retriever = FakeImageRetriever()
+        prefetcher = make_prefetcher(display_config, image_retriever)
+
+        wait_for_buffer_size(prefetcher, 4)
+
+        assert image_retriever.num_fetches == 4
+        assert len(image_retriever.cleaned_up_paths) == 4
+        prefetcher.stop()
+
+    def test_refills_only_below_low_watermark(self, display_config):
+        image_retriever = FakeImageRetriever()
+        prefetcher = make_prefetcher(display_config, image_retriever)
+        wait_for_buffer_size(prefetcher, 4)
+
+        buffered_frame = prefetcher.get()
+        assert buffered_frame.source_path.startswith("image-")
+        wait_for_buffer_size(prefetcher, 3)
+        assert image_retriever.num_fetches == 4
+
+        prefetcher.get()
+        wait_for_buffer_size(prefetcher, 4)
+        assert image_retriever.num_fetches == 6
+        prefetcher.stop()
+
+    def test_retries_failed_retrievals(self, display_config):
+        image_retriever = FakeImageRetriever(num_failures=5)
+        prefetcher = make_prefetcher(display_config, image_retriever)
+
+        wait_for_buffer_size(prefetcher, 4)
+
+        assert image_retriever.num_fetches == 9
+        prefetcher.stop()
+
+    def test_get_times_out_when_empty(self, display_config):
+        display_config.config['prefetch']['num_workers'] = 0
+        prefetcher = make_prefetcher(display_config, FakeImageRetriever())
+
+        assert prefetcher.get(timeout=0) is None
+
+
+class RejectingFrameRenderer(FakeFrameRenderer):
+    """Rejects the first image it's asked to render."""
+
+    def render(self, image_file, source_path=None):
+        if source_path == "image-1.jpg":
+            raise ImageRejected("Too large.")
+        return super().render(image_file, source_path)
+
+
+class CorruptImageFrameRenderer(FakeFrameRenderer):
+    """Fails to decode the first image it's asked to render, as PIL does on
+    truncated files."""
+
+    def render(self, image_file, source_path=None):
+        if source_path == "image-1.jpg":
+            raise OSError("image file is truncated")
+        return super().render(image_file, source_path)
+
+
+class RejectingEverythingFrameRenderer(FakeFrameRenderer):
+    def render(self, image_file, source_path=None):
+        raise ImageRejected("Too large.")
+
+
+class RejectedImageRetriever(FakeImageRetriever):
+    """Fake image retriever that records rejected images."""
+
+    def __init__(self):
+        super().__init__()
+        self.rejected_paths = []
+
+    def reject_image(self, image_path, reason):
+        self.rejected_paths.append(image_path)
+
+
+class TestPrefetcherRejections:
+    """Unit test suite for images that can't be decoded."""
+
+    def test_rejected_images_are_skipped(self, display_config):
+        display_config.config['prefetch']['num_workers'] = 1
+        display_config.config['prefetch']['initial_backoff_secs'] = 60
+        image_retriever = RejectedImageRetriever()
+        prefetcher = Prefetcher(logging.getLogger(), display_config,
+                                image_retriever, RejectingFrameRenderer())
+        prefetcher.start()
+
+        wait_for_buffer_size(prefetcher, 4)
+
+        assert image_retriever.rejected_paths == ["image-1.jpg"]
+        assert prefetcher.get().source_path == "image-2.jpg"
+        prefetcher.stop()
+
+    def test_corrupt_images_are_rejected(self, display_config):
+        display_config.config['prefetch']['num_workers'] = 1
+        display_config.config['prefetch']['initial_backoff_secs'] = 60
+        image_retriever = RejectedImageRetriever()
+        prefetcher = Prefetcher(logging.getLogger(), display_config,
+                                image_retriever, CorruptImageFrameRenderer())
+        prefetcher.start()
+
+        wait_for_buffer_size(prefetcher, 4)
+
+        assert image_retriever.rejected_paths == ["image-1.jpg"]
+        assert prefetcher.get().source_path == "image-2.jpg"
+        prefetcher.stop()
+
+    def test_backs_off_after_many_rejections(self, display_config):
+        display_config.config['prefetch']['num_workers'] = 1
+        display_config.config['prefetch']['initial_backoff_secs'] = 60
+        image_retriever = RejectedImageRetriever()
+        prefetcher = Prefetcher(logging.getLogger(), display_config,
+                                image_retriever, RejectingEverythingFrameRenderer())
+        prefetcher.start()
+
+        time.sleep(0.2)
+        prefetcher.stop()
+
+        assert len(image_retriever.rejected_paths) == prefetcher_module.MAX_REJECTIONS_IN_A_ROW
+
+
+class UnavailableImageRetriever(FakeImageRetriever):
+    """Fake image retriever whose image source is unavailable until
+    `is_available` is set."""
+
+    def __init__(self):
+        super().__init__()
+        self.is_available = threading.Event()
+
+    def fetch_image_file(self, image_path):
+        if not self.is_available.is_set():
+            raise ImageSourceUnavailable("The image source is unavailable.")
+        return image_path
+
+
+class TestPrefetcherOffline:
+    """Unit test suite for falling back to cached frames."""
+
+    def make_offline_prefetcher(self, display_config, image_retriever):
+        display_config.config['prefetch'].update({
+            'num_workers': 1,
+            'max_buffer_bytes': 2 * FRAME_BYTES,
+            'low_watermark_bytes': 0,
+        })
+        frame_renderer = FakeFrameRenderer()
+        frame_renderer.frame_cache = FrameCache(logging.getLogger(), display_config)
+        for source_path in ['cached-a.jpg', 'cached-b.jpg']:
+            frame = frame_renderer.render(source_path)
+            frame.info['source_path'] = source_path
+            frame_renderer.frame_cache.put(source_path, frame)
+        prefetcher = Prefetcher(logging.getLogger(), display_config,
+                                image_retriever, frame_renderer)
+        prefetcher.start()
+        return prefetcher
+
+    def test_uses_cached_frames_while_source_is_unavailable(self, display_config):
+        prefetcher = self.make_offline_prefetcher(display_config, UnavailableImageRetriever())
+
+        wait_for_buffer_size(prefetcher, 2)
+
+        assert {prefetcher.get().source_path, prefetcher.get().source_path} == \
+            {'cached-a.jpg', 'cached-b.jpg'}
+        prefetcher.stop()
+
+    def test_returns_to_source_once_available(self, display_config):
+        image_retriever = UnavailableImageRetriever()
+        prefetcher = self.make_offline_prefetcher(display_config, image_retriever)
+        wait_for_buffer_size(prefetcher, 2)
+
+        image_retriever.is_available.set()
+        # Let the image source's offline period lapse.
+        time.sleep(2 * display_config.config['prefetch']['max_backoff_secs'])
+        prefetcher.get()
+        prefetcher.get()
+        wait_for_buffer_size(prefetcher, 2)
+
+        assert prefetcher.get().source_path.startswith("image-")
+        prefetcher.stop()
+
+
+class TestPrefetcherRestore:
+    """Unit test suite for restoring the buffer after a restart."""
+
+    def test_restores_buffer_from_manifest(self, display_config):
+        display_config.config['prefetch']['num_workers'] = 0
+        frame_renderer = FakeFrameRenderer()
+        frame_renderer.frame_cache = FrameCache(logging.getLogger(), display_config)
+        frame_renderer.frame_cache.put('key-a', frame_renderer.render('a.jpg'))
+        display_state = DisplayState(logging.getLogger(), display_config)
+        display_state.save_buffer_manifest([
+            {'source_path': 'a.jpg', 'frame_key': 'key-a'},
+            {'source_path': 'b.jpg', 'frame_key': 'evicted'},
+        ])
+
+        prefetcher = Prefetcher(logging.getLogger(), display_config,
+                                FakeImageRetriever(), frame_renderer, display_state)
+        prefetcher.restore_buffer()
+
+        buffered_frame = prefetcher.get(timeout=0)
+        assert buffered_frame.source_path == 'a.jpg'
+        assert buffered_frame.exif_date == "2023:03:06 15:03:42"
+        assert prefetcher.get(timeout=0) is None
+        assert display_state.load_buffer_manifest() == []
+
+
+class TestBufferedFrame:
+    """Unit test suite for buffered frame records."""
+
+    def test_round_trips_frame(self):
+        frame = FakeFrameRenderer().render("image.jpg")
+        frame.info['frame_key'] = "key"
+
+        buffered_frame = BufferedFrame.from_frame("image.jpg", frame)
+        unpacked_frame = buffered_frame.to_image()
+
+        assert buffered_frame.nbytes == FRAME_BYTES
+        assert buffered_frame.exif_date == "2023:03:06 15:03:42"
+        assert unpacked_frame.mode == 'P'
+        assert unpacked_frame.tobytes() == frame.tobytes()
+        assert unpacked_frame.getpalette() == frame.getpalette()
+        assert unpacked_frame.info['frame_key'] == "key"
+
+    def test_has_no_instance_dict(self):
+        buffered_frame = BufferedFrame.from_frame(
+            "image.jpg", FakeFrameRenderer().render("image.jpg"))
+
+        assert not hasattr(buffered_frame, '__dict__')
@@ -0,0 +1,94 @@
+"""Unit tests for pre-rendering the album into the frame cache."""
+import logging
+import os
+import pytest
+
+from PIL import Image
+
+from common import prerender as prerender_module
+from common.frame_cache import FrameCache
+from common.prerender import REJECTED, prerender_album, prerender_image
+from display_image import get_panel_resolution, parse_args
+
+
+RESOLUTION = (60, 40)
+
+
+class TestPrerender:
+    """Unit test suite for pre-rendering the album."""
+
+    def test_fills_frame_cache(self, display_config):
+        progress = []
+
+        stats = prerender_album(logging.getLogger(), display_config, RESOLUTION, 2,
+                                on_progress=lambda *args: progress.append(args))
+
+        assert stats['num_images'] > 0
+        assert stats['num_rendered'] == stats['num_images']
+        assert stats['num_cached'] == stats['num_failed'] == stats['num_evicted'] == 0
+        assert [args[0] for args in progress] == list(range(1, stats['num_images'] + 1))
+        frame_cache = FrameCache(logging.getLogger(), display_config)
+        assert len(frame_cache.frame_sizes) == stats['num_images']
+        frame = frame_cache.get(next(iter(frame_cache.frame_sizes)))
+        assert frame.size == RESOLUTION
+        assert frame.info['source_path']
+
+    def test_skips_cached_frames(self, display_config):
+        prerender_album(logging.getLogger(), display_config, RESOLUTION, 2)
+
+        stats = prerender_album(logging.getLogger(), display_config, RESOLUTION, 2)
+
+        assert stats['num_rendered'] == 0
+        assert stats['num_cached'] == stats['num_images']
+
+    def test_leaves_index_file_alone(self, display_config):
+        prerender_album(logging.getLogger(), display_config, RESOLUTION, 2)
+
+        assert not os.path.exists(display_config.config['image_index']['index_file_path'])
+
+    def test_rejects_from_header_alone(self, display_config, tmp_path, monkeypatch):
+        image_path = str(tmp_path / 'large.png')
+        Image.new('RGB', (2000, 1000)).save(image_path)
+        display_config.config['decode']['max_pixels'] = 10000
+        monkeypatch.setattr(prerender_module, 'HEADER_READ_BYTES', 64)
+        # Reading the rest of the file would fail the render.
+        monkeypatch.setattr(prerender_module, 'shutil', None)
+
+        status, _, _ = prerender_image(image_path, RESOLUTION, {},
+                                       display_config.config['decode'])
+
+        assert status == REJECTED
+
+    def test_renders_again_at_new_resolution(self, display_config):
+        prerender_album(logging.getLogger(), display_config, RESOLUTION, 2)
+
+        stats = prerender_album(logging.getLogger(), display_config, (40, 60), 2)
+
+        assert stats['num_rendered'] == stats['num_images']
+
+
+class TestParseArgs:
+    """Unit test suite for the display_image.py command line."""
+
+    def test_lone_path_shows_image(self):
+        args = parse_args(['photo.jpg'])
+
+        assert args.command == 'show'
+        assert args.image_file_path == 'photo.jpg'
+
+    def test_prerender(self):
+        args = parse_args(['prerender', '--resolution', '600x448', '--processes', '3'])
+
+        assert args.command == 'prerender'
+        assert args.resolution == (600, 448)
+        assert args.processes == 3
+
+    def test_resolution_defaults_to_simulated_panel(self, display_config):
+        display_config.config['hardware']['backend'] = 'simulated'
+        display_config.config['hardware']['simulated_resolution'] = [800, 480]
+
+        assert get_panel_resolution(display_config) == (800, 480)
+
+    def test_bad_resolution(self):
+        with pytest.raises(SystemExit):
+            parse_args(['prerender', '--resolution', '600'])
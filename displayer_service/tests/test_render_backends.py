@@ -0,0 +1,59 @@
+"""Unit tests for the render backends."""
+import io
+import logging
+
+from common.render_backends import InProcessRenderBackend, ProcessPoolRenderBackend, \
+    copy_into_shared_memory, get_worker_context, read_from_shared_memory
+
+
+TEST_IMAGE_PATH = "./test-images/watermelon.jpg"
+RENDER_OPTIONS = {'burn_date': True, 'saturation': 0.5}
+
+
+class TestRenderBackends:
+    """Unit test suite for the render backends."""
+
+    def test_in_process_backend(self):
+        frame = InProcessRenderBackend().render(
+            TEST_IMAGE_PATH, (600, 448), RENDER_OPTIONS)
+
+        assert frame.mode == 'P'
+        assert frame.size == (600, 448)
+        assert frame.info['exif_date'] == "2023:03:06 15:03:42"
+
+    def test_process_pool_backend_matches_in_process_backend(self):
+        expected_frame = InProcessRenderBackend().render(
+            TEST_IMAGE_PATH, (600, 448), RENDER_OPTIONS)
+        render_backend = ProcessPoolRenderBackend(logging.getLogger(), 2)
+        with open(TEST_IMAGE_PATH, 'rb') as image_file:
+            image_bytes = io.BytesIO(image_file.read())
+
+        try:
+            path_frame = render_backend.render(
+                TEST_IMAGE_PATH, (600, 448), RENDER_OPTIONS)
+            bytes_frame = render_backend.render(
+                image_bytes, (600, 448), RENDER_OPTIONS)
+        finally:
+            render_backend.shutdown()
+
+        for frame in [path_frame, bytes_frame]:
+            assert frame.mode == 'P'
+            assert frame.tobytes() == expected_frame.tobytes()
+            assert frame.info['crop_box'] == expected_frame.info['crop_box']
+            assert frame.getpalette() == expected_frame.getpalette()
+            assert frame.info['exif_date'] == "2023:03:06 15:03:42"
+
+    def test_workers_are_not_forked(self):
+        assert get_worker_context().get_start_method() in ['forkserver', 'spawn']
+
+    def test_image_files_are_passed_through_shared_memory(self):
+        with open(TEST_IMAGE_PATH, 'rb') as image_file:
+            image_bytes = io.BytesIO(image_file.read())
+
+        image_shm, image_size = copy_into_shared_memory(image_bytes)
+        try:
+            assert read_from_shared_memory(image_shm.name, image_size).getvalue() == \
+                image_bytes.getvalue()
+        finally:
+            image_shm.close()
+            image_shm.unlink()
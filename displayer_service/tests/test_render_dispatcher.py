@@ -0,0 +1,108 @@
+"""Unit tests for the render dispatcher."""
+import logging
+import threading
+
+from common import render_dispatcher
+from common.render_dispatcher import RenderDispatcher
+
+
+class BlockingHandlers:
+    """Records handled intents. Handlers block until `release` is called."""
+
+    def __init__(self):
+        self.handled_intents = []
+        self.started = threading.Event()
+        self.released = threading.Event()
+
+    def make_handler(self, intent):
+        def handler():
+            self.started.set()
+            self.released.wait(5)
+            self.handled_intents.append(intent)
+        return handler
+
+    def release(self):
+        self.released.set()
+
+
+def make_dispatcher():
+    handlers = BlockingHandlers()
+    dispatcher = RenderDispatcher(logging.getLogger(), {
+        intent: handlers.make_handler(intent)
+        for intent in [render_dispatcher.NEXT_IMAGE, render_dispatcher.DEBUG_SCREEN,
+                       render_dispatcher.SHUTDOWN]
+    })
+    dispatcher.start()
+    return dispatcher, handlers
+
+
+class TestRenderDispatcher:
+    """Unit test suite for the render dispatcher."""
+
+    def test_submit_returns_without_waiting(self):
+        dispatcher, handlers = make_dispatcher()
+
+        assert dispatcher.submit(render_dispatcher.NEXT_IMAGE)
+        assert handlers.started.wait(5)
+        assert handlers.handled_intents == []
+
+        handlers.release()
+        assert dispatcher.wait_until_idle(5)
+        assert handlers.handled_intents == [render_dispatcher.NEXT_IMAGE]
+
+    def test_coalesces_repeated_intents(self):
+        dispatcher, handlers = make_dispatcher()
+        dispatcher.submit(render_dispatcher.NEXT_IMAGE)
+        handlers.started.wait(5)
+
+        # Coalesced into the in-progress refresh.
+        assert not dispatcher.submit(render_dispatcher.NEXT_IMAGE)
+        assert dispatcher.submit(render_dispatcher.DEBUG_SCREEN)
+        # Coalesced into the pending debug screen.
+        assert not dispatcher.submit(render_dispatcher.DEBUG_SCREEN)
+
+        handlers.release()
+        assert dispatcher.wait_until_idle(5)
+        assert handlers.handled_intents == [
+            render_dispatcher.NEXT_IMAGE, render_dispatcher.DEBUG_SCREEN]
+
+    def test_newer_intent_cancels_stale_pending_intent(self):
+        dispatcher, handlers = make_dispatcher()
+        dispatcher.submit(render_dispatcher.NEXT_IMAGE)
+        handlers.started.wait(5)
+
+        dispatcher.submit(render_dispatcher.DEBUG_SCREEN)
+        assert dispatcher.has_pending()
+        dispatcher.submit(render_dispatcher.SHUTDOWN)
+        assert dispatcher.has_pending()
+
+        handlers.release()
+        assert dispatcher.wait_until_idle(5)
+        assert handlers.handled_intents == [
+            render_dispatcher.NEXT_IMAGE, render_dispatcher.SHUTDOWN]
+
+    def test_repeating_in_progress_intent_cancels_stale_pending_intent(self):
+        dispatcher, handlers = make_dispatcher()
+        dispatcher.submit(render_dispatcher.NEXT_IMAGE)
+        handlers.started.wait(5)
+
+        dispatcher.submit(render_dispatcher.DEBUG_SCREEN)
+        assert not dispatcher.submit(render_dispatcher.NEXT_IMAGE)
+        assert not dispatcher.has_pending()
+
+        handlers.release()
+        assert dispatcher.wait_until_idle(5)
+        assert handlers.handled_intents == [render_dispatcher.NEXT_IMAGE]
+
+    def test_pending_shutdown_is_never_cancelled(self):
+        dispatcher, handlers = make_dispatcher()
+        dispatcher.submit(render_dispatcher.NEXT_IMAGE)
+        handlers.started.wait(5)
+
+        dispatcher.submit(render_dispatcher.SHUTDOWN)
+        assert not dispatcher.submit(render_dispatcher.DEBUG_SCREEN)
+
+        handlers.release()
+        assert dispatcher.wait_until_idle(5)
+        assert handlers.handled_intents == [
+            render_dispatcher.NEXT_IMAGE, render_dispatcher.SHUTDOWN]
@@ -0,0 +1,148 @@
+"""Unit tests for the render server and client, on localhost."""
+import logging
+import shutil
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+import pytest
+
+from common.image_source import ImageSourceUnavailable
+from common.render_server import RenderClient, RenderServer
+
+
+RESOLUTION = (60, 40)
+
+
+@pytest.fixture()
+def display_config(display_config):
+    display_config.config['prefetch']['num_workers'] = 1
+    display_config.config['render_server'].update({
+        'bind_address': '127.0.0.1',
+        'port': 0,
+        'max_resolutions': 2,
+        'frame_timeout_secs': 30,
+    })
+    return display_config
+
+
+@pytest.fixture()
+def render_server(display_config):
+    render_server = RenderServer(logging.getLogger(), display_config)
+    render_server.start()
+    server_thread = threading.Thread(target=render_server.serve, daemon=True)
+    server_thread.start()
+    display_config.config['render_client']['server_url'] = \
+        f"http://127.0.0.1:{render_server.port}"
+    yield render_server
+    render_server.stop()
+    server_thread.join(5)
+
+
+def request_frame(render_server, path, method='GET', headers=None):
+    request = urllib.request.Request(
+        f"http://127.0.0.1:{render_server.port}{path}", method=method,
+        data=b'' if method == 'POST' else None, headers=headers or {})
+    return urllib.request.urlopen(request, timeout=30)
+
+
+class TestRenderServer:
+    """Unit test suite for the render server."""
+
+    def test_serves_frame_with_etag(self, render_server):
+        with request_frame(render_server, '/frames/60x40') as response:
+            assert response.status == 200
+            assert response.headers['Content-Type'] == 'image/png'
+            assert response.headers['ETag']
+            assert response.headers['X-Frame-Source']
+
+    def test_conditional_get(self, render_server):
+        with request_frame(render_server, '/frames/60x40') as response:
+            etag = response.headers['ETag']
+
+        with pytest.raises(urllib.error.HTTPError) as error:
+            request_frame(render_server, '/frames/60x40', headers={'If-None-Match': etag})
+
+        assert error.value.code == 304
+        assert error.value.headers['ETag'] == etag
+
+    def test_current_frame_moves_on_after_refresh_period(self, render_server, display_config):
+        with request_frame(render_server, '/frames/60x40') as response:
+            etag = response.headers['ETag']
+        display_config.config['display']['refresh_period_secs'] = 0
+
+        with request_frame(render_server, '/frames/60x40',
+                           headers={'If-None-Match': etag}) as response:
+            assert response.status == 200
+
+    def test_bad_requests(self, render_server):
+        for path, method, code in [('/frames/0x40', 'GET', 400),
+                                   ('/frames/60x40/next', 'GET', 404),
+                                   ('/frames/60x40', 'POST', 404),
+                                   ('/other', 'GET', 404)]:
+            with pytest.raises(urllib.error.HTTPError) as error:
+                request_frame(render_server, path, method)
+            assert error.value.code == code
+
+    def test_limits_resolutions(self, render_server):
+        request_frame(render_server, '/frames/60x40').close()
+        request_frame(render_server, '/frames/40x60').close()
+
+        with pytest.raises(urllib.error.HTTPError) as error:
+            request_frame(render_server, '/frames/30x20')
+
+        assert error.value.code == 503
+
+    def test_serves_non_ascii_source_names(self, display_config, tmp_path):
+        album_dir = tmp_path / 'album'
+        album_dir.mkdir()
+        shutil.copy('./test-images/cherry.jpg', album_dir / '写真.jpg')
+        display_config.config['display']['image_source_dir'] = str(album_dir)
+        render_server = RenderServer(logging.getLogger(), display_config)
+        render_server.start()
+        server_thread = threading.Thread(target=render_server.serve, daemon=True)
+        server_thread.start()
+        display_config.config['render_client']['server_url'] = \
+            f"http://127.0.0.1:{render_server.port}"
+        try:
+            with request_frame(render_server, '/frames/60x40') as response:
+                assert urllib.parse.unquote(response.headers['X-Frame-Source']) == '写真.jpg'
+
+            frame = RenderClient(logging.getLogger(), display_config,
+                                 RESOLUTION).fetch_next_frame()
+            assert frame.size == RESOLUTION
+        finally:
+            render_server.stop()
+            server_thread.join(5)
+
+
+class TestRenderClient:
+    """Unit test suite for the render client."""
+
+    def test_fetches_frames(self, render_server, display_config):
+        render_client = RenderClient(logging.getLogger(), display_config, RESOLUTION)
+
+        frame = render_client.fetch_current_frame()
+
+        assert frame.mode == 'P'
+        assert frame.size == RESOLUTION
+        assert render_client.fetch_current_frame() is None
+
+    def test_fetches_next_frame(self, render_server, display_config):
+        render_client = RenderClient(logging.getLogger(), display_config, RESOLUTION)
+        render_client.fetch_current_frame()
+        etag = render_client.etag
+
+        frame = render_client.fetch_next_frame()
+
+        assert frame.size == RESOLUTION
+        assert render_client.etag != etag
+        assert render_client.fetch_current_frame() is None
+
+    def test_unreachable_server(self, display_config):
+        display_config.config['render_client'].update({
+            'server_url': 'http://127.0.0.1:9', 'timeout_secs': 5})
+        render_client = RenderClient(logging.getLogger(), display_config, RESOLUTION)
+
+        with pytest.raises(ImageSourceUnavailable):
+            render_client.fetch_current_frame()
@@ -1,22 +1,279 @@
 """Unit tests for screen manager."""
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
 import unittest
+import unittest.mock
 
-# from common.screen_manager import ScreenManager
+from common import image_processor, screen_manager
+from common.display_config import DisplayConfig
+from common.metrics import metrics
+from common.render_server import RenderServer
+from common.screen_manager import ScreenManager
 
 
-class TestScreenManagerImageQueue(unittest.TestCase):
+def make_simulated_config(test_dir):
+    """Writes a display config that runs on simulated hardware."""
+    display_config_dict = {
+        "display": {
+            "refresh_period_secs": 3600,
+            "allowed_image_extensions": [".jpg", ".jpeg", ".png"],
+            "image_source_dir": "./test-images"
+        },
+        "logging": {
+            "log_file_path": os.path.join(test_dir, "log")
+        },
+        "hardware": {
+            "backend": "simulated",
+            "simulated_output_dir": os.path.join(test_dir, "simulated-display"),
+            "simulated_refresh_secs": 0
+        },
+        "image_index": {
+            "index_file_path": os.path.join(test_dir, "index.json")
+        },
+        "metadata": {
+            "db_path": os.path.join(test_dir, "metadata.sqlite3")
+        },
+        "frame_cache": {
+            "cache_dir": os.path.join(test_dir, "frame-cache")
+        },
+        "state": {
+            "state_dir": os.path.join(test_dir, "state")
+        },
+        "prefetch": {
+            "num_workers": 1,
+            "max_buffer_bytes": 3 * 270000,
+            "low_watermark_bytes": 600 * 448
+        }
+    }
+    config_file_path = os.path.join(test_dir, "display_config.json")
+    with open(config_file_path, 'w', encoding='utf-8') as config_file:
+        json.dump(display_config_dict, config_file)
+    return config_file_path
+
+
+class ScreenManagerTestCase(unittest.TestCase):
+    """Runs a screen manager on simulated hardware."""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.config_file_path = make_simulated_config(self.test_dir)
+        self.screen_managers = []
+
+    def tearDown(self):
+        for each_screen_manager in self.screen_managers:
+            if each_screen_manager.prefetcher is not None:
+                each_screen_manager.prefetcher.stop()
+            each_screen_manager.stop_logging()
+        shutil.rmtree(self.test_dir, ignore_errors=True)
+
+    def make_screen_manager(self):
+        new_screen_manager = ScreenManager(self.config_file_path)
+        self.screen_managers.append(new_screen_manager)
+        return new_screen_manager
+
+    def press(self, manager, label):
+        """Presses the button with the given label and waits for the render."""
+        pin = next(pin for pin, pin_label in manager.pins_to_buttons.items()
+                   if pin_label == label)
+        manager.gpio.press(pin).join(5)
+        self.assertTrue(manager.render_dispatcher.wait_until_idle(30))
+
+
+class TestScreenManagerImageQueue(ScreenManagerTestCase):
     """Unit test suite for the screen manager's image buffer."""
 
     def test_image_queue_fills_up(self):
-        """TODO"""
-        # screen_manager = ScreenManager()
-        # screen_manager.image_retriever.get_random_images = MagicMock(return_value=[Image.])
+        manager = self.make_screen_manager()
+
+        with manager.prefetcher.condition:
+            self.assertTrue(manager.prefetcher.condition.wait_for(
+                lambda: len(manager.prefetcher.buffer) == 3, 30))
+
+    def test_image_queue_restored_after_restart(self):
+        manager = self.make_screen_manager()
+        with manager.prefetcher.condition:
+            manager.prefetcher.condition.wait_for(
+                lambda: len(manager.prefetcher.buffer) == 3, 30)
+        manager.prefetcher.stop()
+        # The worker that added the last frame may not have persisted the
+        # manifest yet.
+        manager.prefetcher.save_manifest()
+
+        restarted_manager = self.make_screen_manager()
+
+        self.assertGreaterEqual(restarted_manager.prefetcher.qsize(), 3)
+
+
+class TestScreenManagerButtons(ScreenManagerTestCase):
+    """Unit test suite for the screen manager's button handling."""
+
+    def test_a_shows_next_image(self):
+        manager = self.make_screen_manager()
+
+        self.press(manager, 'A')
+
+        self.assertEqual(1, manager.eink_display.num_refreshes)
+        self.assertEqual((600, 448), manager.eink_display.image.size)
+        self.assertEqual('P', manager.eink_display.image.mode)
+        self.assertIsNotNone(manager.display_state.load_last_frame())
+
+    def test_b_shows_debug_screen(self):
+        manager = self.make_screen_manager()
+
+        self.press(manager, 'B')
+
+        self.assertTrue(manager.is_debugging)
+        self.assertEqual(1, manager.eink_display.num_refreshes)
+
+    def test_debug_screen_uses_configured_saturation(self):
+        manager = self.make_screen_manager()
+        manager.display_config.config['render']['saturation'] = 1.0
+
+        self.press(manager, 'B')
+
+        palette = image_processor.blend_palette(1.0)
+        self.assertEqual(palette, manager.eink_display.image.getpalette()[:len(palette)])
+
+    def test_b_again_does_not_refresh_unchanged_logs(self):
+        manager = self.make_screen_manager()
+        # Let the prefetcher finish logging.
+        with manager.prefetcher.condition:
+            manager.prefetcher.condition.wait_for(
+                lambda: len(manager.prefetcher.buffer) == 3, 30)
+        manager.log_listener.queue.join()
+        self.press(manager, 'B')
+        manager.log_listener.queue.join()
+
+        self.press(manager, 'B')
+
+        self.assertEqual(1, manager.eink_display.num_refreshes)
+
+    def test_d_without_root_keeps_showing_images(self):
+        manager = self.make_screen_manager()
+
+        with unittest.mock.patch.object(screen_manager.os, 'geteuid', return_value=1000):
+            self.press(manager, 'D')
+        self.press(manager, 'A')
+
+        self.assertEqual(1, manager.eink_display.num_refreshes)
+        self.assertFalse(manager.prefetcher.stop_event.is_set())
+
+    def test_identical_frames_are_not_refreshed(self):
+        manager = self.make_screen_manager()
+        self.press(manager, 'A')
+        num_skipped_refreshes = metrics.get_counter('skipped_refreshes')
+
+        manager.render_dispatcher.submit(screen_manager.render_dispatcher.LAST_FRAME)
+        self.assertTrue(manager.render_dispatcher.wait_until_idle(30))
+
+        self.assertEqual(1, manager.eink_display.num_refreshes)
+        self.assertEqual(num_skipped_refreshes + 1,
+                         metrics.get_counter('skipped_refreshes'))
+
+    def test_logs_are_written_through_the_queue(self):
+        manager = self.make_screen_manager()
+
+        self.press(manager, 'C')
+        manager.stop_logging()
+
+        num_records, lines = manager.ring_buffer_handler.get_lines()
+        self.assertTrue(any("User pressed C." in line for line in lines))
+        with open(os.path.join(self.test_dir, "log"), encoding='utf-8') as log_file:
+            self.assertIn("User pressed C.", log_file.read())
+
+    def test_last_frame_shown_after_restart(self):
+        manager = self.make_screen_manager()
+        self.press(manager, 'A')
+        shown_frame = manager.eink_display.image
+        manager.prefetcher.stop()
+        # Forget what's on the panel, as if it had been replaced.
+        os.remove(manager.display_state.shown_fingerprint_path)
+
+        restarted_manager = self.make_screen_manager()
+        self.assertTrue(restarted_manager.render_dispatcher.wait_until_idle(30))
+
+        self.assertEqual(1, restarted_manager.eink_display.num_refreshes)
+        self.assertEqual(shown_frame.tobytes(),
+                         restarted_manager.eink_display.image.tobytes())
+
+    def test_last_frame_not_refreshed_if_still_shown(self):
+        manager = self.make_screen_manager()
+        self.press(manager, 'A')
+        manager.prefetcher.stop()
+
+        restarted_manager = self.make_screen_manager()
+        self.assertTrue(restarted_manager.render_dispatcher.wait_until_idle(30))
+
+        self.assertEqual(0, restarted_manager.eink_display.num_refreshes)
+
+
+class TestScreenManagerConfigReload(ScreenManagerTestCase):
+    """Unit test suite for applying a reloaded display config."""
+
+    def test_new_refresh_period_cuts_wait_short(self):
+        manager = self.make_screen_manager()
+        wait_thread = threading.Thread(target=manager.wait_for_next_refresh, daemon=True)
+        wait_thread.start()
+
+        manager.display_config.config['display']['refresh_period_secs'] = 0.01
+        manager.apply_config_changes({('display', 'refresh_period_secs')})
+
+        wait_thread.join(5)
+        self.assertFalse(wait_thread.is_alive())
+
+
+class TestScreenManagerRenderClient(ScreenManagerTestCase):
+    """Unit test suite for showing frames from a render server."""
+
+    def setUp(self):
+        super().setUp()
+        server_config = DisplayConfig(logging.getLogger(), self.config_file_path)
+        server_config.config['render_server'].update({'bind_address': '127.0.0.1', 'port': 0})
+        self.render_server = RenderServer(logging.getLogger(), server_config)
+        self.render_server.start()
+        self.server_thread = threading.Thread(target=self.render_server.serve, daemon=True)
+        self.server_thread.start()
+
+        with open(self.config_file_path, 'r', encoding='utf-8') as config_file:
+            display_config_dict = json.load(config_file)
+        display_config_dict['render_client'] = {
+            'enabled': True,
+            'server_url': f"http://127.0.0.1:{self.render_server.port}",
+        }
+        # The client keeps its own state, as it would on its own device.
+        display_config_dict['state'] = {'state_dir': os.path.join(self.test_dir, "client-state")}
+        with open(self.config_file_path, 'w', encoding='utf-8') as config_file:
+            json.dump(display_config_dict, config_file)
+
+    def tearDown(self):
+        self.render_server.stop()
+        self.server_thread.join(5)
+        super().tearDown()
+
+    def test_a_shows_next_server_frame(self):
+        manager = self.make_screen_manager()
+
+        self.press(manager, 'A')
+
+        self.assertIsNone(manager.prefetcher)
+        self.assertEqual(1, manager.eink_display.num_refreshes)
+        self.assertEqual((600, 448), manager.eink_display.image.size)
+        self.assertIsNotNone(manager.display_state.load_last_frame())
+
+    def test_polls_for_new_frames(self):
+        manager = self.make_screen_manager()
 
-        self.assertEqual(1, 1)
+        manager.render_dispatcher.submit(screen_manager.render_dispatcher.SERVER_FRAME)
+        self.assertTrue(manager.render_dispatcher.wait_until_idle(30))
+        manager.render_dispatcher.submit(screen_manager.render_dispatcher.SERVER_FRAME)
+        self.assertTrue(manager.render_dispatcher.wait_until_idle(30))
 
-    def test_image_queue_(self):
-        """TODO"""
-        self.assertEqual(1, 1)
+        # The second poll finds that the server is still on the same frame.
+        self.assertEqual(1, manager.eink_display.num_refreshes)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,107 @@
+"""Unit tests for the shuffle-bag scheduler."""
+import logging
+
+from common.shuffle_scheduler import ShuffleScheduler
+
+
+class FakeImageIndex:
+    """Image index over a settable list of paths."""
+
+    def __init__(self, paths):
+        self.image_source_dir = "/album"
+        self.generation = 0
+        self.set_paths(paths)
+
+    def set_paths(self, paths):
+        self.paths = list(paths)
+        self.generation += 1
+
+    def get_paths(self):
+        return list(self.paths)
+
+
+def make_paths(num_images):
+    return [f"/album/{image_num}.jpg" for image_num in range(num_images)]
+
+
+class TestShuffleScheduler:
+    """Unit test suite for the shuffle-bag scheduler."""
+
+    def test_no_repeats_within_a_cycle(self, display_config):
+        image_index = FakeImageIndex(make_paths(50))
+        scheduler = ShuffleScheduler(logging.getLogger(), display_config, image_index)
+
+        picks = [scheduler.next() for _ in range(50)]
+
+        assert sorted(picks) == sorted(make_paths(50))
+
+    def test_no_back_to_back_repeat_across_cycles(self, display_config):
+        image_index = FakeImageIndex(make_paths(3))
+        scheduler = ShuffleScheduler(logging.getLogger(), display_config, image_index)
+
+        picks = [scheduler.next() for _ in range(30)]
+
+        assert all(pick != next_pick for pick, next_pick in zip(picks, picks[1:]))
+
+    def test_empty_index(self, display_config):
+        scheduler = ShuffleScheduler(
+            logging.getLogger(), display_config, FakeImageIndex([]))
+
+        assert scheduler.next() is None
+
+    def test_peek_matches_next(self, display_config):
+        image_index = FakeImageIndex(make_paths(20))
+        scheduler = ShuffleScheduler(logging.getLogger(), display_config, image_index)
+        scheduler.next()
+
+        upcoming_paths = scheduler.peek(5)
+
+        assert upcoming_paths == [scheduler.next() for _ in range(5)]
+
+    def test_restored_after_restart(self, display_config):
+        image_index = FakeImageIndex(make_paths(20))
+        scheduler = ShuffleScheduler(logging.getLogger(), display_config, image_index)
+        played_paths = [scheduler.next() for _ in range(5)]
+        upcoming_paths = scheduler.peek(15)
+
+        restarted_scheduler = ShuffleScheduler(
+            logging.getLogger(), display_config, image_index)
+
+        assert [restarted_scheduler.next() for _ in range(15)] == upcoming_paths
+        assert not set(played_paths) & set(upcoming_paths)
+
+    def test_reseeded_when_album_changes(self, display_config):
+        image_index = FakeImageIndex(make_paths(20))
+        scheduler = ShuffleScheduler(logging.getLogger(), display_config, image_index)
+        scheduler.next()
+
+        image_index.image_source_dir = "/other-album"
+        restarted_scheduler = ShuffleScheduler(
+            logging.getLogger(), display_config, image_index)
+
+        assert restarted_scheduler.cycle == 0
+        assert restarted_scheduler.order == []
+
+    def test_new_images_inserted_without_reshuffling(self, display_config):
+        image_index = FakeImageIndex(make_paths(20))
+        scheduler = ShuffleScheduler(logging.getLogger(), display_config, image_index)
+        scheduler.next()
+        upcoming_paths = scheduler.peek(19)
+
+        new_paths = ["/album/new-1.jpg", "/album/new-2.jpg"]
+        image_index.set_paths(make_paths(20) + new_paths)
+        picks = [scheduler.next() for _ in range(21)]
+
+        assert [pick for pick in picks if pick not in new_paths] == upcoming_paths
+        assert set(new_paths) <= set(picks)
+
+    def test_removed_images_skipped(self, display_config):
+        image_index = FakeImageIndex(make_paths(20))
+        scheduler = ShuffleScheduler(logging.getLogger(), display_config, image_index)
+        scheduler.next()
+        removed_path = scheduler.peek(1)[0]
+
+        image_index.set_paths(path for path in make_paths(20) if path != removed_path)
+        picks = [scheduler.next() for _ in range(38)]
+
+        assert removed_path not in picks
@@ -0,0 +1,212 @@
+"""Unit tests for weighted image selection."""
+import collections
+import datetime
+import logging
+import random
+import time
+import pytest
+
+from common.weighted_scheduler import (FavouritesRule, FenwickTree, OnThisDayRule,
+                                       RecentRule, WeightedScheduler,
+                                       create_weighting_rules)
+
+
+TODAY = datetime.date(2024, 6, 15)
+
+
+def timestamp_of(date):
+    return time.mktime(date.timetuple()) + 12 * 3600
+
+
+class FakeImageIndex:
+    """Image index over a fixed dict of entries."""
+
+    def __init__(self, entries):
+        self.entries = entries
+        self.generation = 1
+
+    def get_entries(self):
+        return dict(self.entries)
+
+
+@pytest.fixture()
+def display_config(display_config):
+    display_config.config['schedule']['weighting_rules'] = [
+        {"rule": "favourites", "weight": 9.0, "file_names": ["favourite.jpg"]}]
+    return display_config
+
+
+class TestFenwickTree:
+    """Unit test suite for the Fenwick tree."""
+
+    def test_total_and_update(self):
+        tree = FenwickTree([1.0, 2.0, 3.0, 4.0, 5.0])
+        assert tree.total == 15.0
+
+        tree.update(2, 0.0)
+
+        assert tree.total == 12.0
+
+    def test_find_matches_cumulative_weights(self):
+        rng = random.Random(0)
+        weights = [rng.choice([0.0, 0.5, 1.0, 3.0]) for _ in range(37)]
+        tree = FenwickTree(weights)
+
+        for _ in range(200):
+            target = rng.random() * sum(weights)
+            cumulative_weight = 0.0
+            for expected_index, weight in enumerate(weights):
+                cumulative_weight += weight
+                if cumulative_weight > target:
+                    break
+            assert tree.find(target) == expected_index
+
+    def test_draws_follow_weights(self):
+        tree = FenwickTree([1.0, 0.0, 3.0])
+        rng = random.Random(0)
+
+        draws = collections.Counter(tree.draw(rng) for _ in range(4000))
+
+        assert draws[1] == 0
+        assert 2.5 < draws[2] / draws[0] < 3.5
+
+
+class TestWeightingRules:
+    """Unit test suite for the weighting rules."""
+
+    def test_recent(self):
+        rule = RecentRule(weight=3.0, days=30)
+
+        assert rule.get_weight('a.jpg', {'mtime': timestamp_of(datetime.date(2024, 6, 1))}, TODAY) == 3.0
+        assert rule.get_weight('a.jpg', {'mtime': timestamp_of(datetime.date(2024, 1, 1))}, TODAY) == 1.0
+
+    def test_on_this_day(self):
+        rule = OnThisDayRule(weight=5.0, window_days=1)
+
+        assert rule.get_weight('a.jpg', {'mtime': timestamp_of(datetime.date(2019, 6, 14))}, TODAY) == 5.0
+        assert rule.get_weight('a.jpg', {'mtime': timestamp_of(datetime.date(2019, 6, 20))}, TODAY) == 1.0
+        assert rule.get_weight('a.jpg', {'mtime': timestamp_of(TODAY)}, TODAY) == 1.0
+
+    def test_on_this_day_prefers_exif_date(self):
+        rule = OnThisDayRule(weight=5.0)
+        entry = {'mtime': timestamp_of(datetime.date(2024, 1, 1)),
+                 'exif_date': "2019:06:15 10:00:00"}
+
+        assert rule.get_weight('a.jpg', entry, TODAY) == 5.0
+
+    def test_favourites(self):
+        rule = FavouritesRule(weight=2.0, file_names=['a.jpg'])
+
+        assert rule.get_weight('/album/a.jpg', {}, TODAY) == 2.0
+        assert rule.get_weight('/album/b.jpg', {}, TODAY) == 1.0
+
+    def test_unknown_rules_are_ignored(self):
+        weighting_rules = create_weighting_rules(logging.getLogger(), [
+            {"rule": "recent", "weight": 2.0},
+            {"rule": "unknown", "weight": 2.0},
+            {"rule": "favourites", "weight": 2.0, "unknown_param": 1}])
+
+        assert [type(rule) for rule in weighting_rules] == [RecentRule]
+
+
+class TestWeightedScheduler:
+    """Unit test suite for the weighted scheduler."""
+
+    def make_scheduler(self, display_config, num_images):
+        entries = {f"/album/{image_num}.jpg": {'mtime': 0} for image_num in range(num_images)}
+        entries["/album/favourite.jpg"] = {'mtime': 0}
+        scheduler = WeightedScheduler(logging.getLogger(), display_config,
+                                      FakeImageIndex(entries), today_fn=lambda: TODAY)
+        scheduler.rng.seed(0)
+        return scheduler
+
+    def test_favours_weighted_images(self, display_config):
+        scheduler = self.make_scheduler(display_config, 9)
+
+        upcoming = [scheduler.next() for _ in range(2000)]
+        picks = collections.Counter(upcoming)
+
+        favourite_picks = picks.pop("/album/favourite.jpg")
+        assert favourite_picks > 3 * max(picks.values())
+        # No image is shown twice in a row.
+        assert all(pick != next_pick for pick, next_pick in zip(upcoming, upcoming[1:]))
+
+    def test_peek_matches_next(self, display_config):
+        scheduler = self.make_scheduler(display_config, 9)
+
+        upcoming_paths = scheduler.peek(5)
+
+        assert upcoming_paths == [scheduler.next() for _ in range(5)]
+
+    def test_set_weight(self, display_config):
+        scheduler = self.make_scheduler(display_config, 9)
+
+        scheduler.set_weight("/album/favourite.jpg", 0.0)
+
+        assert "/album/favourite.jpg" not in [scheduler.next() for _ in range(200)]
+
+    def test_empty_index(self, display_config):
+        scheduler = WeightedScheduler(logging.getLogger(), display_config,
+                                      FakeImageIndex({}), today_fn=lambda: TODAY)
+
+        assert scheduler.next() is None
+
+
+class FakeMetadataStore:
+    """Metadata store whose crawled records are put by hand."""
+
+    def __init__(self, all_metadata):
+        self.all_metadata = all_metadata
+        self.generation = 0
+        self.listeners = []
+        self.num_get_alls = 0
+
+    def get_all(self):
+        self.num_get_alls += 1
+        return dict(self.all_metadata)
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def put_many(self, records):
+        for image_path, entry, metadata in records:
+            self.all_metadata[image_path] = metadata
+        self.generation += 1
+        for listener in self.listeners:
+            listener(records)
+
+
+class TestWeightedSchedulerMetadata:
+    """Unit test suite for weighting by crawled metadata."""
+
+    def make_scheduler(self, display_config, entries, metadata_store):
+        display_config.config['schedule']['weighting_rules'] = [
+            {"rule": "on_this_day", "weight": 9.0}]
+        scheduler = WeightedScheduler(logging.getLogger(), display_config,
+                                      FakeImageIndex(entries), metadata_store,
+                                      today_fn=lambda: TODAY)
+        scheduler.rng.seed(0)
+        return scheduler
+
+    def test_crawled_dates_reweight_only_their_images(self, display_config):
+        entries = {f"/album/{image_num}.jpg": {'size': 1, 'mtime': timestamp_of(TODAY)}
+                   for image_num in range(3)}
+        metadata_store = FakeMetadataStore({})
+        scheduler = self.make_scheduler(display_config, entries, metadata_store)
+        scheduler.next()
+
+        metadata_store.put_many([("/album/1.jpg", entries["/album/1.jpg"],
+                                  {'exif_date': "2019:06:15 10:00:00"})])
+        scheduler.next()
+
+        assert scheduler.tree.weights == [1.0, 9.0, 1.0]
+        assert metadata_store.num_get_alls == 1
+
+    def test_skips_metadata_of_images_missing_from_index(self, display_config):
+        entries = {"/album/0.jpg": {'size': 1, 'mtime': 0}}
+        metadata_store = FakeMetadataStore({
+            "/album/0.jpg": {'exif_date': None},
+            "/album/removed.jpg": {'exif_date': None}})
+        scheduler = self.make_scheduler(display_config, entries, metadata_store)
+
+        assert scheduler.next() == "/album/0.jpg"